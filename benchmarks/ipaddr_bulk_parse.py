@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Compare ipaddr.bulk_parse_addresses against a loop over ipaddr.IPAddress().
+
+usage: python benchmarks/ipaddr_bulk_parse.py [count]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from py_stdlib.os_utils import ipaddr
+
+
+def timed(label, function, *args):
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    print "%-32s %8.3fs" % (label, elapsed)
+    return result
+
+
+def object_loop(lines):
+    return [int(ipaddr.IPAddress(line)) for line in lines]
+
+
+def main():
+    count = 1000000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    random.seed(0)
+    v4 = [str(ipaddr.IPv4Address(random.getrandbits(32))) for _ in xrange(count)]
+    v6 = [str(ipaddr.IPv6Address(random.getrandbits(128))) for _ in xrange(count // 10)]
+    buf = '\n'.join(v4)
+
+    print "%d IPv4 addresses" % count
+    expected = timed("IPAddress() loop", object_loop, v4)
+    values, _ = timed("bulk_parse_addresses(list)", ipaddr.bulk_parse_addresses, v4)
+    assert list(values) == expected
+    timed("bulk_parse_addresses(buffer)", ipaddr.bulk_parse_addresses, buf)
+
+    print "%d IPv6 addresses" % len(v6)
+    expected = timed("IPAddress() loop", object_loop, v6)
+    values, _ = timed("bulk_parse_addresses(list)", ipaddr.bulk_parse_addresses, v6, 6)
+    assert values == expected
+
+
+if __name__ == '__main__':
+    main()
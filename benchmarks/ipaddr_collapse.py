@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Benchmark ipaddr.collapse_address_list over random networks.
+
+The previous recursive implementation is kept here as a reference; it is
+only run on the smaller inputs (or all of them with --legacy) since it is
+quadratic.
+
+usage: python benchmarks/ipaddr_collapse.py [--legacy] [sizes...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from py_stdlib.os_utils import ipaddr
+from py_stdlib.os_utils.ipaddr import _BaseIP, _BaseNet
+
+
+def legacy_find_address_range(addresses):
+    first = last = addresses[0]
+    for ip in addresses[1:]:
+        if ip._ip == last._ip + 1:
+            last = ip
+        else:
+            break
+    return (first, last)
+
+
+def legacy_collapse_recursive(addresses):
+    ret_array = []
+    optimized = False
+
+    for cur_addr in addresses:
+        if not ret_array:
+            ret_array.append(cur_addr)
+            continue
+        if cur_addr in ret_array[-1]:
+            optimized = True
+        elif cur_addr == ret_array[-1].supernet().subnet()[1]:
+            ret_array.append(ret_array.pop().supernet())
+            optimized = True
+        else:
+            ret_array.append(cur_addr)
+
+    if optimized:
+        return legacy_collapse_recursive(ret_array)
+
+    return ret_array
+
+
+def legacy_collapse_address_list(addresses):
+    i = 0
+    addrs = []
+    ips = []
+    nets = []
+
+    for ip in addresses:
+        if isinstance(ip, _BaseIP):
+            ips.append(ip)
+        elif ip._prefixlen == ip._max_prefixlen:
+            ips.append(ip.ip)
+        else:
+            nets.append(ip)
+
+    ips = sorted(set(ips))
+    nets = sorted(set(nets))
+
+    while i < len(ips):
+        (first, last) = legacy_find_address_range(ips[i:])
+        i = ips.index(last) + 1
+        addrs.extend(ipaddr.summarize_address_range(first, last))
+
+    return legacy_collapse_recursive(sorted(
+        addrs + nets, key=_BaseNet._get_networks_key))
+
+
+def random_networks(count, version=4):
+    """Random networks clustered in a few /8s so that merges happen."""
+    networks = []
+    if version == 4:
+        for _ in xrange(count):
+            prefixlen = random.randint(20, 32)
+            ip = (random.randint(10, 13) << 24) | random.getrandbits(24)
+            networks.append(ipaddr.IPv4Network((ip >> (32 - prefixlen) << (32 - prefixlen), prefixlen)))
+    else:
+        for _ in xrange(count):
+            prefixlen = random.randint(100, 128)
+            ip = (0x2001 << 112) | random.getrandbits(40)
+            networks.append(ipaddr.IPv6Network((ip >> (128 - prefixlen) << (128 - prefixlen), prefixlen)))
+    return networks
+
+
+def timed(label, function, *args):
+    start = time.time()
+    result = function(*args)
+    print "%-40s %8.3fs  (%d networks out)" % (label, time.time() - start, len(result))
+    return result
+
+
+def main():
+    args = sys.argv[1:]
+    legacy = '--legacy' in args
+    sizes = [int(arg) for arg in args if arg != '--legacy'] or [10000, 100000, 1000000]
+
+    random.seed(0)
+    for size in sizes:
+        for version in (4, 6):
+            networks = random_networks(size, version)
+            result = timed("collapse_address_list v%d %d" % (version, size),
+                           ipaddr.collapse_address_list, networks)
+            if legacy or size <= 10000:
+                expected = timed("legacy collapse v%d %d" % (version, size),
+                                 legacy_collapse_address_list, networks)
+                assert result == expected
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Report memory used per ipaddr address and network object.
+
+Each object type is measured by creating many instances and dividing the
+growth in resident set size by the instance count, so shared class data
+and interned small values are not counted.
+
+usage: python benchmarks/ipaddr_memory.py [count]
+"""
+import gc
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from py_stdlib.os_utils import ipaddr
+
+
+def rss():
+    """Resident set size of this process in bytes (Linux only)."""
+    statm = open('/proc/self/statm').read().split()
+    return int(statm[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(label, factory, values, touch=None):
+    gc.collect()
+    before = rss()
+    objects = [factory(value) for value in values]
+    if touch:
+        for obj in objects:
+            touch(obj)
+    gc.collect()
+    used = rss() - before
+    # the list holding the objects is not part of the per object cost
+    used -= sys.getsizeof(objects)
+    print "%-36s %8.1f bytes/object" % (label, float(used) / len(values))
+    del objects
+
+
+def main():
+    count = 500000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    random.seed(0)
+    v4 = [random.getrandbits(32) for _ in xrange(count)]
+    v6 = [random.getrandbits(128) for _ in xrange(count)]
+    v4_nets = ['%s/24' % ipaddr.IPv4Address(ip) for ip in v4]
+    v6_nets = ['%s/64' % ipaddr.IPv6Address(ip) for ip in v6]
+
+    print "%d objects of each type" % count
+    measure("IPv4Address", ipaddr.IPv4Address, v4)
+    measure("IPv6Address", ipaddr.IPv6Address, v6)
+    measure("IPv4Network", ipaddr.IPv4Network, v4_nets)
+    measure("IPv6Network", ipaddr.IPv6Network, v6_nets)
+    measure("IPv4Network (after .broadcast)", ipaddr.IPv4Network, v4_nets,
+            lambda net: net.broadcast)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Compare flat and tree (relay) fan-out of pssh_interface.run_pssh.
+
+No sshd is needed: run with --ssh as first argument this script is a fake
+transport which takes an ssh command line, ignores the host and options
+and runs the remote command locally with /bin/sh, so every host, relays
+included, is a local process.
+
+usage: python benchmarks/pssh_relay.py [hosts] [relay_fanout] [parallel_workers]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from py_stdlib.pssh_interface import PSSHOptions, run_pssh
+from py_stdlib.pssh_interface.capture import demultiplex
+
+# ssh options taking an argument, as used by pssh_interface.ssh_command
+SSH_ARG_OPTIONS = ('-o', '-l', '-p')
+
+
+def fake_ssh(args):
+    """
+    Run the command of the ssh command line args locally, with the host in
+    FAKE_SSH_HOST.
+    """
+    host = args[0]
+    args = args[1:]
+    while args and args[0].startswith('-') and len(args) > 1:
+        if args[0] in SSH_ARG_OPTIONS:
+            args = args[2:]
+        else:
+            args = args[1:]
+    os.environ['FAKE_SSH_HOST'] = host
+    os.execv('/bin/sh', ['/bin/sh', '-c', ' '.join(args) or 'true'])
+
+
+def run(hosts, cmdline, workdir, **config):
+    config = dict(config, host_files=[], capture='multiplex',
+                  capture_file=os.path.join(workdir, 'out.mux'),
+                  transport=[sys.executable, os.path.abspath(__file__), '--ssh'],
+                  relay_python=sys.executable)
+    options = PSSHOptions(config)
+    real_stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    start = time.time()
+    try:
+        statuses = run_pssh(hosts, cmdline, options)
+    finally:
+        sys.stdout = real_stdout
+    elapsed = time.time() - start
+    out = os.path.join(workdir, 'out')
+    os.mkdir(out)
+    exits = demultiplex(config['capture_file'], out)
+    complete = len([host for host, port, user in hosts
+                    if open(os.path.join(out, host)).read() == 'hello %s\n' % host])
+    shutil.rmtree(out)
+    return elapsed, statuses, len(exits), complete
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    fanout = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    hosts = [('host%d' % n, None, None) for n in range(count)]
+    cmdline = 'echo hello $FAKE_SSH_HOST'
+    workdir = tempfile.mkdtemp()
+    try:
+        for name, relay_fanout in (('flat', 0), ('tree', fanout)):
+            elapsed, statuses, exits, complete = run(
+                hosts, cmdline, workdir, parallel_workers=workers,
+                relay_fanout=relay_fanout)
+            failed = len([status for status in statuses if status != 0])
+            print '%-5s %5d hosts  %6.2fs  %d failed  %d exit records  %d outputs complete' % (
+                name, count, elapsed, failed, exits, complete)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--ssh']:
+        fake_ssh(sys.argv[2:])
+    else:
+        main()
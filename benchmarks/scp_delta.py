@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Compare full and delta transfers made by os_utils.scp.Scp.
+
+No sshd is needed: LocalConnection stands in for SSHConnection and runs the
+"remote" commands as local processes against a scratch directory, counting
+the bytes that would have crossed the network.
+
+usage: python benchmarks/scp_delta.py [size_in_mb] [remote_python]
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from py_stdlib.os_utils.hash_utils import checksum as file_checksum
+from py_stdlib.os_utils.openssh_wrapper import SCPFileResult, SSHResult
+from py_stdlib.os_utils.scp import Scp
+
+
+class LocalConnection(object):
+    """
+    Fake transport with the run/scp interface of SSHConnection.
+    """
+    def __init__(self):
+        self.sent = 0
+        self.round_trips = 0
+
+    def run(self, command, interpreter='/bin/bash', forward_ssh_agent=False):
+        self.sent += len(command) + len(interpreter)
+        self.round_trips += 1
+        pipe = subprocess.Popen(interpreter, shell=True, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = pipe.communicate(command)
+        return SSHResult(command, out.strip(), err.strip(), pipe.returncode)
+
+    def scp(self, files, target, mode=None, owner=None, checksum=None):
+        self.round_trips += 1
+        results = []
+        for file_name in files:
+            dest = target
+            if os.path.isdir(target):
+                dest = os.path.join(target, os.path.basename(file_name))
+            shutil.copyfile(file_name, dest)
+            self.sent += os.path.getsize(file_name)
+            if mode:
+                os.chmod(dest, int(str(mode), 8))
+            results.append(SCPFileResult(dest, checksum and file_checksum(dest, checksum)))
+        if mode or owner or checksum:
+            self.round_trips += 1
+        return results
+
+    def close(self):
+        pass
+
+
+class LocalScp(Scp):
+    def __init__(self, connection):
+        Scp.__init__(self, 'localhost')
+        self.connection = connection
+
+    def connect(self, configfile=None):
+        return self.connection
+
+
+def transfer(source, dest, delta, remote_python):
+    conn = LocalConnection()
+    start = time.time()
+    LocalScp(conn).scp(source, dest, "0644", erase_owner=True, delta=delta,
+                       remote_python=remote_python)
+    elapsed = time.time() - start
+    assert open(source, 'rb').read() == open(dest, 'rb').read()
+    return elapsed, conn.sent, conn.round_trips
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    remote_python = sys.argv[2] if len(sys.argv) > 2 else sys.executable
+    size *= 1024 * 1024
+    rand = random.Random(42)
+    data = bytearray(os.urandom(size))
+
+    def edit(data, count):
+        data = bytearray(data)
+        for _ in range(count):
+            data[rand.randrange(len(data))] ^= 0xff
+        return data
+
+    def insert(data, count):
+        data = bytearray(data)
+        for _ in range(count):
+            offset = rand.randrange(len(data))
+            data[offset:offset] = os.urandom(rand.randrange(1, 4096))
+        return data
+
+    scenarios = [
+        ("remote missing", None, data),
+        ("unchanged", data, data),
+        ("10 bytes flipped", data, edit(data, 10)),
+        ("10 inserts", data, insert(data, 10)),
+        ("appended 1MB", data, data + os.urandom(1024 * 1024)),
+        ("rewritten", data, bytearray(os.urandom(size))),
+    ]
+
+    workdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(workdir, 'source')
+        dest = os.path.join(workdir, 'dest')
+        print "%-18s %10s %12s %10s %12s" % ("scenario", "full s", "full bytes", "delta s", "delta bytes")
+        for label, old, new in scenarios:
+            open(source, 'wb').write(new)
+            results = []
+            for delta in (False, True):
+                if os.path.exists(dest):
+                    os.unlink(dest)
+                if old is not None:
+                    open(dest, 'wb').write(old)
+                elapsed, sent, _ = transfer(source, dest, delta, remote_python)
+                results += [elapsed, sent]
+            print "%-18s %10.3f %12d %10.3f %12d" % tuple([label] + results)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
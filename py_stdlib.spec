@@ -7,7 +7,7 @@
 Name:           py_stdlib
 Group:          System Environment/Libraries
 Version:        0
-Release:        9%{?dist}
+Release:        10%{?dist}
 Summary:        Provides many helper modules for common uses cases when programming with Python (2.6+)
 
 License:        Fermitools Software Legal Information (Modified BSD License)
@@ -17,7 +17,6 @@ BuildRequires:  python2-devel
 
 Requires:       python-dateutil
 Requires:       python-colorama
-Requires:       pssh
 Requires:       openssl
 Requires:       libxml2
 Requires:       libxml2-python
@@ -60,7 +59,8 @@ py_stdlib.os_utils
     Provides python implementations of many shell commands.
 
 py_stdlib.pssh_interface
-    Provides a programmatic interface for pssh.
+    Provides a programmatic interface for running commands on many hosts in
+    parallel, in the manner of pssh, without depending on it.
 
 py_stdlib.py_utils
     Provides useful utility functions for python programming tasks.
@@ -97,6 +97,9 @@ cp -r py_stdlib $RPM_BUILD_ROOT%{python_sitelib}
 %{python_sitelib}/py_stdlib/
 
 %changelog
+* Sun Oct 18 2026 agent <agent@local> - 0.10
+- pssh_interface runs hosts with its own executor, drop the pssh requirement
+
 * Thu Aug 21 2014 Anthony Tiradani <anthony.tiradani@gmail.com> - 0.9
 - add the option to pass in a config file
 
@@ -1,7 +1,15 @@
 import hashlib
+import io
+import mmap
+import multiprocessing
+import os
+import Queue
+import sqlite3
+import threading
 
 # for reference:  http://stackoverflow.com/questions/3431825/generating-a-md5-checksum-of-a-file
 # NOTE: md5 and sha1 are intentionally, and explicity excluded due to known security holes
+# (openssh_wrapper.CHECKSUM_ALGORITHMS lists the same set for remote checksums)
 def get_hasher(algorithm="sha256"):
     hasher = None
     if algorithm == "sha256":
@@ -16,8 +24,434 @@ def get_hasher(algorithm="sha256"):
     return hasher
 
 def checksum(file_name, algorithm="sha256", blocksize=65536):
+    cache = _checksum_cache
+    if cache is not None:
+        return cache.digest(file_name, algorithm,
+                            lambda: _checksum(file_name, algorithm, blocksize))[0]
+    return _checksum(file_name, algorithm, blocksize)
+
+def _checksum(file_name, algorithm, blocksize):
     hasher = get_hasher(algorithm)
     with open(file_name, "r+b") as f:
         for block in iter(lambda: f.read(blocksize), ""):
             hasher.update(block)
     return hasher.hexdigest()
+
+def multi_checksum(file_name, algorithms=("sha256", "sha512"), blocksize=65536):
+    """
+    Compute several checksums of a file in a single read pass.
+
+    The file is read with readinto into one reusable buffer which is fed to
+    every hasher, so no memory is allocated per block.
+
+    @type algorithms: iterable
+    @param algorithms: algorithms supported by get_hasher
+
+    @return: dict mapping each algorithm to its hexdigest
+
+    @raise ValueError: if an algorithm is not supported
+    """
+    hashers = {}
+    for algorithm in algorithms:
+        hasher = get_hasher(algorithm)
+        if hasher is None:
+            raise ValueError("Unsupported checksum algorithm: %s" % algorithm)
+        hashers[algorithm] = hasher
+    updates = [hasher.update for hasher in hashers.values()]
+
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    # unbuffered, readinto fills our buffer directly
+    with io.open(file_name, "rb", buffering=0) as f:
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                break
+            block = view
+            if count < blocksize:
+                block = view[:count]
+            for update in updates:
+                update(block)
+    return dict((algorithm, hasher.hexdigest()) for algorithm, hasher in hashers.items())
+
+def _mtime_ns(stat):
+    mtime_ns = getattr(stat, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(round(stat.st_mtime * 1e9))
+    return mtime_ns
+
+class ChecksumCache(object):
+    """
+    Persistent cache of file checksums, stored in a sqlite database.
+
+    Entries are keyed on (device, inode, algorithm) and remember the size
+    and modification time the file had when it was hashed; an entry is only
+    used while both still match, so changed files are rehashed.
+    """
+    def __init__(self, db_path=None):
+        """
+        @type db_path: string
+        @param db_path: the sqlite database to use, by default
+        ~/.cache/py_stdlib/checksums.db (created if missing)
+        """
+        if db_path is None:
+            db_path = os.path.expanduser("~/.cache/py_stdlib/checksums.db")
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        if not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.db_path = db_path
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_not_hashed = 0
+        self.bytes_hashed = 0
+
+        # the connection is shared by checksum_files worker threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        # the cache can always be rebuilt, so don't pay for durability
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                         " device INTEGER, inode INTEGER, algorithm TEXT,"
+                         " size INTEGER, mtime_ns INTEGER, digest TEXT,"
+                         " PRIMARY KEY (device, inode, algorithm))")
+        self._db.commit()
+
+    def digest(self, file_name, algorithm, compute):
+        """
+        Return (hexdigest, size) for file_name, from the cache if the file is
+        unchanged since it was last hashed, otherwise by calling compute()
+        (which must return the hexdigest) and recording the result.
+        """
+        stat = os.stat(file_name)
+        key = (stat.st_dev, stat.st_ino, algorithm)
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, digest FROM checksums"
+                                   " WHERE device=? AND inode=? AND algorithm=?",
+                                   key).fetchone()
+            if row and row[0] == stat.st_size and row[1] == _mtime_ns(stat):
+                self.hits += 1
+                self.bytes_not_hashed += stat.st_size
+                return str(row[2]), stat.st_size
+            self.misses += 1
+
+        digest = compute()
+
+        # don't record a digest for a file that changed while being hashed
+        after = os.stat(file_name)
+        with self._lock:
+            self.bytes_hashed += after.st_size
+            if (after.st_dev, after.st_ino, after.st_size, _mtime_ns(after)) == \
+               (stat.st_dev, stat.st_ino, stat.st_size, _mtime_ns(stat)):
+                self._db.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)",
+                                 key + (stat.st_size, _mtime_ns(stat), digest))
+                self._db.commit()
+        return digest, stat.st_size
+
+    def stats(self):
+        """
+        @return: dict with the hits, misses, hit_ratio, bytes_hashed and
+        bytes_not_hashed since the cache was opened
+        """
+        lookups = self.hits + self.misses
+        hit_ratio = 0.0
+        if lookups:
+            hit_ratio = float(self.hits) / lookups
+        return {"hits": self.hits, "misses": self.misses, "hit_ratio": hit_ratio,
+                "bytes_hashed": self.bytes_hashed,
+                "bytes_not_hashed": self.bytes_not_hashed}
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM checksums")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+_checksum_cache = None
+
+def enable_checksum_cache(db_path=None):
+    """
+    Make checksum and checksum_files consult a persistent ChecksumCache.
+
+    @return: the ChecksumCache, use its stats() method for hit ratios
+    """
+    global _checksum_cache
+    disable_checksum_cache()
+    _checksum_cache = ChecksumCache(db_path)
+    return _checksum_cache
+
+def disable_checksum_cache():
+    global _checksum_cache
+    if _checksum_cache is not None:
+        _checksum_cache.close()
+        _checksum_cache = None
+
+def checksum_cache_stats():
+    """
+    @return: the stats() of the enabled ChecksumCache, or None
+    """
+    if _checksum_cache is None:
+        return None
+    return _checksum_cache.stats()
+
+MIN_BLOCKSIZE = 64 * 1024
+MAX_BLOCKSIZE = 4 * 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+def adaptive_blocksize(size):
+    """
+    Pick a read size for a file: 64 KiB for small files, growing with the
+    file (1/64th of it) up to 4 MiB so large files take fewer, larger reads.
+    """
+    return max(MIN_BLOCKSIZE, min(MAX_BLOCKSIZE, size // 64))
+
+def _hash_file(file_name, algorithm, blocksize=None, mmap_threshold=None):
+    """
+    Hash one file, returning (hexdigest, size).  Files of at least
+    mmap_threshold bytes are hashed straight from a memory map.
+    """
+    hasher = get_hasher(algorithm)
+    with open(file_name, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if mmap_threshold is not None and size and size >= mmap_threshold:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                hasher.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            if not blocksize:
+                blocksize = adaptive_blocksize(size)
+            for block in iter(lambda: f.read(blocksize), ""):
+                hasher.update(block)
+    return hasher.hexdigest(), size
+
+def checksum_files(file_names, algorithm="sha256", workers=None, blocksize=None,
+                   mmap_threshold=MMAP_THRESHOLD):
+    """
+    Checksum many files concurrently with a pool of threads.  hashlib
+    releases the GIL while hashing, so the threads run in parallel.
+
+    Results are yielded as each file completes, in completion order, as
+    (file_name, hexdigest, size, error) tuples.  When a file can not be
+    read or hashed, hexdigest and size are None and error holds the
+    exception.
+
+    @type file_names: iterable
+    @param file_names: the paths of the files to checksum
+
+    @type algorithm: string
+    @param algorithm: one of the algorithms supported by get_hasher
+
+    @type workers: int
+    @param workers: the number of threads, defaults to the number of cpus
+
+    @type blocksize: int
+    @param blocksize: the read size, by default picked per file by
+    adaptive_blocksize
+
+    @type mmap_threshold: int
+    @param mmap_threshold: files of at least this size are memory mapped
+    instead of read, None disables memory mapping
+
+    @raise ValueError: if the algorithm is not supported
+    """
+    if get_hasher(algorithm) is None:
+        raise ValueError("Unsupported checksum algorithm: %s" % algorithm)
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    return _checksum_files(list(file_names), algorithm, workers, blocksize, mmap_threshold)
+
+def _checksum_files(file_names, algorithm, workers, blocksize, mmap_threshold):
+    todo = Queue.Queue()
+    for file_name in file_names:
+        todo.put(file_name)
+    done = Queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        while not stop.is_set():
+            try:
+                file_name = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                cache = _checksum_cache
+                if cache is not None:
+                    digest, size = cache.digest(file_name, algorithm, lambda: _hash_file(
+                        file_name, algorithm, blocksize, mmap_threshold)[0])
+                else:
+                    digest, size = _hash_file(file_name, algorithm, blocksize, mmap_threshold)
+                done.put((file_name, digest, size, None))
+            except Exception, ex:
+                # any failure is reported for its file, a dead thread would
+                # leave the caller waiting for a result forever
+                done.put((file_name, None, None, ex))
+
+    threads = []
+    for _ in range(min(workers, len(file_names))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for _ in file_names:
+            yield done.get()
+    finally:
+        # stop handing out work if the caller stopped iterating early
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+def merkle_root(digests, algorithm="sha256"):
+    """
+    Combine hexdigests of consecutive chunks into a Merkle root.
+
+    Pairs of nodes are joined as H('\\x01' + left + right) over the raw
+    digests, and an odd node out is carried up a level unchanged.  One
+    chunk is its own root, and no chunks (an empty file) hash as ''.
+    """
+    if not digests:
+        return get_hasher(algorithm).hexdigest()
+    level = [digest.decode("hex") for digest in digests]
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level) - 1, 2):
+            hasher = get_hasher(algorithm)
+            hasher.update("\x01" + level[i] + level[i + 1])
+            parents.append(hasher.digest())
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0].encode("hex")
+
+class ChunkedChecksum(object):
+    """
+    Per-chunk digests of a file together with their Merkle root.
+
+    Each digest is the plain checksum of one chunk_size slice of the file
+    (the last one may be shorter), so a remote copy can be checked chunk by
+    chunk with ordinary tools, e.g. dd piped into sha256sum.
+    """
+    def __init__(self, size, digests, algorithm="sha256", chunk_size=DEFAULT_CHUNK_SIZE):
+        self.size = size
+        self.digests = list(digests)
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self._root = None
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = merkle_root(self.digests, self.algorithm)
+        return self._root
+
+    def __eq__(self, other):
+        return (self.algorithm, self.chunk_size, self.size, self.root) == \
+               (other.algorithm, other.chunk_size, other.size, other.root)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def changed_chunks(self, other):
+        """
+        @return: the indexes of the chunks of this file which are missing or
+        different in other
+
+        @raise ValueError: if the two were computed with different algorithms
+        or chunk sizes
+        """
+        if (self.algorithm, self.chunk_size) != (other.algorithm, other.chunk_size):
+            raise ValueError("Checksums use different algorithms or chunk sizes")
+        changed = []
+        for index, digest in enumerate(self.digests):
+            if index >= len(other.digests) or other.digests[index] != digest:
+                changed.append(index)
+        return changed
+
+    def changed_regions(self, other):
+        """
+        @return: list of (offset, length) byte ranges of this file which
+        differ from other, with adjacent changed chunks merged
+        """
+        regions = []
+        for index in self.changed_chunks(other):
+            offset = index * self.chunk_size
+            length = min(self.chunk_size, self.size - offset)
+            if regions and regions[-1][0] + regions[-1][1] == offset:
+                regions[-1] = (regions[-1][0], regions[-1][1] + length)
+            else:
+                regions.append((offset, length))
+        return regions
+
+def chunked_checksum(file_name, algorithm="sha256", chunk_size=DEFAULT_CHUNK_SIZE,
+                     workers=None):
+    """
+    Hash a file in fixed size chunks on a pool of threads.
+
+    Every worker reads whole chunks into its own reusable buffer, and
+    hashlib releases the GIL while hashing, so large files are hashed in
+    parallel.
+
+    @type workers: int
+    @param workers: the number of threads, defaults to the number of cpus
+
+    @return: a ChunkedChecksum
+
+    @raise ValueError: if the algorithm is not supported
+    @raise IOError: if the file can not be read
+    """
+    if get_hasher(algorithm) is None:
+        raise ValueError("Unsupported checksum algorithm: %s" % algorithm)
+    if not workers:
+        workers = multiprocessing.cpu_count()
+
+    size = os.path.getsize(file_name)
+    count = (size + chunk_size - 1) // chunk_size
+    digests = [None] * count
+    errors = []
+    todo = Queue.Queue()
+    for index in range(count):
+        todo.put(index)
+
+    def worker():
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        try:
+            with io.open(file_name, "rb", buffering=0) as f:
+                while not errors:
+                    try:
+                        index = todo.get_nowait()
+                    except Queue.Empty:
+                        return
+                    f.seek(index * chunk_size)
+                    filled = 0
+                    while filled < chunk_size:
+                        read = f.readinto(view[filled:])
+                        if not read:
+                            break
+                        filled += read
+                    hasher = get_hasher(algorithm)
+                    hasher.update(view[:filled])
+                    digests[index] = hasher.hexdigest()
+        except Exception, ex:
+            errors.append(ex)
+
+    threads = []
+    for _ in range(min(workers, count)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    return ChunkedChecksum(size, digests, algorithm, chunk_size)
@@ -24,7 +24,17 @@ and networks.
 
 __version__ = '2.1.10'
 
+import array
+import bisect
+import functools
+import hashlib
+import mmap
+import os
+import socket
 import struct
+import sys
+import tempfile
+import threading
 
 IPV4LENGTH = 32
 IPV6LENGTH = 128
@@ -149,24 +159,6 @@ def v6_int_to_packed(address):
     return Bytes(struct.pack('!QQ', address >> 64, address & (2**64 - 1)))
 
 
-def _find_address_range(addresses):
-    """Find a sequence of addresses.
-
-    Args:
-        addresses: a list of IPv4 or IPv6 addresses.
-
-    Returns:
-        A tuple containing the first and last IP addresses in the sequence.
-
-    """
-    first = last = addresses[0]
-    for ip in addresses[1:]:
-        if ip._ip == last._ip + 1:
-            last = ip
-        else:
-            break
-    return (first, last)
-
 def _get_prefix_length(number1, number2, bits):
     """Get the number of leading bits that are same for two numbers.
 
@@ -179,9 +171,9 @@ def _get_prefix_length(number1, number2, bits):
         The number of leading bits that are the same for two numbers.
 
     """
-    for i in range(bits):
-        if number1 >> i == number2 >> i:
-            return bits - i
+    differing = (number1 ^ number2).bit_length()
+    if differing < bits:
+        return bits - differing
     return 0
 
 def _count_righthand_zero_bits(number, bits):
@@ -197,9 +189,57 @@ def _count_righthand_zero_bits(number, bits):
     """
     if number == 0:
         return bits
-    for i in range(bits):
-        if (number >> i) % 2:
-            return i
+    return min(bits, (number & -number).bit_length() - 1)
+
+def _summarize_int_range(first_int, last_int, bits):
+    """Generate the CIDR blocks covering an integer address range.
+
+    Args:
+        first_int: an integer, the first address in the range.
+        last_int: an integer, the last address in the range.
+        bits: the number of bits in an address.
+
+    Returns:
+        An iterator of (network, prefixlen) integer tuples.
+
+    """
+    while first_int <= last_int:
+        # The largest block starting at first_int is bounded both by the
+        # alignment of first_int and by the number of addresses left.
+        nbits = min(_count_righthand_zero_bits(first_int, bits),
+                    (last_int - first_int + 1).bit_length() - 1)
+        yield first_int, bits - nbits
+        first_int += 1 << nbits
+
+def iter_summarize_address_range(first, last):
+    """Summarize a network range, generating the networks lazily.
+
+    This is the streaming form of summarize_address_range(); it takes the
+    same arguments and raises the same errors (as soon as it is called,
+    not on the first iteration).  Networks are computed with integer
+    arithmetic, so large IPv6 ranges cost O(1) memory.
+
+    Returns:
+        An iterator of IPv4Network's or IPv6Network's.
+
+    """
+    if not (isinstance(first, _BaseIP) and isinstance(last, _BaseIP)):
+        raise TypeError('first and last must be IP addresses, not networks')
+    if first.version != last.version:
+        raise TypeError("%s and %s are not of the same version" % (
+                str(first), str(last)))
+    if first > last:
+        raise ValueError('last IP address must be greater than first')
+
+    if first.version == 4:
+        ip = IPv4Network
+    elif first.version == 6:
+        ip = IPv6Network
+    else:
+        raise ValueError('unknown IP version')
+
+    return (ip((net, prefixlen)) for net, prefixlen in
+            _summarize_int_range(first._ip, last._ip, first._max_prefixlen))
 
 def summarize_address_range(first, last):
     """Summarize a network range given the first and last IP addresses.
@@ -227,89 +267,46 @@ def summarize_address_range(first, last):
             If the version is not 4 or 6.
 
     """
-    if not (isinstance(first, _BaseIP) and isinstance(last, _BaseIP)):
-        raise TypeError('first and last must be IP addresses, not networks')
-    if first.version != last.version:
-        raise TypeError("%s and %s are not of the same version" % (
-                str(first), str(last)))
-    if first > last:
-        raise ValueError('last IP address must be greater than first')
+    return list(iter_summarize_address_range(first, last))
 
-    networks = []
+def _collapse_prefixes(prefixes, bits):
+    """Collapse a sorted list of integer prefixes.
 
-    if first.version == 4:
-        ip = IPv4Network
-    elif first.version == 6:
-        ip = IPv6Network
-    else:
-        raise ValueError('unknown IP version')
-
-    ip_bits = first._max_prefixlen
-    first_int = first._ip
-    last_int = last._ip
-    while first_int <= last_int:
-        nbits = _count_righthand_zero_bits(first_int, ip_bits)
-        current = None
-        while nbits >= 0:
-            addend = 2**nbits - 1
-            current = first_int + addend
-            nbits -= 1
-            if current <= last_int:
-                break
-        prefix = _get_prefix_length(first_int, current, ip_bits)
-        net = ip('%s/%d' % (str(first), prefix))
-        networks.append(net)
-        if current == ip._ALL_ONES:
-            break
-        first_int = current + 1
-        first = IPAddress(first_int, version=first._version)
-    return networks
-
-def _collapse_address_list_recursive(addresses):
-    """Loops through the addresses, collapsing concurrent netblocks.
-
-    Example:
+    Walks the prefixes once, keeping a stack of disjoint blocks: a prefix
+    contained in the top of the stack is dropped, and a prefix which is
+    the upper sibling of the top is merged into their supernet (which may
+    in turn merge with the new top).
 
-        ip1 = IPv4Network('1.1.0.0/24')
-        ip2 = IPv4Network('1.1.1.0/24')
-        ip3 = IPv4Network('1.1.2.0/24')
-        ip4 = IPv4Network('1.1.3.0/24')
-        ip5 = IPv4Network('1.1.4.0/24')
-        ip6 = IPv4Network('1.1.0.1/22')
-
-        _collapse_address_list_recursive([ip1, ip2, ip3, ip4, ip5, ip6]) ->
-          [IPv4Network('1.1.0.0/22'), IPv4Network('1.1.4.0/24')]
-
-        This shouldn't be called directly; it is called via
-          collapse_address_list([]).
+    This shouldn't be called directly; it is called via
+      collapse_address_list([]).
 
     Args:
-        addresses: A list of IPv4Network's or IPv6Network's
+        prefixes: A list of (network, prefixlen, obj) tuples sorted by
+          network and prefixlen, where network is the integer network
+          address and obj is the object the prefix came from (or None).
+        bits: The maximum prefix length of the address family.
 
     Returns:
-        A list of IPv4Network's or IPv6Network's depending on what we were
-        passed.
+        A list of (network, prefixlen, obj) tuples.  obj is only kept for
+        prefixes which passed through unchanged; it is None otherwise.
 
     """
-    ret_array = []
-    optimized = False
-
-    for cur_addr in addresses:
-        if not ret_array:
-            ret_array.append(cur_addr)
-            continue
-        if cur_addr in ret_array[-1]:
-            optimized = True
-        elif cur_addr == ret_array[-1].supernet().subnet()[1]:
-            ret_array.append(ret_array.pop().supernet())
-            optimized = True
-        else:
-            ret_array.append(cur_addr)
-
-    if optimized:
-        return _collapse_address_list_recursive(ret_array)
-
-    return ret_array
+    stack = []
+    for net, prefixlen, obj in prefixes:
+        if stack:
+            top_net, top_prefixlen, _ = stack[-1]
+            if (top_prefixlen <= prefixlen and
+                not (net ^ top_net) >> (bits - top_prefixlen)):
+                continue
+        while stack:
+            top_net, top_prefixlen, _ = stack[-1]
+            if (top_prefixlen != prefixlen or not prefixlen or
+                net ^ top_net != 1 << (bits - prefixlen)):
+                break
+            stack.pop()
+            net, prefixlen, obj = top_net, prefixlen - 1, None
+        stack.append((net, prefixlen, obj))
+    return stack
 
 
 def collapse_address_list(addresses):
@@ -319,6 +316,10 @@ def collapse_address_list(addresses):
         collapse_address_list([IPv4('1.1.0.0/24'), IPv4('1.1.1.0/24')]) ->
           [IPv4('1.1.0.0/23')]
 
+    The addresses are sorted once and collapsed in a single pass over
+    their integer (network, prefixlen) pairs, so this runs in
+    O(n log n) regardless of how many merges are needed.
+
     Args:
         addresses: A list of IPv4Network or IPv6Network objects.
 
@@ -330,43 +331,129 @@ def collapse_address_list(addresses):
         TypeError: If passed a list of mixed version objects.
 
     """
-    i = 0
-    addrs = []
-    ips = []
-    nets = []
+    last_ip = last_net = None
+    prefixes = {4: [], 6: []}
 
-    # split IP addresses and networks
+    # split IP addresses and networks into integer prefixes
     for ip in addresses:
         if isinstance(ip, _BaseIP):
-            if ips and ips[-1]._version != ip._version:
+            if last_ip is not None and last_ip._version != ip._version:
                 raise TypeError("%s and %s are not of the same version" % (
-                        str(ip), str(ips[-1])))
-            ips.append(ip)
+                        str(ip), str(last_ip)))
+            last_ip = ip
+            prefixes[ip._version].append((ip._ip, ip._max_prefixlen, None))
         elif ip._prefixlen == ip._max_prefixlen:
-            if ips and ips[-1]._version != ip._version:
+            if last_ip is not None and last_ip._version != ip._version:
                 raise TypeError("%s and %s are not of the same version" % (
-                        str(ip), str(ips[-1])))
-            ips.append(ip.ip)
+                        str(ip), str(last_ip)))
+            last_ip = ip.ip
+            prefixes[ip._version].append((ip._ip, ip._max_prefixlen, None))
         else:
-            if nets and nets[-1]._version != ip._version:
+            if last_net is not None and last_net._version != ip._version:
                 raise TypeError("%s and %s are not of the same version" % (
-                        str(ip), str(ips[-1])))
-            nets.append(ip)
+                        str(ip), str(last_net)))
+            last_net = ip
+            hostbits = ip._max_prefixlen - ip._prefixlen
+            prefixes[ip._version].append(
+                ((ip._ip >> hostbits) << hostbits, ip._prefixlen, ip))
+
+    ret = []
+    for version, bits, network in ((4, IPV4LENGTH, IPv4Network),
+                                   (6, IPV6LENGTH, IPv6Network)):
+        version_prefixes = prefixes[version]
+        version_prefixes.sort(key=lambda prefix: prefix[:2])
+        for net, prefixlen, obj in _collapse_prefixes(version_prefixes, bits):
+            if obj is None:
+                obj = network((net, prefixlen))
+            ret.append(obj)
+    return ret
 
-    # sort and dedup
-    ips = sorted(set(ips))
-    nets = sorted(set(nets))
+# backwards compatibility
+CollapseAddrList = collapse_address_list
 
-    while i < len(ips):
-        (first, last) = _find_address_range(ips[i:])
-        i = ips.index(last) + 1
-        addrs.extend(summarize_address_range(first, last))
 
-    return _collapse_address_list_recursive(sorted(
-        addrs + nets, key=_BaseNet._get_networks_key))
+def _pack_v4_slow(ip_str):
+    return v4_int_to_packed(IPv4Address(ip_str)._ip)
+
+
+def _pack_v6_slow(ip_str):
+    return v6_int_to_packed(IPv6Address(ip_str)._ip)
+
+
+try:
+    socket.inet_pton(socket.AF_INET6, '::')
+    _pack_v4 = lambda ip_str: socket.inet_pton(socket.AF_INET, ip_str)
+    _pack_v6 = lambda ip_str: socket.inet_pton(socket.AF_INET6, ip_str)
+except (AttributeError, socket.error):
+    # No inet_pton on this platform, stick to the pure python parsers.
+    _pack_v4 = _pack_v4_slow
+    _pack_v6 = _pack_v6_slow
 
-# backwards compatibility
-CollapseAddrList = collapse_address_list
+
+def bulk_parse_addresses(addresses, version=4):
+    """Parse many address strings without building address objects.
+
+    Example:
+        >>> bulk_parse_addresses(['1.2.3.4', 'bogus', '10.0.0.1'])
+        (array('I', [16909060L, 0L, 167772161L]), bytearray(b'\x00\x01\x00'))
+
+    Args:
+        addresses: An iterable of address strings, or a newline
+          delimited string/bytearray buffer holding one address per line.
+        version: An Integer, 4 or 6, the version of every address.
+
+    Returns:
+        A (values, errors) tuple.  For IPv4, values is an array('I') of
+        the integer addresses; for IPv6 it is a list of integers.  errors
+        is a bytearray with one entry per input, 1 where the input could
+        not be parsed (its value is then 0) and 0 otherwise.
+
+    Raises:
+        ValueError: If the version is not 4 or 6.
+
+    """
+    if version == 4:
+        fast, slow, width, zero = _pack_v4, _pack_v4_slow, 4, '\0' * 4
+    elif version == 6:
+        fast, slow, width, zero = _pack_v6, _pack_v6_slow, 16, '\0' * 16
+    else:
+        raise ValueError('unknown IP version %r' % version)
+
+    if isinstance(addresses, (basestring, bytearray)):
+        addresses = str(addresses).splitlines()
+
+    packed = []
+    errors = bytearray()
+    for ip_str in addresses:
+        try:
+            packed.append(fast(ip_str))
+            errors.append(0)
+            continue
+        except (socket.error, TypeError, UnicodeError):
+            pass
+        # inet_pton is stricter than ipaddr in a few corner cases (eg.
+        # 5-digit zero padded hextets); defer to the reference parser.
+        try:
+            packed.append(slow(ip_str))
+            errors.append(0)
+        except ValueError:
+            packed.append(zero)
+            errors.append(1)
+    packed = ''.join(packed)
+
+    if version == 4:
+        values = array.array('I')
+        if values.itemsize != 4:
+            values = array.array('L')
+        values.fromstring(packed)
+        if sys.byteorder == 'little':
+            values.byteswap()
+        return values, errors
+
+    halves = struct.unpack('!%dQ' % (len(packed) // 8), packed)
+    values = [(halves[i] << 64) | halves[i + 1]
+              for i in xrange(0, len(halves), 2)]
+    return values, errors
 
 # We need to distinguish between the string and packed-bytes representations
 # of an IP address.  For example, b'0::1' is the IPv4 address 48.58.58.49,
@@ -414,9 +501,150 @@ def get_mixed_type_key(obj):
         return obj._get_address_key()
     return NotImplemented
 
+class _LRUCache(object):
+
+    """A bounded, thread safe, least recently used cache.
+
+    Entries live in a dict and in a circular doubly linked list of
+    [prev, next, key, value] links ordered from least to most recently
+    used, so lookups, insertions and evictions are all O(1).
+
+    """
+
+    def __init__(self, maxsize):
+        if maxsize < 1:
+            raise ValueError('cache size must be at least 1')
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._map = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key (or None), marking it as used."""
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                self.misses += 1
+                return None
+            link_prev, link_next, _, value = link
+            link_prev[1] = link_next
+            link_next[0] = link_prev
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entry."""
+        self._lock.acquire()
+        try:
+            if key in self._map:
+                return
+            root = self._root
+            if len(self._map) >= self.maxsize:
+                oldest = root[1]
+                root[1] = oldest[1]
+                oldest[1][0] = root
+                del self._map[oldest[2]]
+            last = root[0]
+            link = [last, root, key, value]
+            last[1] = root[0] = link
+            self._map[key] = link
+        finally:
+            self._lock.release()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'currsize': len(self._map), 'maxsize': self.maxsize}
+
+
+def _cached(cache_name):
+    """Route a single argument method through an optional class cache.
+
+    The cache is looked up as a class attribute named cache_name; while it
+    is None (the default) the method is called directly.
+
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, arg=None):
+            cache = getattr(self, cache_name)
+            if cache is None or arg is None:
+                return method(self, arg)
+            value = cache.get(arg)
+            if value is None:
+                value = method(self, arg)
+                cache.put(arg, value)
+            return value
+        return wrapper
+    return decorator
+
+
+def enable_cache(maxsize=65536):
+    """Turn on caching of address parsing and rendering.
+
+    Once enabled, turning a string into an address or network and turning
+    an address back into a string consult a bounded LRU cache.  This pays
+    off when the same addresses are seen over and over, e.g. when writing
+    logs.  Calling this again replaces the caches (and their counters).
+
+    Args:
+        maxsize: An integer, the maximum number of entries in each of the
+          parse and render caches, per IP version.
+
+    Raises:
+        ValueError: If maxsize is less than 1.
+
+    """
+    for cls in (_BaseV4, _BaseV6):
+        cls._parse_cache = _LRUCache(maxsize)
+        cls._render_cache = _LRUCache(maxsize)
+
+
+def disable_cache():
+    """Turn off and drop the caches set up by enable_cache()."""
+    for cls in (_BaseV4, _BaseV6):
+        cls._parse_cache = None
+        cls._render_cache = None
+
+
+def cache_info():
+    """Return hit/miss counters for the caches set up by enable_cache().
+
+    Returns:
+        A dict mapping 'ipv4_parse', 'ipv4_render', 'ipv6_parse' and
+        'ipv6_render' to dicts with 'hits', 'misses', 'currsize' and
+        'maxsize' keys.  Empty if caching is disabled.
+
+    """
+    info = {}
+    for name, cls in (('ipv4', _BaseV4), ('ipv6', _BaseV6)):
+        if cls._parse_cache is not None:
+            info[name + '_parse'] = cls._parse_cache.info()
+            info[name + '_render'] = cls._render_cache.info()
+    return info
+
+
 class _IPAddrBase(object):
 
-    """The mother class."""
+    """The mother class.
+
+    Address and network objects hold nothing but integers in __slots__;
+    everything else (netmask, network, broadcast, ...) is derived on
+    access.  This keeps large collections of them compact.
+
+    """
+
+    __slots__ = ()
 
     def __index__(self):
         return self._ip
@@ -447,6 +675,8 @@ class _BaseIP(_IPAddrBase):
 
     """
 
+    __slots__ = ('_ip', '__weakref__')
+
     def __eq__(self, other):
         try:
             return (self._ip == other._ip
@@ -515,6 +745,9 @@ class _BaseIP(_IPAddrBase):
     def __hash__(self):
         return hash(hex(long(self._ip)))
 
+    def __reduce__(self):
+        return self.__class__, (self._ip,)
+
     def _get_address_key(self):
         return (self._version, self)
 
@@ -532,8 +765,7 @@ class _BaseNet(_IPAddrBase):
 
     """
 
-    def __init__(self, address):
-        self._cache = {}
+    __slots__ = ('_ip', '_prefixlen', '__weakref__')
 
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, str(self))
@@ -545,22 +777,26 @@ class _BaseNet(_IPAddrBase):
            or broadcast addresses.
 
         """
-        cur = int(self.network) + 1
-        bcast = int(self.broadcast) - 1
+        cur = self._network_int()
+        bcast = self._broadcast_int()
+        # A /31 (or /127) has no network or broadcast address to skip.
+        if self._prefixlen != self._max_prefixlen - 1:
+            cur += 1
+            bcast -= 1
         while cur <= bcast:
             cur += 1
             yield IPAddress(cur - 1, version=self._version)
 
     def __iter__(self):
-        cur = int(self.network)
-        bcast = int(self.broadcast)
+        cur = self._network_int()
+        bcast = self._broadcast_int()
         while cur <= bcast:
             cur += 1
             yield IPAddress(cur - 1, version=self._version)
 
     def __getitem__(self, n):
-        network = int(self.network)
-        broadcast = int(self.broadcast)
+        network = self._network_int()
+        broadcast = self._broadcast_int()
         if n >= 0:
             if network + n > broadcast:
                 raise IndexError
@@ -578,10 +814,12 @@ class _BaseNet(_IPAddrBase):
         if not isinstance(other, _BaseNet):
             raise TypeError('%s and %s are not of the same type' % (
                     str(self), str(other)))
-        if self.network != other.network:
-            return self.network < other.network
-        if self.netmask != other.netmask:
-            return self.netmask < other.netmask
+        network = self._network_int()
+        other_network = other._network_int()
+        if network != other_network:
+            return network < other_network
+        if self._prefixlen != other._prefixlen:
+            return self._prefixlen < other._prefixlen
         return False
 
     def __gt__(self, other):
@@ -591,10 +829,12 @@ class _BaseNet(_IPAddrBase):
         if not isinstance(other, _BaseNet):
             raise TypeError('%s and %s are not of the same type' % (
                     str(self), str(other)))
-        if self.network != other.network:
-            return self.network > other.network
-        if self.netmask != other.netmask:
-            return self.netmask > other.netmask
+        network = self._network_int()
+        other_network = other._network_int()
+        if network != other_network:
+            return network > other_network
+        if self._prefixlen != other._prefixlen:
+            return self._prefixlen > other._prefixlen
         return False
 
     def __le__(self, other):
@@ -612,8 +852,8 @@ class _BaseNet(_IPAddrBase):
     def __eq__(self, other):
         try:
             return (self._version == other._version
-                    and self.network == other.network
-                    and int(self.netmask) == int(other.netmask))
+                    and self._prefixlen == other._prefixlen
+                    and self._network_int() == int(other.network))
         except AttributeError:
             if isinstance(other, _BaseIP):
                 return (self._version == other._version
@@ -626,58 +866,65 @@ class _BaseNet(_IPAddrBase):
         return not eq
 
     def __str__(self):
-        return  '%s/%s' % (str(self.ip),
+        return  '%s/%s' % (self._string_from_ip_int(self._ip),
                            str(self._prefixlen))
 
     def __hash__(self):
-        return hash(int(self.network) ^ int(self.netmask))
+        return hash(self._network_int() ^
+                    self._ip_int_from_prefix(self._prefixlen))
+
+    def __reduce__(self):
+        return self.__class__, ((self._ip, self._prefixlen),)
 
     def __contains__(self, other):
         # always false if one is v4 and the other is v6.
         if self._version != other._version:
             return False
+        hostbits = self._max_prefixlen - self._prefixlen
         # dealing with another network.
         if isinstance(other, _BaseNet):
-            return (self.network <= other.network and
-                    self.broadcast >= other.broadcast)
+            return (self._prefixlen <= other._prefixlen and
+                    not (self._ip ^ other._ip) >> hostbits)
         # dealing with another address
         else:
-            return (int(self.network) <= int(other._ip) <=
-                    int(self.broadcast))
+            return not (self._ip ^ int(other._ip)) >> hostbits
 
     def overlaps(self, other):
         """Tell if self is partly contained in other."""
         return self.network in other or self.broadcast in other or (
             other.network in self or other.broadcast in self)
 
+    def _network_int(self):
+        return self._ip & self._ip_int_from_prefix(self._prefixlen)
+
+    def _broadcast_int(self):
+        return self._ip | (self._ALL_ONES >> self._prefixlen)
+
+    @property
+    def ip(self):
+        return IPAddress(self._ip, version=self._version)
+
+    @property
+    def netmask(self):
+        return IPAddress(self._ip_int_from_prefix(self._prefixlen),
+                         version=self._version)
+
     @property
     def network(self):
-        x = self._cache.get('network')
-        if x is None:
-            x = IPAddress(self._ip & int(self.netmask), version=self._version)
-            self._cache['network'] = x
-        return x
+        return IPAddress(self._network_int(), version=self._version)
 
     @property
     def broadcast(self):
-        x = self._cache.get('broadcast')
-        if x is None:
-            x = IPAddress(self._ip | int(self.hostmask), version=self._version)
-            self._cache['broadcast'] = x
-        return x
+        return IPAddress(self._broadcast_int(), version=self._version)
 
     @property
     def hostmask(self):
-        x = self._cache.get('hostmask')
-        if x is None:
-            x = IPAddress(int(self.netmask) ^ self._ALL_ONES,
-                          version=self._version)
-            self._cache['hostmask'] = x
-        return x
+        return IPAddress(self._ALL_ONES >> self._prefixlen,
+                         version=self._version)
 
     @property
     def with_prefixlen(self):
-        return '%s/%d' % (str(self.ip), self._prefixlen)
+        return '%s/%d' % (self._string_from_ip_int(self._ip), self._prefixlen)
 
     @property
     def with_netmask(self):
@@ -690,7 +937,7 @@ class _BaseNet(_IPAddrBase):
     @property
     def numhosts(self):
         """Number of hosts in the current subnet."""
-        return int(self.broadcast) - int(self.network) + 1
+        return (self._ALL_ONES >> self._prefixlen) + 1
 
     @property
     def version(self):
@@ -916,6 +1163,15 @@ class _BaseNet(_IPAddrBase):
             yield self
             return
 
+        for subnet in self.subnet_view(prefixlen_diff, new_prefix):
+            yield subnet
+
+    def _subnet_prefixlen(self, prefixlen_diff, new_prefix):
+        """Validate subnet arguments and return the new prefix length.
+
+        See iter_subnets() for the arguments and the errors raised.
+
+        """
         if new_prefix is not None:
             if new_prefix < self._prefixlen:
                 raise ValueError('new prefix must be longer')
@@ -931,22 +1187,44 @@ class _BaseNet(_IPAddrBase):
             raise ValueError(
                 'prefix length diff %d is invalid for netblock %s' % (
                     new_prefixlen, str(self)))
+        return new_prefixlen
 
-        first = IPNetwork('%s/%s' % (str(self.network),
-                                     str(self._prefixlen + prefixlen_diff)),
-                         version=self._version)
+    def subnet_view(self, prefixlen_diff=1, new_prefix=None):
+        """A lazy sequence of the subnets which join to make this network.
 
-        yield first
-        current = first
-        while True:
-            broadcast = current.broadcast
-            if broadcast == self.broadcast:
-                return
-            new_addr = IPAddress(int(broadcast) + 1, version=self._version)
-            current = IPNetwork('%s/%s' % (str(new_addr), str(new_prefixlen)),
-                                version=self._version)
+        Unlike subnet(), nothing is built up front: subnets are computed
+        from integers as they are indexed or iterated, so even splitting
+        a v6 /32 into /64s takes constant memory.  The view supports
+        len(), indexing, slicing, reversed(), 'in' and index().
+
+        Args:
+            prefixlen_diff, new_prefix: see iter_subnets().
 
-            yield current
+        Returns:
+            A SubnetView.
+
+        Raises:
+            ValueError: see iter_subnets().
+
+        """
+        if self._prefixlen == self._max_prefixlen:
+            new_prefixlen = self._max_prefixlen
+        else:
+            new_prefixlen = self._subnet_prefixlen(prefixlen_diff, new_prefix)
+        return SubnetView(self, new_prefixlen)
+
+    def host_view(self):
+        """A lazy sequence of the usable hosts of this network.
+
+        This holds the same addresses as iterhosts(), but supports
+        len(), indexing, slicing, reversed(), 'in' and index() without
+        generating the addresses in between.
+
+        Returns:
+            A HostView.
+
+        """
+        return HostView(self)
 
     def masked(self):
         """Return the network object with the host bits masked out."""
@@ -1014,17 +1292,21 @@ class _BaseV4(object):
 
     """
 
+    __slots__ = ()
+
     # Equivalent to 255.255.255.255 or 32 bits of 1's.
     _ALL_ONES = (2**IPV4LENGTH) - 1
     _DECIMAL_DIGITS = frozenset('0123456789')
-
-    def __init__(self, address):
-        self._version = 4
-        self._max_prefixlen = IPV4LENGTH
+    _version = 4
+    _max_prefixlen = IPV4LENGTH
+    # See enable_cache().
+    _parse_cache = None
+    _render_cache = None
 
     def _explode_shorthand_ip_string(self):
         return str(self)
 
+    @_cached('_parse_cache')
     def _ip_int_from_string(self, ip_str):
         """Turn the given IP string into an integer for comparison.
 
@@ -1073,6 +1355,7 @@ class _BaseV4(object):
             raise ValueError
         return octet_int
 
+    @_cached('_render_cache')
     def _string_from_ip_int(self, ip_int):
         """Turns a 32-bit integer into dotted decimal notation.
 
@@ -1172,6 +1455,8 @@ class IPv4Address(_BaseV4, _BaseIP):
 
     """Represent and manipulate single IPv4 Addresses."""
 
+    __slots__ = ()
+
     def __init__(self, address):
 
         """
@@ -1189,8 +1474,6 @@ class IPv4Address(_BaseV4, _BaseIP):
             AddressValueError: If ipaddr isn't a valid IPv4 address.
 
         """
-        _BaseV4.__init__(self, address)
-
         # Efficient constructor from integer.
         if isinstance(address, (int, long)):
             self._ip = address
@@ -1227,6 +1510,8 @@ class IPv4Network(_BaseV4, _BaseNet):
 
     """
 
+    __slots__ = ()
+
     # the valid octets for host and netmasks. only useful for IPv4.
     _valid_mask_octets = set((255, 254, 252, 248, 240, 224, 192, 128, 0))
 
@@ -1258,6 +1543,10 @@ class IPv4Network(_BaseV4, _BaseNet):
               IPv4Network(int(IPv4Network('192.168.1.1'))) ==
                 IPv4Network('192.168.1.1')
 
+              An (address, prefixlen) tuple is also accepted, where the
+              address is anything IPv4Address() accepts, so
+              IPv4Network((3232235776, 24)) == IPv4Network('192.168.1.0/24').
+
             strict: A boolean. If true, ensure that we have been passed
               A true network address, eg, 192.168.1.0/24 and not an
               IP address on a network, eg, 192.168.1.1/24.
@@ -1270,15 +1559,24 @@ class IPv4Network(_BaseV4, _BaseNet):
               supplied.
 
         """
-        _BaseNet.__init__(self, address)
-        _BaseV4.__init__(self, address)
+        # Constructing from an (address, prefixlen) tuple.
+        if isinstance(address, tuple):
+            if len(address) != 2:
+                raise AddressValueError(address)
+            self._ip = IPv4Address(address[0])._ip
+            self._prefixlen = address[1]
+            if (not isinstance(self._prefixlen, (int, long)) or
+                not 0 <= self._prefixlen <= self._max_prefixlen):
+                raise NetmaskValueError('%r is not a valid prefix length'
+                                        % (self._prefixlen,))
+            if strict and self._ip != self._network_int():
+                raise ValueError('%s has host bits set' % self.ip)
+            return
 
         # Constructing from an integer or packed bytes.
         if isinstance(address, (int, long, Bytes)):
-            self.ip = IPv4Address(address)
-            self._ip = self.ip._ip
+            self._ip = IPv4Address(address)._ip
             self._prefixlen = self._max_prefixlen
-            self.netmask = IPv4Address(self._ALL_ONES)
             return
 
         # Assume input argument to be string or any object representation
@@ -1289,40 +1587,32 @@ class IPv4Network(_BaseV4, _BaseNet):
             raise AddressValueError(address)
 
         self._ip = self._ip_int_from_string(addr[0])
-        self.ip = IPv4Address(self._ip)
 
         if len(addr) == 2:
             mask = addr[1].split('.')
             if len(mask) == 4:
                 # We have dotted decimal netmask.
                 if self._is_valid_netmask(addr[1]):
-                    self.netmask = IPv4Address(self._ip_int_from_string(
-                            addr[1]))
+                    netmask = self._ip_int_from_string(addr[1])
                 elif self._is_hostmask(addr[1]):
-                    self.netmask = IPv4Address(
-                        self._ip_int_from_string(addr[1]) ^ self._ALL_ONES)
+                    netmask = (self._ip_int_from_string(addr[1]) ^
+                               self._ALL_ONES)
                 else:
                     raise NetmaskValueError('%s is not a valid netmask'
                                                      % addr[1])
 
-                self._prefixlen = self._prefix_from_ip_int(int(self.netmask))
+                self._prefixlen = self._prefix_from_ip_int(netmask)
             else:
                 # We have a netmask in prefix length form.
                 if not self._is_valid_netmask(addr[1]):
                     raise NetmaskValueError(addr[1])
                 self._prefixlen = int(addr[1])
-                self.netmask = IPv4Address(self._ip_int_from_prefix(
-                    self._prefixlen))
         else:
             self._prefixlen = self._max_prefixlen
-            self.netmask = IPv4Address(self._ip_int_from_prefix(
-                self._prefixlen))
         if strict:
-            if self.ip != self.network:
+            if self._ip != self._network_int():
                 raise ValueError('%s has host bits set' %
                                  self.ip)
-        if self._prefixlen == (self._max_prefixlen - 1):
-            self.iterhosts = self.__iter__
 
     def _is_hostmask(self, ip_str):
         """Test if the IP string is a hostmask (rather than a netmask).
@@ -1387,14 +1677,18 @@ class _BaseV6(object):
 
     """
 
+    __slots__ = ()
+
     _ALL_ONES = (2**IPV6LENGTH) - 1
     _HEXTET_COUNT = 8
     _HEX_DIGITS = frozenset('0123456789ABCDEFabcdef')
+    _version = 6
+    _max_prefixlen = IPV6LENGTH
+    # See enable_cache().
+    _parse_cache = None
+    _render_cache = None
 
-    def __init__(self, address):
-        self._version = 6
-        self._max_prefixlen = IPV6LENGTH
-
+    @_cached('_parse_cache')
     def _ip_int_from_string(self, ip_str):
         """Turn an IPv6 ip_str into an integer.
 
@@ -1542,6 +1836,7 @@ class _BaseV6(object):
 
         return hextets
 
+    @_cached('_render_cache')
     def _string_from_ip_int(self, ip_int=None):
         """Turns a 128-bit integer into hexadecimal notation.
 
@@ -1579,12 +1874,7 @@ class _BaseV6(object):
             A string, the expanded IPv6 address.
 
         """
-        if isinstance(self, _BaseNet):
-            ip_str = str(self.ip)
-        else:
-            ip_str = str(self)
-
-        ip_int = self._ip_int_from_string(ip_str)
+        ip_int = self._ip
         parts = []
         for i in xrange(self._HEXTET_COUNT):  # @UnusedVariable
             parts.append('%04x' % (ip_int & 0xFFFF))
@@ -1746,6 +2036,8 @@ class IPv6Address(_BaseV6, _BaseIP):
     """Represent and manipulate single IPv6 Addresses.
     """
 
+    __slots__ = ()
+
     def __init__(self, address):
         """Instantiate a new IPv6 address object.
 
@@ -1763,8 +2055,6 @@ class IPv6Address(_BaseV6, _BaseIP):
             AddressValueError: If address isn't a valid IPv6 address.
 
         """
-        _BaseV6.__init__(self, address)
-
         # Efficient constructor from integer.
         if isinstance(address, (int, long)):
             self._ip = address
@@ -1804,6 +2094,7 @@ class IPv6Network(_BaseV6, _BaseNet):
 
     """
 
+    __slots__ = ()
 
     def __init__(self, address, strict=False):
         """Instantiate a new IPv6 Network object.
@@ -1825,6 +2116,10 @@ class IPv6Network(_BaseV6, _BaseNet):
               IPv6Network(IPv6Network('2001:4860::')._ip) ==
                 IPv6Network('2001:4860::')
 
+              An (address, prefixlen) tuple is also accepted, where the
+              address is anything IPv6Address() accepts, so
+              IPv6Network(('2001:4860::', 32)) == IPv6Network('2001:4860::/32').
+
             strict: A boolean. If true, ensure that we have been passed
               A true network address, eg, 192.168.1.0/24 and not an
               IP address on a network, eg, 192.168.1.1/24.
@@ -1837,15 +2132,24 @@ class IPv6Network(_BaseV6, _BaseNet):
               supplied.
 
         """
-        _BaseNet.__init__(self, address)
-        _BaseV6.__init__(self, address)
+        # Constructing from an (address, prefixlen) tuple.
+        if isinstance(address, tuple):
+            if len(address) != 2:
+                raise AddressValueError(address)
+            self._ip = IPv6Address(address[0])._ip
+            self._prefixlen = address[1]
+            if (not isinstance(self._prefixlen, (int, long)) or
+                not 0 <= self._prefixlen <= self._max_prefixlen):
+                raise NetmaskValueError('%r is not a valid prefix length'
+                                        % (self._prefixlen,))
+            if strict and self._ip != self._network_int():
+                raise ValueError('%s has host bits set' % self.ip)
+            return
 
         # Constructing from an integer or packed bytes.
         if isinstance(address, (int, long, Bytes)):
-            self.ip = IPv6Address(address)
-            self._ip = self.ip._ip
+            self._ip = IPv6Address(address)._ip
             self._prefixlen = self._max_prefixlen
-            self.netmask = IPv6Address(self._ALL_ONES)
             return
 
         # Assume input argument to be string or any object representation
@@ -1856,7 +2160,6 @@ class IPv6Network(_BaseV6, _BaseNet):
             raise AddressValueError(address)
 
         self._ip = self._ip_int_from_string(addr[0])
-        self.ip = IPv6Address(self._ip)
 
         if len(addr) == 2:
             if self._is_valid_netmask(addr[1]):
@@ -1866,14 +2169,10 @@ class IPv6Network(_BaseV6, _BaseNet):
         else:
             self._prefixlen = self._max_prefixlen
 
-        self.netmask = IPv6Address(self._ip_int_from_prefix(self._prefixlen))
-
         if strict:
-            if self.ip != self.network:
+            if self._ip != self._network_int():
                 raise ValueError('%s has host bits set' %
                                  self.ip)
-        if self._prefixlen == (self._max_prefixlen - 1):
-            self.iterhosts = self.__iter__
 
     def _is_valid_netmask(self, prefixlen):
         """Verify that the netmask/prefixlen is valid.
@@ -1895,3 +2194,949 @@ class IPv6Network(_BaseV6, _BaseNet):
     @property
     def with_netmask(self):
         return self.with_prefixlen
+
+
+def _slice_range(index, length):
+    """Resolve a slice against a sequence length.
+
+    This works like slice.indices() but with arbitrarily large lengths,
+    which IPv6 address ranges easily exceed.
+
+    Returns:
+        A (start, step, count) tuple of integers.
+
+    """
+    step = index.step
+    if step is None:
+        step = 1
+    if step == 0:
+        raise ValueError('slice step cannot be zero')
+    if step > 0:
+        lower, upper = 0, length
+    else:
+        lower, upper = -1, length - 1
+
+    def clamp(value, default):
+        if value is None:
+            return default
+        if value < 0:
+            value += length
+        return max(lower, min(upper, value))
+
+    if step > 0:
+        start = clamp(index.start, lower)
+        stop = clamp(index.stop, upper)
+        count = max(0, (stop - start + step - 1) // step)
+    else:
+        start = clamp(index.start, upper)
+        stop = clamp(index.stop, lower)
+        count = max(0, (start - stop - step - 1) // -step)
+    return start, step, count
+
+
+class _IntegerRangeView(object):
+
+    """A lazy arithmetic sequence of IP objects.
+
+    Item i of the view is built from the integer first + i * step, so
+    the view costs the same memory however many items it spans.
+    Subclasses define _make(value), which builds the item for an
+    integer, and _position(item), which returns the position of an item
+    or None if it is not in the view.
+
+    """
+
+    __slots__ = ('_version', '_first', '_step', '_count')
+
+    def __init__(self, version, first, step, count):
+        self._version = version
+        self._first = first
+        self._step = step
+        self._count = count
+
+    def _locate(self, value):
+        offset = value - self._first
+        if offset % self._step:
+            return None
+        position = offset // self._step
+        if 0 <= position < self._count:
+            return position
+        return None
+
+    def _sliced(self, first, step, count):
+        view = self.__class__.__new__(self.__class__)
+        _IntegerRangeView.__init__(view, self._version, first, step, count)
+        return view
+
+    @property
+    def count(self):
+        """The number of items, usable where it exceeds sys.maxsize."""
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return self._count > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, step, count = _slice_range(index, self._count)
+            return self._sliced(self._first + start * self._step,
+                                self._step * step, count)
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('index out of range')
+        return self._make(self._first + index * self._step)
+
+    def __iter__(self):
+        # xrange() can not count past sys.maxsize, which IPv6 views do.
+        value = self._first
+        remaining = self._count
+        while remaining:
+            yield self._make(value)
+            value += self._step
+            remaining -= 1
+
+    def __reversed__(self):
+        return iter(self[::-1])
+
+    def __contains__(self, item):
+        return self._position(item) is not None
+
+    def index(self, item):
+        position = self._position(item)
+        if position is None:
+            raise ValueError('%s is not in %r' % (item, self))
+        return position
+
+
+class SubnetView(_IntegerRangeView):
+
+    """A lazy sequence of equally sized subnets of a network.
+
+    Use _BaseNet.subnet_view() to create one.
+
+    """
+
+    __slots__ = ('_prefixlen',)
+
+    def __init__(self, network, prefixlen):
+        hostbits = network._max_prefixlen - prefixlen
+        _IntegerRangeView.__init__(
+            self, network._version, network._network_int(), 1 << hostbits,
+            1 << (prefixlen - network._prefixlen))
+        self._prefixlen = prefixlen
+
+    def _sliced(self, first, step, count):
+        view = _IntegerRangeView._sliced(self, first, step, count)
+        view._prefixlen = self._prefixlen
+        return view
+
+    def _make(self, value):
+        if self._version == 4:
+            return IPv4Network((value, self._prefixlen))
+        return IPv6Network((value, self._prefixlen))
+
+    def _position(self, item):
+        if (not isinstance(item, _BaseNet) or
+            item._version != self._version or
+            item._prefixlen != self._prefixlen):
+            return None
+        return self._locate(item._network_int())
+
+    def __repr__(self):
+        return '%s(first=%s/%d, step=%d, count=%d)' % (
+            self.__class__.__name__,
+            IPAddress(self._first, version=self._version), self._prefixlen,
+            self._step, self._count)
+
+
+class HostView(_IntegerRangeView):
+
+    """A lazy sequence of the usable host addresses of a network.
+
+    Use _BaseNet.host_view() to create one.
+
+    """
+
+    __slots__ = ()
+
+    def __init__(self, network):
+        first = network._network_int()
+        last = network._broadcast_int()
+        # A /31 (or /127) has no network or broadcast address to skip.
+        if network._prefixlen != network._max_prefixlen - 1:
+            first += 1
+            last -= 1
+        _IntegerRangeView.__init__(self, network._version, first, 1,
+                                   max(0, last - first + 1))
+
+    def _make(self, value):
+        return IPAddress(value, version=self._version)
+
+    def _position(self, item):
+        if not isinstance(item, _BaseIP) or item._version != self._version:
+            return None
+        return self._locate(item._ip)
+
+    def __repr__(self):
+        return '%s(first=%s, step=%d, count=%d)' % (
+            self.__class__.__name__,
+            IPAddress(self._first, version=self._version), self._step,
+            self._count)
+
+
+class _TrieNode(object):
+
+    """A single node of a PrefixTrie.
+
+    Nodes either carry a value (they were explicitly inserted) or are
+    glue nodes created where two stored prefixes diverge.
+
+    """
+
+    __slots__ = ('net', 'prefixlen', 'network', 'value', 'has_value',
+                 'children')
+
+    def __init__(self, net, prefixlen, network=None, value=None,
+                 has_value=False):
+        self.net = net
+        self.prefixlen = prefixlen
+        self.network = network
+        self.value = value
+        self.has_value = has_value
+        self.children = [None, None]
+
+
+class PrefixTrie(object):
+
+    """A path-compressed binary (Patricia) trie of IP networks.
+
+    Maps IPv4Network/IPv6Network keys to arbitrary values and answers
+    longest-prefix-match, covering-prefix and covered-subnet queries in
+    time proportional to the prefix length instead of the number of
+    stored networks.
+
+    Example:
+        >>> trie = PrefixTrie()
+        >>> trie[IPv4Network('10.0.0.0/8')] = 'corp'
+        >>> trie[IPv4Network('10.1.0.0/16')] = 'lab'
+        >>> trie.lookup(IPv4Address('10.1.2.3'))
+        'lab'
+        >>> trie.longest_match(167772161)
+        (IPv4Network('10.0.0.0/8'), 'corp')
+
+    Lookup keys may be IPv4Address/IPv6Address or IPv4Network/IPv6Network
+    objects, integers, packed bytes (4 or 16 bytes) or strings.  Integers
+    follow the same rule as IPAddress(): values below 2**32 are treated
+    as IPv4 unless a version is given.
+
+    """
+
+    def __init__(self, items=None):
+        """Create a new trie.
+
+        Args:
+            items: An optional iterable of (network, value) pairs or a
+              mapping of networks to values.
+
+        """
+        self._roots = {4: _TrieNode(0, 0), 6: _TrieNode(0, 0)}
+        self._width = {4: IPV4LENGTH, 6: IPV6LENGTH}
+        self._size = 0
+        if items is not None:
+            if hasattr(items, 'items'):
+                items = items.items()
+            for network, value in items:
+                self[network] = value
+
+    def _address_key(self, key, version=None):
+        """Turn a lookup key into a (version, integer, prefixlen) tuple.
+
+        Raises:
+            ValueError: If the key can not be interpreted as an address
+              or network.
+
+        """
+        if isinstance(key, (int, long)):
+            if version is None:
+                if 0 <= key <= _BaseV4._ALL_ONES:
+                    version = 4
+                else:
+                    version = 6
+            width = self._width.get(version)
+            if width is None:
+                raise ValueError('unknown IP version %r' % version)
+            if key < 0 or key >> width:
+                raise AddressValueError(key)
+            return version, key, width
+        if isinstance(key, _BaseIP):
+            return key._version, key._ip, key._max_prefixlen
+        if isinstance(key, _BaseNet):
+            width = key._max_prefixlen
+            prefixlen = key._prefixlen
+            net = (key._ip >> (width - prefixlen)) << (width - prefixlen)
+            return key._version, net, prefixlen
+        if isinstance(key, Bytes):
+            if len(key) == 4:
+                return 4, struct.unpack('!I', key)[0], IPV4LENGTH
+            if len(key) == 16:
+                hi, lo = struct.unpack('!QQ', key)
+                return 6, (hi << 64) | lo, IPV6LENGTH
+            raise AddressValueError(key)
+        return self._address_key(IPNetwork(key, version=version))
+
+    def _network_key(self, network):
+        """Return the network object and trie key used for insertion."""
+        if not isinstance(network, _BaseNet):
+            network = IPNetwork(network)
+        return network, self._address_key(network)
+
+    def _find(self, version, net, prefixlen):
+        """Return the node stored exactly at net/prefixlen, or None."""
+        width = self._width[version]
+        node = self._roots[version]
+        while node is not None:
+            if node.prefixlen >= prefixlen:
+                if node.prefixlen == prefixlen and node.net == net:
+                    return node
+                return None
+            if (net ^ node.net) >> (width - node.prefixlen):
+                return None
+            node = node.children[(net >> (width - node.prefixlen - 1)) & 1]
+        return None
+
+    def __setitem__(self, network, value):
+        network, (version, net, prefixlen) = self._network_key(network)
+        width = self._width[version]
+        node = self._roots[version]
+        while True:
+            if node.prefixlen == prefixlen:
+                if not node.has_value:
+                    self._size += 1
+                node.network = network
+                node.value = value
+                node.has_value = True
+                return
+            bit = (net >> (width - node.prefixlen - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _TrieNode(net, prefixlen, network, value,
+                                               True)
+                self._size += 1
+                return
+            common = width - (net ^ child.net).bit_length()
+            common = min(common, prefixlen, child.prefixlen)
+            if common == child.prefixlen:
+                node = child
+                continue
+            if common == prefixlen:
+                new = _TrieNode(net, prefixlen, network, value, True)
+            else:
+                glue_net = (net >> (width - common)) << (width - common)
+                new = _TrieNode(glue_net, common)
+                new.children[(net >> (width - common - 1)) & 1] = (
+                    _TrieNode(net, prefixlen, network, value, True))
+            new.children[(child.net >> (width - common - 1)) & 1] = child
+            node.children[bit] = new
+            self._size += 1
+            return
+
+    def __getitem__(self, network):
+        node = self._find(*self._network_key(network)[1])
+        if node is None or not node.has_value:
+            raise KeyError(network)
+        return node.value
+
+    def __delitem__(self, network):
+        version, net, prefixlen = self._network_key(network)[1]
+        width = self._width[version]
+        parent = None
+        node = self._roots[version]
+        while node is not None and node.prefixlen < prefixlen:
+            if (net ^ node.net) >> (width - node.prefixlen):
+                node = None
+                break
+            parent = node
+            node = node.children[(net >> (width - node.prefixlen - 1)) & 1]
+        if (node is None or node.prefixlen != prefixlen or node.net != net or
+            not node.has_value):
+            raise KeyError(network)
+        node.network = None
+        node.value = None
+        node.has_value = False
+        self._size -= 1
+        # Splice out nodes that no longer carry a value or a fork.
+        if parent is not None:
+            children = [c for c in node.children if c is not None]
+            if len(children) < 2:
+                slot = parent.children.index(node)
+                parent.children[slot] = children and children[0] or None
+
+    def __contains__(self, network):
+        try:
+            node = self._find(*self._network_key(network)[1])
+        except ValueError:
+            return False
+        return node is not None and node.has_value
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for network, _ in self.iteritems():
+            yield network
+
+    def _walk(self, node):
+        """Yield the value-carrying nodes below node in address order."""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.has_value:
+                yield node
+            if node.children[1] is not None:
+                stack.append(node.children[1])
+            if node.children[0] is not None:
+                stack.append(node.children[0])
+
+    def iteritems(self):
+        """Iterate over (network, value) pairs, IPv4 first, in order."""
+        for version in (4, 6):
+            for node in self._walk(self._roots[version]):
+                yield node.network, node.value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [value for _, value in self.iteritems()]
+
+    def get(self, network, default=None):
+        try:
+            return self[network]
+        except KeyError:
+            return default
+
+    def _match(self, key, version):
+        """Return the value-carrying nodes covering key, shortest first."""
+        version, ip, prefixlen = self._address_key(key, version)
+        width = self._width[version]
+        node = self._roots[version]
+        matches = []
+        while node is not None and node.prefixlen <= prefixlen:
+            if (ip ^ node.net) >> (width - node.prefixlen):
+                break
+            if node.has_value:
+                matches.append(node)
+            if node.prefixlen == width:
+                break
+            node = node.children[(ip >> (width - node.prefixlen - 1)) & 1]
+        return matches
+
+    def longest_match(self, key, version=None):
+        """Find the most specific stored network containing key.
+
+        Args:
+            key: An address, network, integer, packed bytes or string.
+            version: An Integer, 4 or 6, used to interpret integer keys.
+
+        Returns:
+            A (network, value) tuple, or None if nothing matches.
+
+        """
+        version, ip, prefixlen = self._address_key(key, version)
+        width = self._width[version]
+        node = self._roots[version]
+        best = None
+        while node is not None and node.prefixlen <= prefixlen:
+            if (ip ^ node.net) >> (width - node.prefixlen):
+                break
+            if node.has_value:
+                best = node
+            if node.prefixlen == width:
+                break
+            node = node.children[(ip >> (width - node.prefixlen - 1)) & 1]
+        if best is None:
+            return None
+        return best.network, best.value
+
+    def lookup(self, key, default=None, version=None):
+        """Return the value of the longest matching network for key.
+
+        This is the hot path for classifying addresses; it avoids
+        building any address objects when given integers or packed bytes.
+
+        """
+        match = self.longest_match(key, version)
+        if match is None:
+            return default
+        return match[1]
+
+    def covering(self, key, version=None):
+        """Find all stored networks containing key.
+
+        Returns:
+            A list of (network, value) tuples, least specific first.
+
+        """
+        return [(node.network, node.value)
+                for node in self._match(key, version)]
+
+    def covered(self, key, version=None):
+        """Find all stored networks contained in key.
+
+        Args:
+            key: A network (or anything accepted by IPNetwork()).
+            version: An Integer, 4 or 6, used to interpret integer keys.
+
+        Returns:
+            A list of (network, value) tuples in address order.
+
+        """
+        version, net, prefixlen = self._address_key(key, version)
+        width = self._width[version]
+        node = self._roots[version]
+        while node is not None and node.prefixlen < prefixlen:
+            if (net ^ node.net) >> (width - node.prefixlen):
+                return []
+            node = node.children[(net >> (width - node.prefixlen - 1)) & 1]
+        if node is None or (net ^ node.net) >> (width - prefixlen):
+            return []
+        return [(n.network, n.value) for n in self._walk(node)]
+
+
+class IPSet(object):
+
+    """An immutable set of IP addresses stored as sorted integer ranges.
+
+    The set is kept, per IP version, as a flat sorted list of range
+    boundaries [start, stop, start, stop, ...] (stop is exclusive), so
+    membership is a bisect and the set operations are a single merge of
+    the two boundary lists.
+
+    Example:
+        >>> allow = IPSet([IPv4Network('10.0.0.0/8')])
+        >>> deny = IPSet([IPv4Network('10.1.0.0/16'), '10.2.3.4'])
+        >>> IPv4Address('10.1.2.3') in allow - deny
+        False
+        >>> list(IPSet(['10.0.0.0/24', '10.0.1.0/24']))
+        [IPv4Network('10.0.0.0/23')]
+
+    """
+
+    __slots__ = ('_bounds',)
+
+    def __init__(self, iterable=None):
+        """Create a new IPSet.
+
+        Args:
+            iterable: An optional iterable of IPv4/IPv6 networks, addresses
+              or strings accepted by IPNetwork().  IPv4 and IPv6 entries
+              may be mixed.
+
+        """
+        ranges = {4: [], 6: []}
+        if iterable is not None:
+            for item in iterable:
+                if isinstance(item, _BaseNet):
+                    hostbits = item._max_prefixlen - item._prefixlen
+                    start = (item._ip >> hostbits) << hostbits
+                    ranges[item._version].append(
+                        (start, start + (1 << hostbits)))
+                    continue
+                if not isinstance(item, _BaseIP):
+                    item = IPNetwork(item)
+                    ranges[item._version].append(
+                        (item._network_int(), item._broadcast_int() + 1))
+                    continue
+                ranges[item._version].append((item._ip, item._ip + 1))
+        self._bounds = {}
+        for version in (4, 6):
+            self._bounds[version] = self._container(
+                version, self._merge_ranges(ranges[version]))
+
+    @staticmethod
+    def _merge_ranges(ranges):
+        """Sort (start, stop) ranges and merge them into boundaries."""
+        ranges.sort()
+        bounds = []
+        for start, stop in ranges:
+            if bounds and start <= bounds[-1]:
+                if stop > bounds[-1]:
+                    bounds[-1] = stop
+            else:
+                bounds.append(start)
+                bounds.append(stop)
+        return bounds
+
+    @staticmethod
+    def _container(version, bounds):
+        """Store IPv4 boundaries in an array when it can hold 2**32."""
+        if version == 4 and array.array('L').itemsize >= 8:
+            return array.array('L', bounds)
+        return list(bounds)
+
+    @classmethod
+    def _from_ranges(cls, ranges):
+        """Build an IPSet from a {version: [(start, stop), ...]} dict."""
+        bounds = {}
+        for version in (4, 6):
+            bounds[version] = cls._merge_ranges(ranges[version])
+        return cls._from_bounds(bounds)
+
+    @classmethod
+    def _from_bounds(cls, bounds):
+        ipset = cls.__new__(cls)
+        ipset._bounds = {}
+        for version in (4, 6):
+            ipset._bounds[version] = cls._container(version, bounds[version])
+        return ipset
+
+    def _combine(self, other, keep):
+        """Merge the boundaries of self and other.
+
+        Args:
+            other: Another IPSet.
+            keep: A function taking (in_self, in_other) booleans and
+              returning whether addresses in that state are in the result.
+
+        Returns:
+            A new IPSet.
+
+        """
+        if not isinstance(other, IPSet):
+            other = IPSet(other)
+        result = {}
+        for version in (4, 6):
+            a = self._bounds[version]
+            b = other._bounds[version]
+            len_a, len_b = len(a), len(b)
+            i = j = 0
+            in_a = in_b = inside = False
+            bounds = []
+            while i < len_a or j < len_b:
+                if j >= len_b or (i < len_a and a[i] <= b[j]):
+                    point = a[i]
+                else:
+                    point = b[j]
+                if i < len_a and a[i] == point:
+                    in_a = not in_a
+                    i += 1
+                if j < len_b and b[j] == point:
+                    in_b = not in_b
+                    j += 1
+                if keep(in_a, in_b) != inside:
+                    inside = not inside
+                    bounds.append(point)
+            result[version] = bounds
+        return self._from_bounds(result)
+
+    def union(self, other):
+        return self._combine(other, lambda a, b: a or b)
+
+    def intersection(self, other):
+        return self._combine(other, lambda a, b: a and b)
+
+    def difference(self, other):
+        return self._combine(other, lambda a, b: a and not b)
+
+    def symmetric_difference(self, other):
+        return self._combine(other, lambda a, b: a != b)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+    __xor__ = symmetric_difference
+
+    def issubset(self, other):
+        return not self.difference(other)
+
+    def issuperset(self, other):
+        if not isinstance(other, IPSet):
+            other = IPSet(other)
+        return other.issubset(self)
+
+    def isdisjoint(self, other):
+        return not self.intersection(other)
+
+    __le__ = issubset
+    __ge__ = issuperset
+
+    def __eq__(self, other):
+        if not isinstance(other, IPSet):
+            return NotImplemented
+        return self._bounds == other._bounds
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return NotImplemented
+        return not eq
+
+    __hash__ = None
+
+    def __contains__(self, item):
+        if isinstance(item, _BaseNet):
+            first = item._network_int()
+            last = item._broadcast_int()
+        elif isinstance(item, _BaseIP):
+            first = last = item._ip
+        else:
+            item = IPNetwork(item)
+            return item in self
+        bounds = self._bounds[item._version]
+        index = bisect.bisect_right(bounds, first)
+        return index % 2 == 1 and last < bounds[index]
+
+    def __nonzero__(self):
+        return bool(self._bounds[4] or self._bounds[6])
+
+    @property
+    def size(self):
+        """The number of addresses in the set."""
+        total = 0
+        for version in (4, 6):
+            bounds = self._bounds[version]
+            for i in xrange(0, len(bounds), 2):
+                total += bounds[i + 1] - bounds[i]
+        return total
+
+    def iter_ranges(self):
+        """Iterate over (first, last) address pairs, IPv4 first."""
+        for version in (4, 6):
+            bounds = self._bounds[version]
+            for i in xrange(0, len(bounds), 2):
+                yield (IPAddress(bounds[i], version=version),
+                       IPAddress(bounds[i + 1] - 1, version=version))
+
+    def __iter__(self):
+        """Iterate over the minimal list of CIDR networks in the set."""
+        for version, bits, network in ((4, IPV4LENGTH, IPv4Network),
+                                       (6, IPV6LENGTH, IPv6Network)):
+            bounds = self._bounds[version]
+            for i in xrange(0, len(bounds), 2):
+                for net, prefixlen in _summarize_int_range(
+                        bounds[i], bounds[i + 1] - 1, bits):
+                    yield network((net, prefixlen))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, [str(n) for n in self])
+
+
+# Layout of the cache written by load_cidr_file(): a header followed by
+# the IPv4 boundaries as little endian uint64s and the IPv6 boundaries as
+# pairs of little endian uint64s (high, low).  The IPv6 stop boundaries
+# are stored as the last address of each range, since the exclusive stop
+# of a range ending at ffff:...:ffff is 2**128 and does not fit.  Bump
+# _CIDR_CACHE_VERSION whenever the layout changes.
+_CIDR_CACHE_MAGIC = 'IPSETCCH'
+_CIDR_CACHE_VERSION = 2
+_CIDR_CACHE_HEADER = struct.Struct('<8sIQdQQ32s')
+
+
+def _parse_cidr_line(line):
+    """Turn one feed line into (version, start, stop), stop exclusive.
+
+    The common 'address/prefixlen' and bare address forms are decoded
+    with inet_pton; anything else goes through IPNetwork().
+
+    """
+    addr, _, prefixlen = line.partition('/')
+    try:
+        if ':' in addr:
+            version, bits = 6, IPV6LENGTH
+            hi, lo = struct.unpack('!QQ', _pack_v6(addr))
+            ip_int = (hi << 64) | lo
+        else:
+            version, bits = 4, IPV4LENGTH
+            ip_int, = struct.unpack('!I', _pack_v4(addr))
+        if prefixlen:
+            if not prefixlen.isdigit():
+                raise ValueError
+            prefixlen = int(prefixlen)
+            if prefixlen > bits:
+                raise ValueError
+        else:
+            prefixlen = bits
+    except (socket.error, ValueError, TypeError, UnicodeError):
+        network = IPNetwork(line)
+        return (network._version, network._network_int(),
+                network._broadcast_int() + 1)
+    hostbits = bits - prefixlen
+    start = (ip_int >> hostbits) << hostbits
+    return version, start, start + (1 << hostbits)
+
+
+def _read_cidr_cache(cache_path, stat, digest):
+    """Load an IPSet from a cache file if it matches the source.
+
+    Args:
+        cache_path: The path of the cache file.
+        stat: The os.stat() result of the source file.
+        digest: The sha256 digest the source must have, or None to trust
+          its size and modification time.
+
+    Returns:
+        An IPSet, or None if the cache is missing, stale or unreadable.
+
+    """
+    try:
+        cache_file = open(cache_path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            cache_map = mmap.mmap(cache_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            return None
+        try:
+            if len(cache_map) < _CIDR_CACHE_HEADER.size:
+                return None
+            (magic, version, size, mtime, count4, count6,
+             cached_digest) = _CIDR_CACHE_HEADER.unpack_from(cache_map)
+            if (magic != _CIDR_CACHE_MAGIC or
+                version != _CIDR_CACHE_VERSION or
+                size != stat.st_size or mtime != stat.st_mtime or
+                (digest is not None and digest != cached_digest)):
+                return None
+            offset = _CIDR_CACHE_HEADER.size
+            if len(cache_map) != offset + 8 * count4 + 16 * count6:
+                return None
+
+            bounds4 = array.array('L')
+            if bounds4.itemsize == 8:
+                bounds4.fromstring(cache_map[offset:offset + 8 * count4])
+                if sys.byteorder == 'big':
+                    bounds4.byteswap()
+            else:
+                bounds4 = list(struct.unpack_from('<%dQ' % count4, cache_map,
+                                                  offset))
+            offset += 8 * count4
+
+            halves = struct.unpack_from('<%dQ' % (2 * count6), cache_map,
+                                        offset)
+            # Every second boundary is the inclusive last address of a
+            # range, turn it back into the exclusive stop.
+            bounds6 = [((halves[i] << 64) | halves[i + 1]) + (i >> 1 & 1)
+                       for i in xrange(0, len(halves), 2)]
+            return IPSet._from_bounds({4: bounds4, 6: bounds6})
+        finally:
+            cache_map.close()
+    finally:
+        cache_file.close()
+
+
+def _write_cidr_cache(cache_path, ipset, stat, digest):
+    """Atomically write the cache file for an IPSet, if possible."""
+    bounds4 = ipset._bounds[4]
+    bounds6 = ipset._bounds[6]
+    halves = []
+    for i, bound in enumerate(bounds6):
+        # Stop boundaries are stored inclusive, see _CIDR_CACHE_VERSION.
+        bound -= i & 1
+        halves.append(bound >> 64)
+        halves.append(bound & 0xFFFFFFFFFFFFFFFF)
+    try:
+        chunks = [_CIDR_CACHE_HEADER.pack(
+            _CIDR_CACHE_MAGIC, _CIDR_CACHE_VERSION, stat.st_size,
+            stat.st_mtime, len(bounds4), len(bounds6), digest)]
+        chunks.append(struct.pack('<%dQ' % len(bounds4), *bounds4))
+        chunks.append(struct.pack('<%dQ' % len(halves), *halves))
+    except struct.error:
+        # Nothing the layout can hold, carry on without a cache.
+        return False
+
+    directory = os.path.dirname(os.path.abspath(cache_path))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.ipset')
+    except (IOError, OSError):
+        # Read only location, carry on without a cache.
+        return False
+    try:
+        cache_file = os.fdopen(fd, 'wb')
+        try:
+            cache_file.write(''.join(chunks))
+        finally:
+            cache_file.close()
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def load_cidr_file(path, use_cache=True, cache_path=None, verify=False):
+    """Load a feed of networks, one per line, into an IPSet.
+
+    Blank lines and anything following a '#' are ignored.  IPv4 and IPv6
+    networks may be mixed.
+
+    Parsing large feeds takes a while, so the result is saved to a binary
+    cache next to the feed (path + '.ipset' by default).  Later loads
+    memory map the cache instead of parsing, as long as the feed's size
+    and modification time (and, with verify, its sha256) match what the
+    cache recorded.  If the cache can not be written the feed is still
+    loaded.
+
+    Args:
+        path: The path of the feed.
+        use_cache: A boolean, whether to read and write the cache.
+        cache_path: Where to keep the cache, instead of path + '.ipset'.
+        verify: A boolean. If true, also hash the feed and only use the
+          cache if the digest matches.
+
+    Returns:
+        An IPSet.
+
+    Raises:
+        IOError: If the feed can not be read.
+        ValueError: If a line does not hold a valid address or network.
+
+    """
+    if cache_path is None:
+        cache_path = path + '.ipset'
+
+    feed = open(path, 'rb')
+    try:
+        stat = os.fstat(feed.fileno())
+        if use_cache:
+            digest = None
+            if verify:
+                hasher = hashlib.sha256()
+                for block in iter(lambda: feed.read(65536), ''):
+                    hasher.update(block)
+                digest = hasher.digest()
+                feed.seek(0)
+            ipset = _read_cidr_cache(cache_path, stat, digest)
+            if ipset is not None:
+                return ipset
+        data = feed.read()
+    finally:
+        feed.close()
+
+    ranges = {4: [], 6: []}
+    for number, line in enumerate(data.splitlines()):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        try:
+            version, start, stop = _parse_cidr_line(line)
+        except ValueError:
+            raise ValueError('%s:%d: %r is not a valid network' % (
+                path, number + 1, line))
+        ranges[version].append((start, stop))
+    ipset = IPSet._from_ranges(ranges)
+
+    if use_cache:
+        _write_cidr_cache(cache_path, ipset, stat,
+                          hashlib.sha256(data).digest())
+    return ipset
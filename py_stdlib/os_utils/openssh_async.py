@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio counterpart of openssh_wrapper.
+
+One event loop can drive thousands of concurrent ssh sessions, each one an
+asyncio subprocess rather than a thread. Results are the same SSHResult and
+SCPFileResult objects SSHConnection returns.
+
+Example::
+
+    async def main():
+        results = await run_many(['web1', 'web2'], 'uptime', concurrency=200)
+
+This module needs python 3.5 or later, so it is not imported by os_utils.
+"""
+import asyncio
+import shutil
+
+try:
+    from .openssh_wrapper import (SSHConnection, SSHResult, SSHError, SSHTimeoutError,
+                                  b, _check_file_results, _native)
+except (ImportError, SystemError, ValueError):  # imported as a top-level module
+    from openssh_wrapper import (SSHConnection, SSHResult, SSHError, SSHTimeoutError,
+                                 b, _check_file_results, _native)
+
+__all__ = 'AsyncSSHConnection run_many'.split()
+
+
+class AsyncSSHConnection(SSHConnection):
+    """
+    SSHConnection whose run, scp, post_process and get_scp_targets methods
+    are coroutines.
+
+    The constructor takes the same arguments as SSHConnection, plus an
+    optional asyncio.Semaphore shared by every connection that should count
+    against the same concurrency limit.
+
+    .. note:: with ``persist`` the master connection is started by a
+              blocking call the first time it is needed.
+    """
+
+    def __init__(self, server, semaphore=None, **kwargs):
+        SSHConnection.__init__(self, server, **kwargs)
+        self.semaphore = semaphore
+
+    async def run(self, command, interpreter='/bin/bash', forward_ssh_agent=False):
+        """
+        Execute the command using the interpreter provided, see
+        :meth:`SSHConnection.run`
+
+        :return: SSH result instance
+        :rtype: SSHResult
+
+        :raise: SSHError, if server is unreachable, or timeout has reached.
+        """
+        ssh_command = self.ssh_command(interpreter, forward_ssh_agent)
+        out, err, returncode = await self._execute(ssh_command, b(command))
+        if returncode == 255:  # ssh client error
+            raise SSHError("%s (under %s): %s" % (
+                _join(ssh_command), self.user, _native(err.strip())))
+        return SSHResult(command, out.strip(), err.strip(), returncode)
+
+    async def scp(self, files, target, mode=None, owner=None, checksum=None):
+        """
+        Copy files identified by their names to remote location, see
+        :meth:`SSHConnection.scp`
+
+        :return: list of :class:`SCPFileResult`, one per file, if mode, owner
+        or checksum was given, otherwise None.
+        :raise: SSHError
+        """
+        filenames, tmpdir = self.convert_files_to_filenames(files)
+        try:
+            scp_command = self.scp_command(filenames, target)
+            _, err, returncode = await self._execute(scp_command)
+            if returncode != 0:  # ssh client error
+                raise SSHError("%s (under %s): %s" % (
+                    _join(scp_command), self.user, _native(err.strip())))
+            if not (mode or owner or checksum):
+                return None
+            results = await self.post_process(filenames, target, mode, owner, checksum)
+        finally:
+            if tmpdir:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        _check_file_results(results)
+        return results
+
+    async def post_process(self, filenames, target, mode=None, owner=None, checksum=None):
+        """
+        Set mode and owner of copied files and compute their checksums in a
+        single remote command, see :meth:`SSHConnection.post_process`
+        """
+        result = await self.run(self.post_process_script(
+            filenames, target, mode, owner, checksum))
+        return self.post_process_results(result, filenames, target)
+
+    async def get_scp_targets(self, filenames, target):
+        """
+        Given a list of filenames and a target name return the full list of
+        targets, see :meth:`SSHConnection.get_scp_targets`
+        """
+        results = await self.post_process(filenames, target)
+        return [result.path for result in results]
+
+    async def _execute(self, cmd, data=None):
+        """
+        Run cmd with data on stdin, holding a slot of the semaphore if any.
+
+        :return: tuple (stdout, stderr, returncode)
+        :raise: SSHError, if the timeout has passed
+        """
+        if self.semaphore is None:
+            return await self._spawn(cmd, data)
+        async with self.semaphore:
+            return await self._spawn(cmd, data)
+
+    async def _spawn(self, cmd, data):
+        pipe = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, env=self.get_env())
+        try:
+            out, err = await asyncio.wait_for(pipe.communicate(data),
+                                              self.timeout or None)
+        except asyncio.TimeoutError:
+            await _kill(pipe)
+            raise SSHTimeoutError("%s (under %s): SSH connect timeout" % (
+                _join(cmd), self.user))
+        except asyncio.CancelledError:
+            await _kill(pipe)
+            raise
+        return out, err, pipe.returncode
+
+
+async def _kill(pipe, grace=1.0):
+    """
+    Terminate the process, killing it if it is still there after grace, and
+    reap it.
+
+    Process.wait also waits for the pipes to close, which descendants of the
+    process may hold open, so it is only given grace; the transport is then
+    closed explicitly rather than left to leak.
+    """
+    try:
+        pipe.terminate()
+        for _ in range(int(grace * 100)):
+            if pipe.returncode is not None:
+                break
+            await asyncio.sleep(0.01)
+        else:
+            pipe.kill()
+    except ProcessLookupError:  # already gone
+        pass
+    try:
+        await asyncio.wait_for(pipe.wait(), grace)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        transport = getattr(pipe, '_transport', None)
+        if transport is not None:
+            transport.close()
+
+
+def _join(cmd):
+    return ' '.join([_native(chunk) for chunk in cmd])
+
+
+async def run_many(servers, command, concurrency=100, **kwargs):
+    """
+    Run command on every server, at most concurrency of them at a time.
+
+    :param servers: list of server names or IP addresses
+    :param command: command to execute on each of them
+    :param concurrency: the most ssh processes to run at once
+    :param kwargs: further arguments for :class:`AsyncSSHConnection`
+
+    :return: list with an SSHResult, or the SSHError raised, for every server
+    in the order given
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(server):
+        try:
+            connection = AsyncSSHConnection(server, semaphore=semaphore, **kwargs)
+            return await connection.run(command)
+        except SSHError as exc:
+            return exc
+
+    return await asyncio.gather(*[run_one(server) for server in servers])
@@ -15,20 +15,32 @@ import io
 import re
 import os
 import sys
+import math
+import stat
+import time
+import errno
+import heapq
+import random
 import pipes
-import signal
-import shutil
+import atexit
+import select
 import getpass
+import weakref
 import tempfile
+import threading
+import itertools
 import subprocess
 
-__all__ = 'SSHConnection SSHResult SSHError b u b_list u_list'.split()
+__all__ = ('SSHConnection SSHResult SSHStream SCPFileResult SSHError SSHTimeoutError '
+           'SSHCluster ClusterResult ClusterSummary b u b_list u_list').split()
 
 if int(sys.version[0]) == 2:
     text = unicode
     bytes = str  # @ReservedAssignment
+    import Queue as queue
 else:  # PY3K
     text = str
+    import queue
 
 
 def b(string):
@@ -82,7 +94,8 @@ class SSHConnection(object):
     """
 
     def __init__(self, server, login=None, port=None, configfile=None,
-                 identity_file=None, ssh_agent_socket=None, timeout=60, debug=False):
+                 identity_file=None, ssh_agent_socket=None, timeout=60, debug=False,
+                 persist=False, control_dir=None, control_persist=300):
         """
         Create new object to establish SSH connection to remote servers
 
@@ -97,6 +110,12 @@ class SSHConnection(object):
         :param timeout: connect timeout. If you plan to execute long
         lasting commands, adjust this variable accordingly.  Default value of
         60 seconds is usually a good choice.
+        :param persist: open a multiplexed master connection on first use and
+        reuse it for every later run and scp until :meth:`close` is called.
+        :param control_dir: directory for the master's control socket (by
+        default a private directory under the system temp directory)
+        :param control_persist: seconds an idle master is kept alive, a safety
+        net for connections which are never closed
 
         :raise SSHError: if server name or login contain illegal symbols, or
         some of the files, provided to the constructor, don't exist.
@@ -128,6 +147,101 @@ class SSHConnection(object):
         else:
             self.identity_file = None
         self.ssh_agent_socket = ssh_agent_socket
+        self.persist = persist
+        self.control_dir = control_dir
+        self.control_persist = control_persist
+        self.control_path = None
+        self._control_lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Start a master connection which later run and scp calls multiplex
+        over, so they skip the connection handshake.
+
+        Control sockets left behind by processes which no longer exist are
+        removed first. Opening an already open connection does nothing.
+
+        :return: None
+        :raise SSHError: if the master connection can not be established
+        """
+        with self._control_lock:
+            if self.control_path and os.path.exists(self.control_path):
+                return
+            control_dir = self.control_dir or _default_control_dir()
+            _remove_stale_control_sockets(control_dir)
+            control_path = os.path.join(control_dir, 'cm-%d-%d' % (
+                os.getpid(), next(_control_counter)))
+
+            cmd = self.ssh_options() + ['-M', '-N', '-f',
+                '-o', 'ControlPath=%s' % control_path,
+                '-o', 'ControlPersist=%s' % self.control_persist,
+                self.server]
+            cmd = b_list(cmd)
+            devnull = open(os.devnull)
+            errors = tempfile.TemporaryFile()
+            try:
+                # ssh forks into the background once the master is up; its
+                # output must not be a pipe or reading it would never end.
+                pipe = subprocess.Popen(cmd, stdin=devnull,
+                        stdout=errors, stderr=errors, env=self.get_env())
+                try:
+                    _wait(pipe, self.timeout)
+                except IOError as exc:
+                    raise _failure(cmd, self.user, exc)
+                if pipe.returncode != 0:
+                    errors.seek(0)
+                    raise SSHError("%s (under %s): %s" % (
+                        ' '.join(cmd), self.user, errors.read().strip()))
+            finally:
+                devnull.close()
+                errors.close()
+            self.control_path = control_path
+            _open_connections.add(self)
+
+    def close(self):
+        """
+        Stop the master connection started by :meth:`open`, if any.
+
+        :return: None
+        """
+        with self._control_lock:
+            control_path = self.control_path
+            if not control_path:
+                return
+            self.control_path = None
+            _open_connections.discard(self)
+            if os.path.exists(control_path):
+                cmd = b_list(self.ssh_options() + [
+                    '-o', 'ControlPath=%s' % control_path, '-O', 'exit', self.server])
+                pipe = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                        env=self.get_env())
+                try:
+                    _communicate(pipe, timeout=self.timeout)
+                except IOError:
+                    pass
+            try:
+                os.unlink(control_path)
+            except OSError:
+                pass
+
+    def control_options(self):
+        """
+        Options making ssh and scp multiplex over the master connection,
+        opening it first if the connection persists.
+
+        Internal function
+        """
+        if self.persist or self.control_path:
+            self.open()
+        return ['-o', 'ControlPath=%s' % self.control_path, '-o', 'ControlMaster=no']
 
     def check_server(self, server):
         """
@@ -177,39 +291,87 @@ class SSHConnection(object):
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE, env=self.get_env())
         try:
-            signal.signal(signal.SIGALRM, _timeout_handler)
-        except ValueError:  # signal only works in main thread
-            pass
-        signal.alarm(self.timeout)
-        out = b('')
-        err = b('')
-        try:
-            out, err = pipe.communicate(b(command))
+            out, err = _communicate(pipe, b(command), self.timeout)
         except IOError as exc:
-            # pipe.terminate() # only in python 2.6 allowed
-            os.kill(pipe.pid, signal.SIGTERM)
-            signal.alarm(0)  # disable alarm
-            raise SSHError("%s (under %s): %s" % (
-                ' '.join(ssh_command), self.user, str(exc)))
+            raise _failure(ssh_command, self.user, exc)
 
-        signal.alarm(0)  # disable alarm
         returncode = pipe.returncode
         if returncode == 255:  # ssh client error
             raise SSHError("%s (under %s): %s" % (
                 ' '.join(ssh_command), self.user, err.strip()))
         return SSHResult(command, out.strip(), err.strip(), returncode)
 
-    def scp(self, files, target, mode=None, owner=None):
+    def stream(self, command, interpreter='/bin/bash', forward_ssh_agent=False,
+               lines=False, timeout=None):
+        """
+        Execute the command like :meth:`run`, but hand out its output as it
+        arrives instead of collecting it in memory.
+
+        Example::
+
+            output = ssh_connection.stream('tail -n 1000000 /var/log/messages',
+                                           lines=True)
+            for name, line in output:
+                ...
+            print(output.returncode)
+
+        :param command: string/unicode object or byte sequence with the command
+        or set of commands to execute
+        :param interpreter: name of the interpreter (by default "/bin/bash" is used)
+        :param forward_ssh_agent: turn this flag to `True`, if you want to use
+        and forward SSH agent
+        :param lines: yield whole lines instead of chunks as they are read
+        :param timeout: seconds the whole command may take (by default the
+        connection timeout, 0 for no limit)
+
+        :return: SSH stream instance to iterate over
+        :rtype: SSHStream
+        """
+        ssh_command = self.ssh_command(interpreter, forward_ssh_agent)
+        pipe = subprocess.Popen(ssh_command,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, env=self.get_env())
+        if timeout is None:
+            timeout = self.timeout
+        return SSHStream(command, ssh_command, self.user, pipe,
+                         _iter_communicate(pipe, b(command), timeout), lines)
+
+    def run_stream(self, command, stdout=None, stderr=None, callback=None,
+                   interpreter='/bin/bash', forward_ssh_agent=False, lines=False,
+                   timeout=None):
+        """
+        Execute the command like :meth:`run`, writing its output into file
+        objects and/or passing it to a callback as it arrives.
+
+        :param stdout: file object to write stdout to, discarded if None
+        :param stderr: file object to write stderr to, discarded if None
+        :param callback: called with ('stdout' or 'stderr', data) for every
+        chunk, or line if lines is set
+
+        See :meth:`stream` for the other parameters.
+
+        :return: the command return code
+        :raise: SSHError, if server is unreachable, or timeout has reached.
+        """
+        files = {'stdout': stdout, 'stderr': stderr}
+        output = self.stream(command, interpreter, forward_ssh_agent, lines, timeout)
+        for name, data in output:
+            if files[name] is not None:
+                files[name].write(data)
+            if callback is not None:
+                callback(name, data)
+        return output.returncode
+
+    def scp(self, files, target, mode=None, owner=None, checksum=None):
         """ Copy files identified by their names to remote location
 
         .. note:: if you want your file objects to have meaningful names,
                   make sure they have `name` attribute.
 
-        :param files: list of file names or file-like objects to copy. Before
-        copying the files will be interpreted the following way: if the element
-        is a string, it is considered as a file name, if it's a file-like object,
-        then it will be copied to a temporary directory, and then copied from
-        there to a remote location using "scp" command.
+        :param files: list of file names or file-like objects to copy. File
+        names are copied with the "scp" command, file-like objects are
+        streamed over a single ssh session by :meth:`upload`, without being
+        written to local temporary files.
 
         :param target: target file or directory to copy data to. Target file
         makes sense only if the number of files to copy equals to one.
@@ -221,62 +383,194 @@ class SSHConnection(object):
         uploaded file (must be a string in the form understandable by chown).
         Makes sense only if you open your connection as root.
 
-        :return: None
+        :param checksum: optional name of a checksum algorithm, one of
+        CHECKSUM_ALGORITHMS, to compute for every uploaded file on the
+        remote side
+
+        :return: list of :class:`SCPFileResult`, one per file, if mode, owner
+        or checksum was given, otherwise None. The mode, ownership and
+        checksums are all handled by one remote command.
         :raise: SSHError
         """
-        filenames, tmpdir = self.convert_files_to_filenames(files)
+        if isinstance(files, (text, bytes)):
+            raise ValueError('"files" argument have to be iterable (list or tuple)')
+        files = list(files)
+        filenames = [f for f in files if isinstance(f, (text, bytes))]
+        objects = [f for f in files if not isinstance(f, (text, bytes))]
+        if not files:
+            raise ValueError('You should name at least one file to copy')
+
+        if filenames:
+            scp_command = self.scp_command(filenames, target)
+            pipe = subprocess.Popen(scp_command,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, env=self.get_env())
+            try:
+                _, err = _communicate(pipe, timeout=self.timeout)
+            except IOError as exc:
+                raise _failure(scp_command, self.user, exc)
+            returncode = pipe.returncode
+            if returncode != 0:  # ssh client error
+                raise SSHError("%s (under %s): %s" % (
+                    ' '.join(scp_command), self.user, err.strip()))
+        names = []
+        if objects:
+            names = self.upload(objects, target, mode)
+
+        if not (mode or owner or checksum):
+            return None
+        # the remote names in the order the files were given
+        names = iter(names)
+        remote_names = [isinstance(f, (text, bytes)) and f or next(names) for f in files]
+        results = self.post_process(remote_names, target, mode, owner, checksum)
+        _check_file_results(results)
+        return results
+
+    def upload(self, objects, target, mode=None, chunk_size=65536):
+        """
+        Stream file-like objects to the remote location over one ssh session.
+
+        The data is sent in chunk_size pieces using the sink side of the scp
+        protocol ("scp -t" on the remote host), so neither the objects nor
+        copies of them have to fit in memory or on local disk. The size of
+        each object is taken from the underlying file or by seeking to its
+        end; objects which allow neither are read into memory.
 
-        def cleanup_tmp_dir():
-            if tmpdir:
-                shutil.rmtree(tmpdir, ignore_errors=True)
+        .. note:: objects are named after the basename of their `name`
+                  attribute if they have a real one, otherwise "upload<n>". Target should be a directory
+                  if more than one object is uploaded.
 
-        scp_command = self.scp_command(filenames, target)
-        pipe = subprocess.Popen(scp_command,
+        :param objects: list of file-like objects, read from their current
+        position
+        :param target: target file or directory
+        :param mode: octal mode of newly created files. By default, and for
+        other modes understood by chmod, which are left to the chmod
+        :meth:`scp` runs afterwards, files are created with the mode of the
+        local file an object reads from, or 0600 if it reads from none
+        :param chunk_size: bytes read from an object and sent at a time
+
+        :return: list of the names the objects were sent under
+        :raise: SSHError
+        """
+        uploads = []
+        for index, file_obj in enumerate(objects):
+            name = getattr(file_obj, 'name', None)
+            # file descriptors and pseudo names like <stdin> or <fdopen>
+            if isinstance(name, (text, bytes)) and not name.startswith('<'):
+                name = os.path.basename(name)
+            else:
+                name = 'upload%d' % index
+            size = _remaining_size(file_obj)
+            if size is None:
+                file_obj = io.BytesIO(b(file_obj.read()))
+                size = len(file_obj.getvalue())
+            uploads.append((name, file_obj, size, _source_mode(file_obj)))
+
+        cmd_chunks = ['scp', '-t']
+        if len(uploads) > 1:
+            cmd_chunks.append('-d')
+        cmd = self.ssh_command(b_quote(cmd_chunks + ['--', target]), False)
+        if mode and re.match(r'^[0-7]{1,4}$', str(mode)):
+            uploads = [upload[:3] + (int(str(mode), 8), ) for upload in uploads]
+        stream = _scp_sink_stream(uploads, chunk_size)
+        pipe = subprocess.Popen(cmd,
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE, env=self.get_env())
         try:
-            signal.signal(signal.SIGALRM, _timeout_handler)
-        except ValueError:  # signal only works in main thread
-            pass
-        signal.alarm(self.timeout)
-        err = b('')
-        try:
-            _, err = pipe.communicate()
+            out, err = _communicate(pipe, stream, self.timeout)
         except IOError as exc:
-            # pipe.terminate() # only in python 2.6 allowed
-            os.kill(pipe.pid, signal.SIGTERM)
-            signal.alarm(0)  # disable alarm
-            cleanup_tmp_dir()
+            raise _failure(cmd, self.user, exc)
+        errors = _scp_sink_errors(out)
+        if pipe.returncode or errors:
             raise SSHError("%s (under %s): %s" % (
-                ' '.join(scp_command), self.user, str(exc)))
-        signal.alarm(0)  # disable alarm
-        returncode = pipe.returncode
-        if returncode != 0:  # ssh client error
-            cleanup_tmp_dir()
-            raise SSHError("%s (under %s): %s" % (
-                ' '.join(scp_command), self.user, err.strip()))
-
-        if mode or owner:
-            targets = self.get_scp_targets(filenames, target)
-            if mode:
-                cmd_chunks = ['chmod', str(mode)] + targets
-                cmd = b_quote(cmd_chunks)
-                result = self.run(cmd)
-                if result.returncode:
-                    cleanup_tmp_dir()
-                    raise SSHError("change mode: %s" % result.stderr.strip())
-            if owner:
-                cmd_chunks = ['chown', owner] + targets
-                cmd = b_quote(cmd_chunks)
-                result = self.run(cmd)
-                if result.returncode:
-                    cleanup_tmp_dir()
-                    raise SSHError("change owner: %s" % result.stderr.strip())
-        cleanup_tmp_dir()
+                ' '.join(cmd), self.user, '; '.join(errors) or _native(err.strip())))
+        return [name for name, _, _, _ in uploads]
+
+    def post_process(self, filenames, target, mode=None, owner=None, checksum=None):
+        """
+        Resolve the remote paths of copied files and set their mode, owner
+        and compute their checksums, all in a single remote command.
+
+        Internal command which is used by scp.
+
+        :param filenames: list of copied filenames (basenames are used)
+        :param target: target file or directory they were copied to
+        :param mode: mode to chmod every file to, if given
+        :param owner: owner to chown every file to, if given
+        :param checksum: checksum algorithm to compute, if given
+
+        :return: list of :class:`SCPFileResult`, in the order of filenames
+        :raise: SSHError, if the remote command could not be run
+        """
+        result = self.run(self.post_process_script(
+            filenames, target, mode, owner, checksum))
+        return self.post_process_results(result, filenames, target)
+
+    def post_process_script(self, filenames, target, mode=None, owner=None,
+                            checksum=None):
+        """
+        Build the remote shell script run by :meth:`post_process`.
+
+        Internal function
+        """
+        if checksum and checksum not in _CHECKSUM_TOOLS:
+            raise ValueError('Unsupported checksum algorithm: %s' % checksum)
+        quote = lambda chunk: pipes.quote(u(chunk))
+        script = [
+            'target=%s' % quote(target),
+            'if [ -d "$target" ]; then echo DIR; else echo FILE; fi',
+            'i=0',
+            'for name in %s; do' % ' '.join(
+                [quote(os.path.basename(f)) for f in filenames]),
+            '  if [ -d "$target" ]; then path="$target/$name"; else path="$target"; fi',
+            '  mode_err=; owner_err=; digest=',
+        ]
+        if mode:
+            script.append('  mode_err=$(chmod %s "$path" 2>&1) && mode_err= '
+                          '|| mode_err=${mode_err:-failed}' % quote(str(mode)))
+        if owner:
+            script.append('  owner_err=$(chown %s "$path" 2>&1) && owner_err= '
+                          '|| owner_err=${owner_err:-failed}' % quote(owner))
+        if checksum:
+            script.append('  digest=$(%s < "$path" 2>/dev/null | cut -d" " -f1)' %
+                          _CHECKSUM_TOOLS[checksum])
+        script += [
+            '  printf "%s\\t%s\\t%s\\t%s\\n" "$i" "$digest" '
+            '"$(printf %s "$mode_err" | tr "\\t\\n" "  ")" '
+            '"$(printf %s "$owner_err" | tr "\\t\\n" "  ")"',
+            '  i=$((i + 1))',
+            'done',
+        ]
+        return b('\n'.join(script) + '\n')
+
+    def post_process_results(self, result, filenames, target):
+        """
+        Parse the output of the :meth:`post_process_script` into a list of
+        :class:`SCPFileResult`.
+
+        Internal function
+        """
+        lines = result.stdout.splitlines()
+        if result.returncode or len(lines) != len(filenames) + 1:
+            raise SSHError("post process: %s" % result.stderr.strip())
+
+        is_directory = lines[0].strip() == b('DIR')
+        results = []
+        for filename, line in zip(filenames, lines[1:]):
+            fields = line.split(b('\t'))
+            fields += [b('')] * (4 - len(fields))
+            if is_directory:
+                path = os.path.join(target, os.path.basename(filename))
+            else:
+                path = target
+            results.append(SCPFileResult(path, fields[1] or None,
+                                         fields[2] or None, fields[3] or None))
+        return results
 
     def convert_files_to_filenames(self, files):
         """
-        Helper function which is invoked by scp.
+        Helper function which is invoked by the asyncio scp, :meth:`scp`
+        streams file-like objects with :meth:`upload` instead.
 
         You don't usually need to execute this function manually.
         Check for every file in list and save it locally to send to
@@ -344,6 +638,21 @@ class SSHConnection(object):
         Internal function
         """
         interpreter = b(interpreter)
+        cmd = self.ssh_options()
+        if self.persist or self.control_path:
+            cmd += self.control_options()
+        if forward_ssh_agent:
+            cmd.append('-A')
+        cmd.append(self.server)
+        cmd.append(interpreter)
+        return b_list(cmd)
+
+    def ssh_options(self):
+        """
+        Build the ssh command line up to the connection specific options.
+
+        Internal function
+        """
         cmd = ['/usr/bin/ssh', ]
         if self.debug:
             cmd += ['-vvvv']
@@ -353,13 +662,9 @@ class SSHConnection(object):
             cmd += ['-F', self.configfile]
         if self.identity_file:
             cmd += ['-i', self.identity_file]
-        if forward_ssh_agent:
-            cmd.append('-A')
         if self.port:
             cmd += ['-p', str(self.port)]
-        cmd.append(self.server)
-        cmd.append(interpreter)
-        return b_list(cmd)
+        return cmd
 
     def scp_command(self, files, target):
         """
@@ -379,6 +684,8 @@ class SSHConnection(object):
             cmd += ['-i', self.identity_file]
         if self.port:
             cmd += ['-P', str(self.port)]
+        if self.persist or self.control_path:
+            cmd += self.control_options()
 
         if isinstance(files, (text, bytes)):
             raise ValueError('"files" argument have to be iterable (list or tuple)')
@@ -400,9 +707,300 @@ class SSHConnection(object):
         return env
 
 
-def _timeout_handler(signum, frame):
-    """ This function is called when ssh takes too long to connect. """
-    raise IOError('SSH connect timeout')
+_control_counter = itertools.count(1)
+_open_connections = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_connections():
+    """ Stop master connections still open when the interpreter exits. """
+    for connection in list(_open_connections):
+        connection.close()
+
+
+# the digests hash_utils.get_hasher allows: md5 and sha1 are left out on purpose
+CHECKSUM_ALGORITHMS = ('sha224', 'sha256', 'sha384', 'sha512')
+
+_CHECKSUM_TOOLS = dict([(algorithm, '%ssum' % algorithm) for algorithm in CHECKSUM_ALGORITHMS])
+
+
+def _default_control_dir():
+    """
+    Return a directory private to the current user for control sockets,
+    creating it if needed.
+    """
+    control_dir = os.path.join(tempfile.gettempdir(),
+                               'py_stdlib-ssh-%s' % getpass.getuser())
+    try:
+        os.mkdir(control_dir, int('700', 8))
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    return control_dir
+
+
+def _remove_stale_control_sockets(control_dir):
+    """
+    Remove control sockets whose owning process is gone. Socket names carry
+    the pid of the process which opened them.
+    """
+    try:
+        names = os.listdir(control_dir)
+    except OSError:
+        return
+    for name in names:
+        match = re.match(r'^cm-(\d+)-\d+$', name)
+        if not match:
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+        except OSError as exc:
+            if exc.errno == errno.ESRCH:
+                try:
+                    os.unlink(os.path.join(control_dir, name))
+                except OSError:
+                    pass
+
+
+_CLOCK_MONOTONIC = 1  # the clock id on linux, other systems number it differently
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:  # python 2, call clock_gettime(CLOCK_MONOTONIC) on linux
+    _monotonic = time.time
+if _monotonic is time.time and sys.platform.startswith('linux'):
+    try:
+        import ctypes
+        import ctypes.util
+
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt'),
+                                     use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+        def _monotonic():
+            """ Seconds on a clock which is not affected by system time changes. """
+            spec = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(spec)):
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return spec.tv_sec + spec.tv_nsec * 1e-9
+    except (ImportError, OSError, AttributeError):
+        pass
+
+_PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+
+def _deadline(timeout):
+    """ Convert a timeout in seconds to a deadline, None means no limit. """
+    if timeout:
+        return _monotonic() + timeout
+    return None
+
+
+def _remaining(deadline):
+    """
+    Return the seconds left until deadline (None if unlimited)
+
+    :raise IOError: if the deadline has passed
+    """
+    if deadline is None:
+        return None
+    remaining = deadline - _monotonic()
+    if remaining <= 0:
+        raise _Timeout('SSH connect timeout')
+    return remaining
+
+
+class _Timeout(IOError):
+    """ Raised when the deadline of a call has passed. """
+
+
+def _failure(cmd, user, exc):
+    """
+    Wrap an IOError raised while running cmd in an SSHError, or in an
+    SSHTimeoutError if it was a timeout.
+    """
+    if isinstance(exc, _Timeout):
+        error_class = SSHTimeoutError
+    else:
+        error_class = SSHError
+    return error_class("%s (under %s): %s" % (' '.join(cmd), user, str(exc)))
+
+
+def _select(readers, writers, timeout):
+    """
+    Wait until some of the file descriptors are ready, with poll where the
+    platform has it so descriptor numbers are not limited by FD_SETSIZE.
+
+    :return: tuple (readable, writable)
+    """
+    try:
+        if not hasattr(select, 'poll'):
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+            return readable, writable
+        poller = select.poll()
+        for fd in readers:
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        for fd in writers:
+            poller.register(fd, select.POLLOUT)
+        if timeout is not None:
+            timeout = int(timeout * 1000) + 1
+        readable, writable = [], []
+        for fd, event in poller.poll(timeout):
+            if fd in writers:
+                writable.append(fd)
+            else:
+                readable.append(fd)
+        return readable, writable
+    except (select.error, OSError, IOError) as exc:
+        if exc.args[0] == errno.EINTR:
+            return [], []
+        raise
+
+
+def _kill(pipe, grace=1.0):
+    """ Terminate the process, killing it if it is still there after grace. """
+    try:
+        pipe.terminate()
+        deadline = _monotonic() + grace
+        while pipe.poll() is None and _monotonic() < deadline:
+            time.sleep(0.01)
+        if pipe.poll() is None:
+            pipe.kill()
+    except OSError:  # already gone
+        pass
+    pipe.wait()
+    for stream in (pipe.stdin, pipe.stdout, pipe.stderr):
+        if stream:
+            stream.close()
+
+
+def _wait(pipe, timeout=None):
+    """
+    Wait for the process to exit within timeout seconds.
+
+    :return: the return code
+    :raise IOError: if the timeout has passed, after the process was stopped
+    """
+    deadline = _deadline(timeout)
+    delay = 0.0005
+    while pipe.poll() is None:
+        try:
+            remaining = _remaining(deadline)
+        except IOError:
+            _kill(pipe)
+            raise
+        if remaining is not None:
+            delay = min(delay, remaining)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+    return pipe.returncode
+
+
+def _iter_communicate(pipe, data=None, timeout=None):
+    """
+    Feed data, a byte string or an iterable of them, to the process and
+    yield its output as it arrives, until it exits or timeout seconds have
+    passed.
+
+    Unlike alarm signals this works from any thread, so many calls can run
+    concurrently. The process is terminated, then killed, on timeout or when
+    the consumer stops iterating early. Output is only read as fast as it
+    is consumed.
+
+    :return: generator of tuples (name, chunk), name is 'stdout' or 'stderr'
+    :raise IOError: if the timeout has passed
+    """
+    deadline = _deadline(timeout)
+    names = {}
+    if pipe.stdout:
+        names[pipe.stdout.fileno()] = 'stdout'
+    if pipe.stderr:
+        names[pipe.stderr.fileno()] = 'stderr'
+    writers = []
+    if pipe.stdin:
+        writers.append(pipe.stdin.fileno())
+    if isinstance(data, bytes):
+        data = [data]
+    chunks = iter(data or ())
+    pending = b('')
+    offset = 0
+
+    try:
+        while names or writers:
+            while writers and offset >= len(pending):
+                try:
+                    pending = next(chunks)
+                    offset = 0
+                except StopIteration:
+                    pipe.stdin.close()
+                    writers = []
+            readable, writable = _select(list(names), writers, _remaining(deadline))
+            if writable:
+                try:
+                    offset += os.write(writers[0], pending[offset:offset + _PIPE_BUF])
+                except OSError as exc:
+                    if exc.errno != errno.EPIPE:
+                        raise
+                    pipe.stdin.close()
+                    writers = []
+            for fd in readable:
+                chunk = os.read(fd, 32768)
+                if chunk:
+                    yield names[fd], chunk
+                else:
+                    del names[fd]
+        _wait(pipe, _remaining(deadline))
+    finally:
+        if pipe.returncode is None:
+            _kill(pipe)
+        for stream in (pipe.stdout, pipe.stderr):
+            if stream:
+                stream.close()
+
+
+def _communicate(pipe, data=None, timeout=None):
+    """
+    Like Popen.communicate, but gives up after timeout seconds, see
+    _iter_communicate.
+
+    :return: tuple (stdout, stderr)
+    :raise IOError: if the timeout has passed
+    """
+    output = {'stdout': [], 'stderr': []}
+    for name, chunk in _iter_communicate(pipe, data, timeout):
+        output[name].append(chunk)
+    return b('').join(output['stdout']), b('').join(output['stderr'])
+
+
+def _iter_lines(chunks):
+    """
+    Regroup (name, chunk) tuples into (name, line) tuples. Lines keep their
+    newline, a last line without one is yielded at the end.
+    """
+    pending = {}
+    newline = b('\n')
+    for name, chunk in chunks:
+        end = chunk.find(newline)
+        if end < 0:
+            pending.setdefault(name, []).append(chunk)
+            continue
+        parts = pending.pop(name, [])
+        parts.append(chunk[:end + 1])
+        yield name, b('').join(parts)
+        start = end + 1
+        end = chunk.find(newline, start)
+        while end >= 0:
+            yield name, chunk[start:end + 1]
+            start = end + 1
+            end = chunk.find(newline, start)
+        if start < len(chunk):
+            pending[name] = [chunk[start:]]
+    for name in ('stdout', 'stderr'):
+        if name in pending:
+            yield name, b('').join(pending[name])
 
 
 class SSHResult(object):
@@ -467,8 +1065,432 @@ class SSHResult(object):
         return self.repr_binary().encode('utf-8', 'ignore')
 
 
+def _native(string):
+    """ convert remote output to the native str type for messages """
+    if isinstance(string, str):
+        return string
+    return string.decode('utf-8', 'replace')
+
+
+def _remaining_size(file_obj):
+    """
+    Return the number of bytes left to read from a binary file-like object,
+    or None if it can not be told without reading it.
+    """
+    if isinstance(file_obj, io.TextIOBase):
+        return None
+    try:
+        return os.fstat(file_obj.fileno()).st_size - file_obj.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    try:
+        position = file_obj.tell()
+        file_obj.seek(0, 2)
+        end = file_obj.tell()
+        file_obj.seek(position)
+        return end - position
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+def _source_mode(file_obj):
+    """
+    Return the permission bits of the regular file a file-like object reads
+    from, or 0600 for any other object, the mode a temporary copy would get.
+    """
+    try:
+        st = os.fstat(file_obj.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return 0o600
+    if not stat.S_ISREG(st.st_mode):
+        return 0o600
+    return stat.S_IMODE(st.st_mode)
+
+
+def _scp_sink_stream(uploads, chunk_size):
+    """
+    Generate the scp protocol messages sending each (name, file_obj, size,
+    mode).
+    """
+    for name, file_obj, size, mode in uploads:
+        yield b('C%04o %d %s\n' % (mode, size, name))
+        remaining = size
+        while remaining:
+            chunk = b(file_obj.read(min(chunk_size, remaining)))
+            if not chunk:
+                raise IOError('%s ended %d bytes early' % (name, remaining))
+            remaining -= len(chunk)
+            yield chunk
+        yield b('\0')
+
+
+def _scp_sink_errors(output):
+    """
+    Return the error messages among the acknowledgements of an scp sink:
+    a zero byte for success, otherwise a byte 1 or 2 and a line of text.
+    """
+    errors = []
+    index = 0
+    while index < len(output):
+        if output[index:index + 1] == b('\0'):
+            index += 1
+            continue
+        end = output.find(b('\n'), index)
+        if end < 0:
+            end = len(output)
+        errors.append(_native(output[index + 1:end]))
+        index = end + 1
+    return errors
+
+
+def _check_file_results(results):
+    """ Raise SSHError for the first kind of post processing failure. """
+    for action, attr in (("change mode", "mode_error"),
+                         ("change owner", "owner_error")):
+        errors = [_native(getattr(r, attr)) for r in results if getattr(r, attr)]
+        if errors:
+            raise SSHError("%s: %s" % (action, '; '.join(errors)))
+
+
+class SSHStream(object):
+    """
+    Output of a command started by :meth:`SSHConnection.stream`.
+
+    Iterating yields (name, data) tuples as the output arrives, where name
+    is 'stdout' or 'stderr'. The return code is set once the iteration is
+    over; timeouts and ssh client errors are raised from the iteration.
+    """
+    #: command which has been executed remotely
+    command = None
+    #: command return code, None until the output has been consumed
+    returncode = None
+
+    #: bytes of stderr kept to report ssh client errors
+    stderr_tail_size = 4096
+
+    def __init__(self, command, ssh_command, user, pipe, chunks, lines=False):
+        self.command = command
+        self.stderr_tail = b('')
+        self._ssh_command = ssh_command
+        self._user = user
+        self._pipe = pipe
+        self._chunks = chunks
+        self._lines = lines
+
+    def __iter__(self):
+        output = self._track_stderr()
+        if self._lines:
+            output = _iter_lines(output)
+        finished = False
+        try:
+            for name, data in output:
+                yield name, data
+            finished = True
+        except IOError as exc:
+            raise _failure(self._ssh_command, self._user, exc)
+        finally:
+            if not finished:  # abandoned early, stop the command
+                self.close()
+        self.returncode = self._pipe.returncode
+        if self.returncode == 255:  # ssh client error
+            raise SSHError("%s (under %s): %s" % (
+                ' '.join(self._ssh_command), self._user, self.stderr_tail.strip()))
+
+    def _track_stderr(self):
+        for name, chunk in self._chunks:
+            if name == 'stderr':
+                self.stderr_tail = (self.stderr_tail + chunk)[-self.stderr_tail_size:]
+            yield name, chunk
+
+    def close(self):
+        """ Stop the command if it is still running. """
+        self._chunks.close()
+
+
+class SCPFileResult(object):
+    """
+    Remote state of one file after :meth:`SSHConnection.scp`.
+    """
+    #: remote path of the file
+    path = None
+    #: hexdigest computed on the remote side, if a checksum was requested
+    checksum = None
+    #: chmod error message, or None
+    mode_error = None
+    #: chown error message, or None
+    owner_error = None
+
+    def __init__(self, path, checksum=None, mode_error=None, owner_error=None):
+        self.path = path
+        self.checksum = checksum
+        self.mode_error = mode_error
+        self.owner_error = owner_error
+
+    @property
+    def ok(self):
+        """ True if neither changing the mode nor the owner failed. """
+        return not (self.mode_error or self.owner_error)
+
+    def __repr__(self):
+        return 'SCPFileResult(%r, checksum=%r, mode_error=%r, owner_error=%r)' % (
+            self.path, self.checksum, self.mode_error, self.owner_error)
+
+
 class SSHError(Exception):
     """
     This exception is used for all errors raised by this module.
     """
     pass
+
+
+class SSHTimeoutError(SSHError):
+    """
+    Raised when a command or copy did not finish within its timeout.
+    """
+    pass
+
+
+class ClusterResult(object):
+    """
+    Outcome of one host of an :class:`SSHCluster` run.
+    """
+    #: server name or IP address
+    server = None
+    #: SSH result instance, None if every attempt failed
+    result = None
+    #: SSHError of the last attempt, or any other exception it raised;
+    #: None if a result was obtained
+    error = None
+    #: number of attempts made
+    attempts = 0
+    #: seconds the last attempt took
+    latency = None
+
+    def __init__(self, server, result=None, error=None, attempts=0, latency=None):
+        self.server = server
+        self.result = result
+        self.error = error
+        self.attempts = attempts
+        self.latency = latency
+
+    @property
+    def ok(self):
+        """ True if the command ran and returned 0. """
+        return self.result is not None and self.result.returncode == 0
+
+    @property
+    def timed_out(self):
+        """ True if the last attempt ran into its timeout. """
+        return isinstance(self.error, SSHTimeoutError)
+
+    def __repr__(self):
+        return 'ClusterResult(%r, ok=%r, attempts=%r, latency=%r, error=%r)' % (
+            self.server, self.ok, self.attempts, self.latency,
+            self.error and str(self.error))
+
+
+class ClusterSummary(object):
+    """
+    Aggregate of the results of an :class:`SSHCluster` run.
+    """
+
+    def __init__(self, results, elapsed=None):
+        #: dict of server to :class:`ClusterResult`
+        self.results = dict([(r.server, r) for r in results])
+        #: seconds the whole run took
+        self.elapsed = elapsed
+        values = list(self.results.values())
+        #: hosts where the command returned 0
+        self.succeeded = len([r for r in values if r.ok])
+        #: hosts where the command ran but returned non-zero
+        self.failed = len([r for r in values if r.result is not None and not r.ok])
+        #: hosts which timed out on their last attempt
+        self.timed_out = len([r for r in values if r.timed_out])
+        #: hosts which could not be reached for other reasons
+        self.unreachable = len([r for r in values if r.error is not None
+                                and not r.timed_out])
+        #: latencies of the hosts which returned a result, sorted
+        self.latencies = sorted([r.latency for r in values if r.result is not None])
+
+    def percentile(self, percent):
+        """
+        Return the latency below which percent of the answering hosts
+        finished (nearest rank), or None if no host answered.
+        """
+        if not self.latencies:
+            return None
+        rank = int(math.ceil(percent / 100.0 * len(self.latencies)))
+        return self.latencies[max(rank, 1) - 1]
+
+    def __str__(self):
+        line = '%d hosts: %d ok, %d failed, %d timed out, %d unreachable' % (
+            len(self.results), self.succeeded, self.failed, self.timed_out,
+            self.unreachable)
+        if self.latencies:
+            line += '; latency p50 %.3fs p90 %.3fs p99 %.3fs max %.3fs' % (
+                self.percentile(50), self.percentile(90), self.percentile(99),
+                self.latencies[-1])
+        return line
+
+
+class SSHCluster(object):
+    """
+    Run commands on many hosts from a bounded pool of worker threads.
+
+    Hosts which can not be reached (ssh client errors and timeouts) are
+    retried with exponential backoff; a command which ran and failed is not.
+    Hosts waiting for a retry do not hold a worker.
+
+    Example::
+
+        cluster = SSHCluster(hosts, concurrency=50, timeout=30, retries=2)
+        for host_result in cluster.iter_run('uptime'):
+            print(host_result.server, host_result.result)
+
+        print(cluster.run('uptime'))  # ClusterSummary
+    """
+
+    def __init__(self, servers, concurrency=10, timeout=60, retries=0,
+                 backoff=1.0, max_backoff=30.0, **connection_options):
+        """
+        :param servers: list of server names or IP addresses
+        :param concurrency: the most hosts to work on at the same time
+        :param timeout: seconds each attempt on a host may take
+        :param retries: how often an unreachable host is tried again
+        :param backoff: seconds before the first retry, doubled for each
+        following one (with jitter) up to max_backoff
+        :param connection_options: further arguments for :class:`SSHConnection`
+        """
+        self.servers = list(servers)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.connection_options = connection_options
+
+    def connect(self, server):
+        """ Create the connection used for server. """
+        return SSHConnection(server, timeout=self.timeout, **self.connection_options)
+
+    def iter_run(self, command, interpreter='/bin/bash'):
+        """
+        Run command on every host.
+
+        :return: generator of :class:`ClusterResult`, in the order the hosts
+        finish
+        """
+        return self.iter_map(lambda connection: connection.run(command, interpreter))
+
+    def run(self, command, interpreter='/bin/bash'):
+        """
+        Run command on every host and wait for all of them.
+
+        :rtype: ClusterSummary
+        """
+        start = _monotonic()
+        results = list(self.iter_run(command, interpreter))
+        return ClusterSummary(results, _monotonic() - start)
+
+    def iter_map(self, action):
+        """
+        Call action with the :class:`SSHConnection` of every host. Its
+        return value becomes the result of the host, an exception it raises
+        the error. Only SSHErrors are retried.
+
+        :return: generator of :class:`ClusterResult`, in the order the hosts
+        finish
+        """
+        # pending: heap of (not before, sequence, server, attempt)
+        pending = [(0, index, server, 1) for index, server in enumerate(self.servers)]
+        state = {'running': 0, 'stopped': False}
+        condition = threading.Condition()
+        finished = queue.Queue()
+
+        def next_host():
+            with condition:
+                while not state['stopped'] and (pending or state['running']):
+                    if pending:
+                        wait = pending[0][0] - _monotonic()
+                        if wait <= 0:
+                            state['running'] += 1
+                            return heapq.heappop(pending)
+                        condition.wait(wait)
+                    else:
+                        condition.wait()
+                condition.notify_all()
+                return None
+
+        def work():
+            while True:
+                task = next_host()
+                if task is None:
+                    return
+                _, sequence, server, attempt = task
+                host_result = None
+                try:
+                    host_result = self._attempt(action, server, attempt)
+                finally:
+                    # always account the host, or iter_map would wait for it forever
+                    with condition:
+                        state['running'] -= 1
+                        if host_result is None:
+                            finished.put(ClusterResult(server, attempts=attempt, error=SSHError(
+                                '%s: worker interrupted' % server)))
+                        elif self._retry(host_result.error, attempt):
+                            heapq.heappush(pending, (_monotonic() + self._delay(attempt),
+                                                     sequence, server, attempt + 1))
+                        else:
+                            finished.put(host_result)
+                        condition.notify_all()
+
+        workers = []
+        for _ in range(min(self.concurrency, len(self.servers))):
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        try:
+            for _ in self.servers:
+                yield finished.get()
+        finally:
+            with condition:
+                state['stopped'] = True
+                condition.notify_all()
+            for worker in workers:
+                worker.join()
+
+    def _attempt(self, action, server, attempt):
+        """
+        Try action on server once. Any exception becomes the error of the
+        result, so that it can not take its worker thread down.
+        """
+        try:
+            connection = self.connect(server)
+        except SSHError as exc:
+            return ClusterResult(server, error=_InvalidHost(str(exc)), attempts=attempt)
+        except Exception as exc:
+            return ClusterResult(server, error=exc, attempts=attempt)
+        start = _monotonic()
+        try:
+            result = action(connection)
+        except Exception as exc:
+            return ClusterResult(server, error=exc, attempts=attempt,
+                                 latency=_monotonic() - start)
+        return ClusterResult(server, result, attempts=attempt,
+                             latency=_monotonic() - start)
+
+    def _retry(self, error, attempt):
+        """ Whether an attempt which ended with error is made again. """
+        return (isinstance(error, SSHError) and not isinstance(error, _InvalidHost)
+                and attempt <= self.retries)
+
+    def _delay(self, attempt):
+        """ Backoff before retry number attempt, with jitter. """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+
+class _InvalidHost(SSHError):
+    """ The connection could not even be set up, retrying would not help. """
+    pass
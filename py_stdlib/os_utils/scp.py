@@ -1,10 +1,261 @@
 import os
+import re
+import mmap
+import zlib
+import base64
+import struct
+import hashlib
 
 from openssh_wrapper import SSHConnection
 from openssh_wrapper import SSHError
 
 from hash_utils import checksum
 
+REMOTE_PYTHON = "/usr/bin/python"
+
+MIN_DELTA_BLOCKSIZE = 2048
+MAX_DELTA_BLOCKSIZE = 128 * 1024
+
+# Rolling the weak checksum is done byte by byte in python, far slower than
+# copying the bytes.  A changed region is only rolled through for its first
+# DELTA_ROLL_BLOCKS block lengths, and a file for DELTA_MAX_ROLL_BLOCKS in
+# total; past that blocks are only looked for at block boundaries.
+DELTA_ROLL_BLOCKS = 4
+DELTA_MAX_ROLL_BLOCKS = 16
+
+# octal or symbolic modes as understood by chmod
+_CHMOD_MODE = re.compile(r"^([0-7]{1,4}|[ugoa]*([-+=]([rwxXst]*|[ugo]))+(,[ugoa]*([-+=]([rwxXst]*|[ugo]))+)*)$")
+
+_DELTA_COPY = struct.Struct(">cQQ")
+_DELTA_LITERAL = struct.Struct(">cQ")
+
+# Both scripts run under python 2 or 3 on the remote host.  They resolve the
+# target the same way the checksum verification does: a directory target
+# means a file of the source's name inside it.
+_REMOTE_TARGET = """
+import base64, hashlib, os, stat, struct, subprocess, sys, tempfile, zlib
+path = base64.b64decode(TARGET)
+if os.path.isdir(path):
+    path = os.path.join(path, base64.b64decode(NAME))
+"""
+
+# Prints the size of the existing target followed by an adler32 and sha1
+# checksum for each block, or MISSING if there is nothing to diff against.
+_SIGNATURE_SCRIPT = _REMOTE_TARGET + """
+if not os.path.isfile(path):
+    sys.stdout.write("MISSING\\n")
+    sys.exit(0)
+sys.stdout.write("FILE %d\\n" % os.path.getsize(path))
+old = open(path, "rb")
+while True:
+    block = old.read(BLOCKSIZE)
+    if not block:
+        break
+    sys.stdout.write("%d %s\\n" % (zlib.adler32(block) & 0xffffffff,
+                                  hashlib.sha1(block).hexdigest()))
+old.close()
+"""
+
+# Rebuilds the target from the delta on stdin into a temporary file next to
+# it, then copies that over the target in place, as scp does, so the inode
+# and with it hard links, owner and mode are kept.  MODE and OWNER are tried
+# on the temporary file first, so a bad one fails before the target is
+# touched.  Prints the sha256 of the new contents.
+_APPLY_SCRIPT = _REMOTE_TARGET + """
+stream = getattr(sys.stdin, "buffer", sys.stdin)
+old = open(path, "rb")
+directory, name = os.path.split(path)
+fd, tmp = tempfile.mkstemp(dir=directory or b".", prefix=b"." + name + b".")
+digest = hashlib.sha256()
+try:
+    new = os.fdopen(fd, "wb")
+    try:
+        while True:
+            kind = stream.read(1)
+            if kind == b"C":
+                offset, length = struct.unpack(">QQ", stream.read(16))
+                old.seek(offset)
+                source = old
+            elif kind == b"L":
+                length, = struct.unpack(">Q", stream.read(8))
+                source = stream
+            elif kind == b"E":
+                break
+            else:
+                raise IOError("Malformed delta")
+            while length:
+                data = source.read(min(length, 1048576))
+                if not data:
+                    raise IOError("Truncated delta")
+                new.write(data)
+                digest.update(data)
+                length -= len(data)
+    finally:
+        new.close()
+        old.close()
+    for command, value in (("chmod", MODE), ("chown", OWNER)):
+        if value:
+            subprocess.check_call([command, value, tmp])
+    new = open(tmp, "rb")
+    target = open(path, "wb")
+    try:
+        while True:
+            data = new.read(1048576)
+            if not data:
+                break
+            target.write(data)
+        target.flush()
+        os.fsync(target.fileno())
+    finally:
+        target.close()
+        new.close()
+    for command, value in (("chmod", MODE), ("chown", OWNER)):
+        if value:
+            subprocess.check_call([command, value, path])
+finally:
+    os.unlink(tmp)
+sys.stdout.write(digest.hexdigest() + "\\n")
+"""
+
+def _remote_python_command(python, script, **params):
+    """
+    Build a command line running script under the remote python with the
+    given module level names defined, leaving stdin free for data.
+    """
+    header = "".join(["%s = %r\n" % item for item in sorted(params.items())])
+    code = base64.b64encode(zlib.compress(header + script))
+    return "%s -c 'import base64, zlib; exec(zlib.decompress(base64.b64decode(\"%s\")))'" % \
+           (python, code)
+
+def delta_blocksize(size):
+    """
+    Pick the delta block size for a file of the given size: roughly its
+    square root, which balances signature size against match granularity.
+    """
+    block_size = int(size ** 0.5) & ~63
+    return max(MIN_DELTA_BLOCKSIZE, min(MAX_DELTA_BLOCKSIZE, block_size))
+
+def _add_op(ops, old_offset, start, length):
+    """
+    Append a copy (old_offset set) or literal (old_offset None) operation,
+    extending the previous one when they are contiguous.
+    """
+    if not length:
+        return
+    if ops:
+        last = ops[-1]
+        if old_offset is None and last[0] is None:
+            last[2] += length
+            return
+        if old_offset is not None and last[0] is not None and last[0] + last[2] == old_offset:
+            last[2] += length
+            return
+    ops.append([old_offset, start, length])
+
+def compute_delta(file_name, remote_size, signature, block_size, max_literal=None):
+    """
+    Diff a local file against the block signature of the remote copy.
+
+    A rolling adler32 is slid over the local file, so blocks are found again
+    even when data was inserted or removed before them.  Unchanged files
+    cost one checksum per block.  Within a changed region the checksum is
+    rolled byte by byte, but only for DELTA_ROLL_BLOCKS block lengths and
+    DELTA_MAX_ROLL_BLOCKS over the whole file; beyond that the region is
+    stepped through a block at a time.  Larger shifts are then missed, but
+    a rewritten file costs about one checksum per block, like an unchanged
+    one, before max_literal gives up on it.
+
+    @type remote_size: int
+    @param remote_size: the size of the remote copy
+
+    @type signature: list
+    @param signature: (adler32, sha1 hexdigest) for each block of the remote
+    copy, the last one may be short
+
+    @type max_literal: int
+    @param max_literal: give up once more than this many bytes must be sent
+    literally
+
+    @return: the delta stream understood by the remote apply script and the
+    number of literal bytes in it, or None if max_literal was exceeded
+    """
+    table = {}
+    tail = None
+    for index, (weak, strong) in enumerate(signature):
+        offset = index * block_size
+        if offset + block_size > remote_size:
+            tail = (offset, remote_size - offset, weak, strong)
+        else:
+            table.setdefault(weak, {}).setdefault(strong, offset)
+
+    size = os.path.getsize(file_name)
+    ops = []
+    f = open(file_name, "rb")
+    try:
+        data = ""
+        if size:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start = 0
+            weak = None
+            region_roll = DELTA_ROLL_BLOCKS * block_size
+            roll_budget = DELTA_MAX_ROLL_BLOCKS * block_size
+            while pos + block_size <= size:
+                if weak is None:
+                    weak = zlib.adler32(data[pos:pos + block_size]) & 0xffffffff
+                    low, high = weak & 0xffff, weak >> 16
+                candidates = table.get(weak)
+                if candidates:
+                    match = candidates.get(hashlib.sha1(data[pos:pos + block_size]).hexdigest())
+                    if match is not None:
+                        _add_op(ops, None, start, pos - start)
+                        _add_op(ops, match, pos, block_size)
+                        pos = start = pos + block_size
+                        weak = None
+                        continue
+                if pos + block_size == size:
+                    break
+                if max_literal is not None and pos - start > max_literal:
+                    return None
+                if pos - start >= region_roll or not roll_budget:
+                    pos = min(pos + block_size, size - block_size)
+                    weak = None
+                    continue
+                roll_budget -= 1
+                out_byte = ord(data[pos])
+                low = (low - out_byte + ord(data[pos + block_size])) % 65521
+                high = (high - block_size * out_byte + low - 1) % 65521
+                weak = (high << 16) | low
+                pos += 1
+
+            if tail is not None:
+                offset, length, weak, strong = tail
+                end = data[size - length:size]
+                if size - length >= start and zlib.adler32(end) & 0xffffffff == weak and \
+                   hashlib.sha1(end).hexdigest() == strong:
+                    _add_op(ops, None, start, size - length - start)
+                    _add_op(ops, offset, size - length, length)
+                    start = size
+            _add_op(ops, None, start, size - start)
+
+            literal = sum([length for old_offset, _, length in ops if old_offset is None])
+            if max_literal is not None and literal > max_literal:
+                return None
+            stream = []
+            for old_offset, start, length in ops:
+                if old_offset is None:
+                    stream.append(_DELTA_LITERAL.pack("L", length))
+                    stream.append(data[start:start + length])
+                else:
+                    stream.append(_DELTA_COPY.pack("C", old_offset, length))
+            stream.append("E")
+            return "".join(stream), literal
+        finally:
+            if size:
+                data.close()
+    finally:
+        f.close()
+
 class SCPError(Exception): pass
 
 class Scp(object):
@@ -21,7 +272,22 @@ class Scp(object):
         if not os.path.exists(source):
             raise IOError("Source file not found (%s)" % source)
 
-    def scp(self, source, dest_path, mode, erase_owner=False, do_checksum=True, configfile=None):
+    def connect(self, configfile=None):
+        # the copy and its follow up commands share one multiplexed connection
+        return SSHConnection(self.host, login=self.user, port=self.port, configfile=configfile,
+                             identity_file=self.ssh_key, persist=True)
+
+    def scp(self, source, dest_path, mode, erase_owner=False, do_checksum=True, configfile=None,
+            delta=False, block_size=None, remote_python=REMOTE_PYTHON):
+        """
+        Copy source to dest_path on the remote host.
+
+        With delta set, the remote copy of the file is diffed block by block
+        against the source and only the changed blocks are sent, in the
+        manner of rsync.  The full file is copied instead when there is no
+        remote copy, remote_python can not be run, or more than half of the
+        file changed.
+        """
         try:
             # Check to see if the source exists, raises ERROR_FILE_NOT_FOUND
             self.source_exists(source)
@@ -30,40 +296,82 @@ class Scp(object):
             sha256_checksum = checksum(source)
 
             # set up the ssh connection
-            conn = SSHConnection(self.host, login=self.user, port=self.port, configfile=configfile,
-                                 identity_file=self.ssh_key)
+            conn = self.connect(configfile)
+            try:
+                if erase_owner:
+                    owner = None
+                else:
+                    owner = self.user
 
-            # scp the file
-            if erase_owner:
-                owner = None
-            else:
-                owner = self.user
-            conn.scp((source, ), target=dest_path, mode=mode, owner=owner)
-
-            if do_checksum:
-                # Now get the sha256 checksum of the remote file
-                checksum_path = dest_path
-                command = "if [ -d \"%s\" ]; then echo 'ISDIR'; else echo 'ISFILE'; fi" % dest_path
-                ret = conn.run(command)
-                try:
-                    is_dir = ret.stdout.split()[0]
-                    if is_dir.lower() == 'isdir':
-                        checksum_path = "%s/%s" % (dest_path, os.path.basename(source))
-                except IndexError:
-                    raise SSHError("SCP failed:\n  Command: %s\n  stdout: %s\n  stderr: %s" % \
-                                   (command, ret.stdout, ret.stderr))
-
-                command = "/usr/bin/sha256sum %s" % checksum_path
-                ret = conn.run(command)
-                try:
-                    # the shell utility return the checksum + the file path, we only want the checksum
-                    remote_checksum = ret.stdout.split()[0]
+                if delta:
+                    remote_checksum = self.delta_scp(conn, source, dest_path, mode, owner,
+                                                     block_size, remote_python)
+                    if remote_checksum is not None:
+                        if do_checksum and sha256_checksum != remote_checksum:
+                            raise SSHError("Checksums do not match.")
+                        return
+
+                # scp the file, setting its mode and owner and getting the
+                # sha256 checksum of the remote copy in the same round trip
+                results = conn.scp((source, ), target=dest_path, mode=mode, owner=owner,
+                                   checksum=do_checksum and "sha256" or None)
+
+                if do_checksum:
+                    remote_checksum = results[0].checksum
+                    if remote_checksum is None:
+                        raise SSHError("SCP failed: could not checksum %s" % results[0].path)
                     if sha256_checksum != remote_checksum:
                         raise SSHError("Checksums do not match.")
-                except IndexError:
-                    raise SSHError("SCP failed:\n  Command: %s\n  stdout: %s\n  stderr: %s" % \
-                                   (command, ret.stdout, ret.stderr))
+            finally:
+                conn.close()
 
         except SSHError, ssh_e:
             raise SCPError("SCP failed: %s" % str(ssh_e))
 
+    def delta_scp(self, conn, source, dest_path, mode, owner, block_size=None,
+                  remote_python=REMOTE_PYTHON):
+        """
+        Update the remote copy of source by sending only the changed blocks.
+
+        @return: the sha256 checksum of the updated remote file, or None if
+        a full copy is needed instead
+
+        @raise SSHError: if applying the delta on the remote host fails
+        """
+        size = os.path.getsize(source)
+        if not block_size:
+            block_size = delta_blocksize(size)
+        params = dict(TARGET=base64.b64encode(dest_path),
+                      NAME=base64.b64encode(os.path.basename(source)))
+
+        command = _remote_python_command(remote_python, _SIGNATURE_SCRIPT,
+                                         BLOCKSIZE=int(block_size), **params)
+        ret = conn.run("", interpreter=command)
+        lines = ret.stdout.splitlines()
+        if ret.returncode or not lines or not lines[0].startswith("FILE "):
+            return None
+        try:
+            remote_size = int(lines[0].split()[1])
+            signature = [(int(weak), strong) for weak, strong in
+                         [line.split() for line in lines[1:]]]
+        except ValueError:
+            return None
+
+        delta = compute_delta(source, remote_size, signature, block_size, max_literal=size // 2)
+        if delta is None:
+            return None
+
+        if mode:
+            mode = str(mode)
+            if not _CHMOD_MODE.match(mode):
+                return None  # let the full copy report the bad mode
+        command = _remote_python_command(remote_python, _APPLY_SCRIPT,
+                                         MODE=mode, OWNER=owner, **params)
+        ret = conn.run(delta[0], interpreter=command)
+        try:
+            if ret.returncode:
+                raise IndexError
+            return ret.stdout.split()[0]
+        except IndexError:
+            raise SSHError("Delta transfer failed:\n  stdout: %s\n  stderr: %s" % \
+                           (ret.stdout, ret.stderr))
@@ -20,69 +20,124 @@ pssh:
   inline: False         # for pssh
   inline_stdout: False  # for pssh
   remote: /tmp/command
-
+  capture: files        # files, rotate or multiplex, see capture
+  capture_file: /tmp/output/pssh.mux   # for multiplex
+  max_output_bytes: 10485760           # for rotate
+  output_backups: 1                    # for rotate
+  tail_bytes: 65536     # output kept in memory per host, all if not set
+  adaptive: False       # adapt the workers up to parallel_workers, see scheduler
+  min_workers: 4                       # for adaptive
+  latency_history: /var/tmp/pssh.json  # for adaptive
+  speculative: False    # second attempts for stragglers, for adaptive
+  speculative_factor: 2                # for speculative
+  relay_fanout: 0       # fan out through relays above this many hosts, see relay
+  relay_python: python                 # for relay_fanout
+  transport: ssh        # program, or list of arguments, used instead of ssh
+
+host_files may also be a list of files. The hosts are run by the native
+executor in manager, so psshlib is not needed; askpass is accepted for
+compatibility but ignored, since the ssh children run without a terminal.
 """
 
 import os
 
-from psshlib import psshutil
-from psshlib.manager import Manager, FatalError
-from psshlib.task import Task
+from hosts import read_host_files
+from manager import Manager, FatalError, Task
+from relay import run_tree
 
 class PSSHOptions(object):
-    def __init__(self, config, section):
-        self.par = config["parallel_workers"]
-        self.timeout = config["timeout"]
-        self.askpass = config["askpass"]
-        self.outdir = config["output_directory"]
-        self.errdir = config["error_directory"]
-        self.user = config["username"]
+    def __init__(self, config, section=None):
+        if section:
+            config = config[section]
+        self.config = config
+        self.par = config.get("parallel_workers", 32)
+        self.timeout = config.get("timeout", 0)
+        self.askpass = config.get("askpass", False)
+        self.outdir = config.get("output_directory")
+        self.errdir = config.get("error_directory")
+        self.user = config.get("username")
         self.host_files = config["host_files"]
-
-        self.verbose = False
-        self.print_out = False
-        self.inline = False
-        self.inline_stdout = False
-        self.recursive = False
-
-        self.verbose = config["verbose"]
-        self.print_out = config["print_out"]
-        if config["inline"]: self.inline = config["inline"]
-        if config["inline_stdout"]: self.inline_stdout = config["inline_stdout"]
-        if config["recursive"]: self.recursive = config["recursive"]
-        if config["remote"]: self.remote = config["remote"]
+        if isinstance(self.host_files, basestring):
+            self.host_files = [self.host_files]
+
+        self.verbose = config.get("verbose") or False
+        self.print_out = config.get("print_out") or False
+        self.inline = config.get("inline") or False
+        self.inline_stdout = config.get("inline_stdout") or False
+        self.recursive = config.get("recursive") or False
+        self.remote = config.get("remote")
+
+        self.capture = config.get("capture") or "files"
+        self.capture_file = config.get("capture_file")
+        if self.capture == "multiplex" and not self.capture_file and self.outdir:
+            self.capture_file = os.path.join(self.outdir, "pssh.mux")
+        self.max_output_bytes = config.get("max_output_bytes")
+        self.output_backups = config.get("output_backups", 1)
+        self.tail_bytes = config.get("tail_bytes")
+
+        self.adaptive = config.get("adaptive") or False
+        self.min_workers = config.get("min_workers", 4)
+        self.latency_history = config.get("latency_history")
+        self.speculative = config.get("speculative") or False
+        self.speculative_factor = config.get("speculative_factor", 2)
+
+        self.relay_fanout = config.get("relay_fanout") or 0
+        self.relay_python = config.get("relay_python") or "python"
+        self.transport = config.get("transport") or "ssh"
+        if isinstance(self.transport, basestring):
+            self.transport = [self.transport]
 
         if self.outdir and not os.path.exists(self.outdir):
             os.makedirs(self.outdir)
         if self.errdir and not os.path.exists(self.errdir):
             os.makedirs(self.errdir)
 
-def do_pssh(cmdline, pssh_config):
-    rtn_code = 0
+def ssh_command(host, port, user, cmdline, options, forward_agent=False):
+    cmd = list(options.transport) + [host, '-o', 'NumberOfPasswordPrompts=1',
+            '-o', 'SendEnv=PSSH_NODENUM PSSH_HOST']
+    if forward_agent:
+        cmd.append('-A')
+    if user:
+        cmd += ['-l', user]
+    if port:
+        cmd += ['-p', port]
 
-    options = PSSHOptions(pssh_config)
-    hosts = psshutil.read_host_files(options.host_files, default_user='root')
-    manager = Manager(options)
+    if cmdline:
+        cmd.append(cmdline)
+    return cmd
+
+def run_pssh(hosts, cmdline, options):
+    """
+    Run cmdline on hosts, through relays if there are more than
+    options.relay_fanout of them.
+
+    @type hosts: list
+    @param hosts: (host, port, user) tuples
+
+    @return: list of exit statuses, in the order of hosts
 
+    @raise FatalError: if no ssh can be started
+    """
+    if options.relay_fanout and len(hosts) > options.relay_fanout:
+        return run_tree(hosts, cmdline, options)
+
+    manager = Manager(options)
     for host, port, user in hosts:
-        cmd = ['ssh', host, '-o', 'NumberOfPasswordPrompts=1',
-                '-o', 'SendEnv=PSSH_NODENUM PSSH_HOST']
-        if user:
-            cmd += ['-l', user]
-        if port:
-            cmd += ['-p', port]
+        cmd = ssh_command(host, port, user, cmdline, options)
+        manager.add_task(Task(host, port, user, cmd, options))
+    return manager.run()
 
-        if cmdline:
-            cmd.append(cmdline)
+def do_pssh(cmdline, pssh_config):
+    rtn_code = 0
 
-        t = Task(host, port, user, cmd, options)
-        manager.add_task(t)
+    options = PSSHOptions(pssh_config)
+    hosts = read_host_files(options.host_files, default_user=options.user or 'root')
     try:
-        statuses = manager.run()
+        statuses = run_pssh(hosts, cmdline, options)
     except FatalError:
-        rtn_code = 1
+        return 1
 
-    if min(statuses) < 0:
+    if statuses and min(statuses) < 0:
         # At least one process was killed.
         rtn_code = 3
 
@@ -100,7 +155,7 @@ def do_pscp(pssh_config):
     rtn_code = 0
 
     options = PSSHOptions(pssh_config)
-    hosts = psshutil.read_host_files(options.host_files, default_user='root')
+    hosts = read_host_files(options.host_files, default_user=options.user or 'root')
 
     manager = Manager(options)
     for host, port, user in hosts:
@@ -119,9 +174,9 @@ def do_pscp(pssh_config):
     try:
         statuses = manager.run()
     except FatalError:
-        rtn_code = 1
+        return 1
 
-    if min(statuses) < 0:
+    if statuses and min(statuses) < 0:
         # At least one process was killed.
         rtn_code = 3
 
@@ -0,0 +1,264 @@
+"""
+Output capture for pssh_interface.
+
+Each host's stdout and stderr are streamed to disk as they are read, in
+one of the capture modes:
+
+  files       one file per host in output_directory / error_directory
+  rotate      the same files, rotated to .1, .2, ... every max_output_bytes
+  multiplex   a single capture_file of length prefixed records for all hosts
+
+Independently of the mode, a bounded tail of each stream (tail_bytes) is
+kept in memory for the inline output and summaries.
+
+A multiplexed file is a sequence of records, each a header packed as
+MUX_HEADER (host name length, stream, data length) followed by the host
+name and the data. The last record of a host is a MUX_EXIT record whose
+data is its exit status. Use read_multiplexed or demultiplex to read it.
+"""
+import os
+import struct
+from collections import deque
+
+CAPTURE_MODES = ("files", "rotate", "multiplex")
+
+MUX_HEADER = struct.Struct("!HBI")
+MUX_EXIT = 0
+MUX_STREAMS = {"stdout": 1, "stderr": 2}
+MUX_NAMES = {MUX_EXIT: "exit", 1: "stdout", 2: "stderr"}
+
+class CaptureError(Exception): pass
+
+class TailBuffer(object):
+    """
+    Keeps the last limit bytes written to it, or everything if limit is
+    None.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.size = 0
+        self.total = 0
+        self.chunks = deque()
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        self.total += len(data)
+        if self.limit is None:
+            return
+        while self.size - len(self.chunks[0]) >= self.limit:
+            self.size -= len(self.chunks.popleft())
+        if self.size > self.limit:
+            # cut the oldest chunk rather than keep up to a whole chunk extra
+            extra = self.size - self.limit
+            self.chunks[0] = self.chunks[0][extra:]
+            self.size -= extra
+
+    @property
+    def truncated(self):
+        return self.total > self.size
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+class RotatingFile(object):
+    """
+    File which is renamed to path.1 (and path.1 to path.2 and so on, up to
+    backups files) once writing to it would grow it past max_bytes.
+    """
+    def __init__(self, path, max_bytes, backups=1):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.size = 0
+        self.stream = open(path, "w")
+
+    def write(self, data):
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.stream.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.stream.close()
+        if self.backups > 0:
+            for n in range(self.backups - 1, 0, -1):
+                source = "%s.%d" % (self.path, n)
+                if os.path.exists(source):
+                    os.rename(source, "%s.%d" % (self.path, n + 1))
+            os.rename(self.path, self.path + ".1")
+        self.stream = open(self.path, "w")
+        self.size = 0
+
+    def close(self):
+        self.stream.close()
+
+class MultiplexWriter(object):
+    """
+    Writes the output of all hosts to one file, see the module docstring
+    for the format. path may also be an open stream, such as the stdout of
+    a relay, which is then flushed after every record.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.flush = hasattr(path, "write")
+        if self.flush:
+            self.stream = path
+        else:
+            self.stream = open(path, "wb")
+
+    def write(self, host, stream, data):
+        self.stream.write(MUX_HEADER.pack(len(host), stream, len(data)) + host + data)
+        if self.flush:
+            self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+class _MultiplexStream(object):
+    # file-like view of one stream of one host in a MultiplexWriter
+    def __init__(self, writer, host, stream):
+        self.writer = writer
+        self.host = host
+        self.stream = stream
+
+    def write(self, data):
+        self.writer.write(self.host, self.stream, data)
+
+    def close(self):
+        pass
+
+class HostOutput(object):
+    """
+    Captured output of one host, as handed out by Capture.open.
+    """
+    def __init__(self, host, writers, tails, multiplex=None):
+        self.host = host
+        self.writers = writers
+        self.tails = tails
+        self.multiplex = multiplex
+
+    def write(self, name, data):
+        if name in self.writers:
+            self.writers[name].write(data)
+        if name in self.tails:
+            self.tails[name].write(data)
+
+    def tail(self, name):
+        """
+        @return: the part of the stream kept in memory, "" if none is kept
+        """
+        if name in self.tails:
+            return self.tails[name].getvalue()
+        return ""
+
+    def close(self, status=None):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        if self.multiplex is not None and status is not None:
+            self.multiplex.write(self.host, MUX_EXIT, str(status))
+
+class Capture(object):
+    """
+    Hands out the HostOutput of every task of a run according to the
+    capture options (capture, capture_file, max_output_bytes,
+    output_backups, tail_bytes, inline and inline_stdout).
+    """
+    def __init__(self, opts):
+        self.opts = opts
+        self.mode = getattr(opts, "capture", None) or "files"
+        if self.mode not in CAPTURE_MODES:
+            raise CaptureError("Unknown capture mode: %s" % self.mode)
+        self.tail_bytes = getattr(opts, "tail_bytes", None) or None
+        self.multiplex = None
+        if self.mode == "multiplex":
+            if not opts.capture_file:
+                raise CaptureError("capture multiplex needs capture_file")
+            self.multiplex = MultiplexWriter(opts.capture_file)
+        elif self.mode == "rotate" and not opts.max_output_bytes:
+            raise CaptureError("capture rotate needs max_output_bytes")
+
+    def open(self, host):
+        """
+        @type host: string
+        @param host: the host name, also the name of its output files
+
+        @return: HostOutput
+        """
+        writers = {}
+        for name, directory in (("stdout", self.opts.outdir), ("stderr", self.opts.errdir)):
+            if self.multiplex is not None:
+                writers[name] = _MultiplexStream(self.multiplex, host, MUX_STREAMS[name])
+            elif not directory:
+                continue
+            elif self.mode == "rotate":
+                writers[name] = RotatingFile(os.path.join(directory, host),
+                                             self.opts.max_output_bytes,
+                                             self.opts.output_backups)
+            else:
+                writers[name] = open(os.path.join(directory, host), "w")
+
+        tails = {}
+        for name in ("stdout", "stderr"):
+            inline = self.opts.inline or (self.opts.inline_stdout and name == "stdout")
+            if inline or self.tail_bytes:
+                tails[name] = TailBuffer(self.tail_bytes)
+        return HostOutput(host, writers, tails, self.multiplex)
+
+    def close(self):
+        if self.multiplex is not None:
+            self.multiplex.close()
+
+def read_multiplexed(path):
+    """
+    Read a multiplexed capture file.
+
+    @return: generator of (host, stream, data) tuples in file order, stream
+    being "stdout", "stderr" or "exit"
+
+    @raise CaptureError: if the file ends within a record
+    """
+    mux = open(path, "rb")
+    try:
+        while True:
+            header = mux.read(MUX_HEADER.size)
+            if not header:
+                return
+            if len(header) < MUX_HEADER.size:
+                raise CaptureError("Truncated record in %s" % path)
+            host_size, stream, size = MUX_HEADER.unpack(header)
+            host = mux.read(host_size)
+            data = mux.read(size)
+            if len(host) < host_size or len(data) < size:
+                raise CaptureError("Truncated record in %s" % path)
+            yield host, MUX_NAMES.get(stream, stream), data
+    finally:
+        mux.close()
+
+def demultiplex(path, outdir, errdir=None):
+    """
+    Split a multiplexed capture file into per host files, as the files
+    capture mode would have written them.
+
+    @return: dictionary of host to exit status, for the hosts which finished
+    """
+    statuses = {}
+    files = {}
+    directories = {"stdout": outdir, "stderr": errdir or outdir}
+    try:
+        for host, stream, data in read_multiplexed(path):
+            if stream == "exit":
+                statuses[host] = int(data)
+                continue
+            key = (host, stream)
+            if key not in files:
+                name = host
+                if directories["stdout"] == directories["stderr"] and stream == "stderr":
+                    name += ".err"
+                files[key] = open(os.path.join(directories[stream], name), "w")
+            files[key].write(data)
+    finally:
+        for output in files.values():
+            output.close()
+    return statuses
@@ -0,0 +1,61 @@
+"""
+Reading of pssh host files.
+
+Each line names one host as "[user@]host[:port] [user]". Blank lines and
+lines starting with "#" are ignored.
+"""
+
+class HostFileError(Exception): pass
+
+def parse_host_entry(line, default_user=None, default_port=None):
+    """
+    Parse one host file line.
+
+    @return: tuple (host, port, user), or None for blank and comment lines
+
+    @raise HostFileError: if the line is malformed
+    """
+    line = line.split('#', 1)[0].strip()
+    if not line:
+        return None
+    fields = line.split()
+    if len(fields) > 2:
+        raise HostFileError("Bad host line: %r" % line)
+
+    host = fields[0]
+    user = default_user
+    port = default_port
+    if '@' in host:
+        user, host = host.split('@', 1)
+    if host.count(':') == 1:
+        host, port = host.split(':')
+    if len(fields) == 2:
+        user = fields[1]
+    if not host:
+        raise HostFileError("Bad host line: %r" % line)
+    return host, port, user
+
+def read_host_files(paths, default_user=None, default_port=None):
+    """
+    Read hosts from one host file or a list of them.
+
+    @return: list of (host, port, user) tuples in file order
+
+    @raise HostFileError: if a file can not be read or has a malformed line
+    """
+    if isinstance(paths, basestring):
+        paths = [paths]
+    hosts = []
+    for path in paths:
+        try:
+            host_file = open(path)
+        except IOError, ex:
+            raise HostFileError("Could not open host file %s: %s" % (path, ex))
+        try:
+            for line in host_file:
+                entry = parse_host_entry(line, default_user, default_port)
+                if entry:
+                    hosts.append(entry)
+        finally:
+            host_file.close()
+    return hosts
@@ -0,0 +1,551 @@
+"""
+Native parallel process manager for pssh_interface, standing in for the
+Manager and Task classes of psshlib.
+
+Up to opts.par children run at a time. Their stdout and stderr are read,
+and a string stdin is written to them, from a single poll loop (epoll or
+poll where available, select otherwise), timeouts are tracked in a heap, and finished children are reaped as their
+pipes close, so the cost per host does not grow with the number of hosts
+running. Output is captured as configured in capture.
+"""
+import errno
+import fcntl
+import heapq
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+from collections import deque
+
+from capture import Capture
+from scheduler import AdaptiveScheduler
+
+READ_SIZE = 65536
+WRITE_SIZE = 65536
+
+class FatalError(Exception): pass
+
+def _set_cloexec(fd):
+    # so children started later do not inherit the pipes of earlier ones
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class Poller(object):
+    """
+    Wait for file descriptors to become readable, or writable for those
+    registered with write set.
+    """
+    def __init__(self):
+        self._fds = set()
+        self._write_fds = set()
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._events = select.EPOLLIN | select.EPOLLPRI | select.EPOLLHUP | select.EPOLLERR
+            self._write_events = select.EPOLLOUT | select.EPOLLERR
+            self._scale = 1.0
+        elif hasattr(select, "poll"):
+            self._poller = select.poll()
+            self._events = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+            self._write_events = select.POLLOUT | select.POLLERR
+            self._scale = 1000.0
+        else:
+            self._poller = None
+
+    def register(self, fd, write=False):
+        if write:
+            self._write_fds.add(fd)
+        else:
+            self._fds.add(fd)
+        if self._poller is not None:
+            self._poller.register(fd, write and self._write_events or self._events)
+
+    def unregister(self, fd):
+        self._fds.discard(fd)
+        self._write_fds.discard(fd)
+        if self._poller is not None:
+            self._poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        """
+        @type timeout: float
+        @param timeout: seconds to wait at most, None to wait indefinitely
+
+        @return: list of ready file descriptors
+        """
+        try:
+            if self._poller is None:
+                if not self._fds and not self._write_fds:
+                    time.sleep(timeout or 0)
+                    return []
+                readable, writable, _ = select.select(list(self._fds), list(self._write_fds),
+                                                      [], timeout)
+                return readable + writable
+            if timeout is None:
+                timeout = -1
+            else:
+                timeout = timeout * self._scale
+                if self._scale > 1:
+                    timeout = int(timeout) + 1
+            return [fd for fd, _ in self._poller.poll(timeout)]
+        except (select.error, IOError, OSError), ex:
+            if ex.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if self._poller is not None and hasattr(self._poller, "close"):
+            self._poller.close()
+
+class Task(object):
+    """
+    One host of a pssh run: cmd is run for host and its output captured
+    (see capture.Capture), printed line by line (opts.print_out) or printed
+    after it finished (opts.inline and opts.inline_stdout). stdin is a
+    string or an open file to feed the child, /dev/null if None.
+    """
+    def __init__(self, host, port, user, cmd, opts, stdin=None):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.cmd = cmd
+        self.opts = opts
+        self.stdin = stdin
+
+        if port:
+            self.pretty_host = "%s:%s" % (host, port)
+        else:
+            self.pretty_host = host
+
+        self.exitstatus = None
+        self.failures = []
+        self.proc = None
+        self.started = None
+        self.deadline = None
+        self.streams = {}
+        self.input_fd = None
+        self.written = 0
+        self.output = None
+        self.partial = {"stdout": "", "stderr": ""}
+
+        # speculative attempts of the same host share the first one as primary
+        self.attempt = 0
+        self.primary = self
+        self.attempts = [self]
+        self.result = None
+        self.superseded = False
+
+    def clone(self):
+        """
+        @return: a new attempt of this task's host, not started yet; it is
+        added to the attempts of the host once it was started
+        """
+        primary = self.primary
+        task = Task(primary.host, primary.port, primary.user, primary.cmd,
+                    primary.opts, primary.stdin)
+        task.attempt = len(primary.attempts)
+        task.primary = primary
+        return task
+
+    @property
+    def output_name(self):
+        if self.attempt:
+            return "%s.%d" % (self.pretty_host, self.attempt)
+        return self.pretty_host
+
+    def start(self, nodenum, capture):
+        """
+        Start the child process, capturing its output with capture. A
+        string stdin is left in input_fd, to be written with write_input.
+
+        @return: the file descriptors to read its stdout and stderr from
+        """
+        env = dict(os.environ)
+        env["PSSH_NODENUM"] = str(nodenum)
+        env["PSSH_HOST"] = self.host
+
+        # the output is opened first: a child whose output can not be opened
+        # must not be started, or it would run again when the task is retried
+        self.output = capture.open(self.output_name)
+        stdin = self.stdin
+        try:
+            if stdin is None:
+                stdin = open(os.devnull)
+            elif not hasattr(stdin, "fileno"):
+                stdin = subprocess.PIPE
+            self.proc = subprocess.Popen(self.cmd, stdin=stdin,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                         env=env)
+        except:
+            self.output.close()
+            self.output = None
+            raise
+        finally:
+            if self.stdin is None and stdin is not None:
+                stdin.close()
+        try:
+            if stdin is subprocess.PIPE:
+                # written as the child reads it, so that one slow reader does
+                # not block the loop which serves every host
+                self.written = 0
+                if self.stdin:
+                    self.input_fd = self.proc.stdin.fileno()
+                    _set_nonblocking(self.input_fd)
+                    _set_cloexec(self.input_fd)
+                else:
+                    self.proc.stdin.close()
+            self.streams = {self.proc.stdout.fileno(): "stdout",
+                            self.proc.stderr.fileno(): "stderr"}
+            for fd in self.streams:
+                _set_cloexec(fd)
+        except:
+            self.abort()
+            raise
+        self.started = time.time()
+        if self.opts.timeout:
+            self.deadline = self.started + self.opts.timeout
+        return list(self.streams)
+
+    def handle_read(self, fd, data):
+        """
+        Dispatch a chunk read from one of the child's pipes.
+        """
+        self.handle_output(self.streams[fd], data)
+
+    def handle_output(self, name, data):
+        """
+        Capture and print a chunk of the "stdout" or "stderr" of the task.
+        """
+        self.output.write(name, data)
+        if self.opts.print_out:
+            lines = (self.partial[name] + data).split("\n")
+            self.partial[name] = lines.pop()
+            for line in lines:
+                sys.stdout.write("%s: %s\n" % (self.host, line))
+
+    def write_input(self):
+        """
+        Write the next chunk of a string stdin to the child, closing its
+        stdin once all of it was written or the child closed it.
+
+        @return: True if stdin was closed
+        """
+        try:
+            self.written += os.write(self.input_fd,
+                                     buffer(self.stdin, self.written, WRITE_SIZE))
+        except OSError, ex:
+            if ex.errno in (errno.EINTR, errno.EAGAIN):
+                return False
+            if ex.errno != errno.EPIPE:
+                raise
+            self.written = len(self.stdin)  # the child does not want the rest
+        if self.written < len(self.stdin):
+            return False
+        self.close_input()
+        return True
+
+    def close_input(self):
+        """
+        Close the child's stdin, if it is still being written.
+        """
+        if self.input_fd is not None:
+            self.input_fd = None
+            self.proc.stdin.close()
+
+    def close_stream(self, fd):
+        """
+        Close one of the child's pipes once it reached the end.
+
+        @return: True if no pipe is left open
+        """
+        name = self.streams.pop(fd)
+        if self.opts.print_out and self.partial[name]:
+            sys.stdout.write("%s: %s\n" % (self.host, self.partial[name]))
+            self.partial[name] = ""
+        getattr(self.proc, name).close()
+        return not self.streams
+
+    def abort(self):
+        """
+        Kill and reap a child which could not be set up, and close its
+        pipes and output, so that the task can be started again.
+        """
+        try:
+            os.kill(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            if pipe is not None:
+                pipe.close()
+        self.proc = None
+        self.streams = {}
+        self.input_fd = None
+        self.output.close()
+        self.output = None
+
+    def kill(self, reason="Timed out"):
+        """
+        Kill the child, after its timeout by default.
+
+        @return: the file descriptors which were still open
+        """
+        fds = list(self.streams)
+        if self.input_fd is not None:
+            fds.append(self.input_fd)
+        try:
+            os.kill(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.close_input()
+        for fd in list(self.streams):
+            self.close_stream(fd)
+        self.failures.append(reason)
+        return fds
+
+    def tail(self, name):
+        """
+        @return: the end of the stdout or stderr of the task kept in memory
+        """
+        if self.output is None:
+            return ""
+        return self.output.tail(name)
+
+    def finish(self, status):
+        """
+        Record the exit status of the reaped child and close its output.
+        """
+        self.exitstatus = status
+        if status < 0:
+            self.failures.append("Killed by signal %s" % -status)
+        elif status > 0:
+            self.failures.append("Exited with error code %s" % status)
+        self.output.close(status)
+
+    def report(self, n):
+        """
+        Print the status line of the finished task, and its output if the
+        options ask for it inline.
+        """
+        tstamp = time.asctime().split()[3]
+        if self.failures:
+            sys.stdout.write("[%s] %s [FAILURE] %s %s\n" % (
+                n, tstamp, self.pretty_host, ", ".join(self.failures)))
+        else:
+            sys.stdout.write("[%s] %s [SUCCESS] %s\n" % (n, tstamp, self.pretty_host))
+        if self.opts.inline or self.opts.inline_stdout:
+            stdout = self.tail("stdout")
+            if stdout:
+                sys.stdout.write(stdout)
+        if self.opts.inline:
+            stderr = self.tail("stderr")
+            if stderr:
+                sys.stdout.write("Stderr: " + stderr)
+        sys.stdout.flush()
+
+class Manager(object):
+    """
+    Runs the added tasks, at most opts.par at a time, each for at most
+    opts.timeout seconds (0 or None for no limit). With opts.adaptive the
+    number running at once, the order and speculative attempts are left
+    to a scheduler.AdaptiveScheduler.
+    """
+    def __init__(self, opts):
+        self.opts = opts
+        self.limit = max(1, int(opts.par or 1))
+        self.scheduler = None
+        if getattr(opts, "adaptive", False):
+            self.scheduler = AdaptiveScheduler.from_options(opts)
+        self.tasks = []
+
+    def add_task(self, task):
+        self.tasks.append(task)
+
+    def run(self):
+        """
+        Run all tasks.
+
+        @return: list of the exit statuses, in the order the tasks were
+        added; negative for children killed by a signal
+
+        @raise FatalError: if no child can be started at all
+        """
+        pending = deque(self.tasks)
+        if self.scheduler:
+            pending = deque(self.scheduler.order(self.tasks))
+        self.active = set()
+        self.readers = {}
+        self.writers = {}
+        self.deadlines = []
+        self.reaping = []
+        self.poller = Poller()
+        self.capture = Capture(self.opts)
+        self.nodenum = 0
+        self.finished = 0
+        try:
+            while pending or self.active:
+                while pending and len(self.active) < self._limit():
+                    if not self._start(pending[0]):
+                        break  # start it once a running task is done
+                    pending.popleft()
+                wakeup = None
+                if self.scheduler and self.scheduler.speculative and not pending:
+                    wakeup = self._speculate()
+
+                timeout = None
+                if self.reaping:
+                    timeout = 0.005
+                if self.deadlines:
+                    wakeup = min(wakeup or self.deadlines[0][0], self.deadlines[0][0])
+                if wakeup is not None:
+                    wait = max(0, wakeup - time.time())
+                    if timeout is None or wait < timeout:
+                        timeout = wait
+
+                for fd in self.poller.poll(timeout):
+                    if fd in self.writers:
+                        if self.writers[fd].write_input():
+                            self.poller.unregister(fd)
+                            del self.writers[fd]
+                        continue
+                    task = self.readers[fd]
+                    try:
+                        data = os.read(fd, READ_SIZE)
+                    except OSError, ex:
+                        if ex.errno in (errno.EINTR, errno.EAGAIN):
+                            continue
+                        raise
+                    if data:
+                        task.handle_read(fd, data)
+                        continue
+                    self.poller.unregister(fd)
+                    del self.readers[fd]
+                    if task.close_stream(fd):
+                        self.reaping.append(task)
+
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    task = heapq.heappop(self.deadlines)[2]
+                    if task in self.active and task.exitstatus is None:
+                        self._kill(task)
+
+                reaping, self.reaping = self.reaping, []
+                for task in reaping:
+                    status = task.proc.poll()
+                    if status is None:
+                        self.reaping.append(task)
+                    else:
+                        self._finish(task, status)
+        finally:
+            for task in self.active:
+                if task.proc.poll() is None:
+                    os.kill(task.proc.pid, signal.SIGKILL)
+                    task.proc.wait()
+            self.poller.close()
+            self.capture.close()
+            if self.scheduler:
+                self.scheduler.close()
+
+        return [task.result.exitstatus for task in self.tasks]
+
+    def _limit(self):
+        if self.scheduler:
+            return self.scheduler.limit
+        return self.limit
+
+    def _start(self, task):
+        """
+        @return: False if the task could not be started for now
+
+        @raise FatalError: if it can not be started at all
+        """
+        try:
+            fds = task.start(self.nodenum, self.capture)
+        except (OSError, IOError), ex:
+            if ex.errno in (errno.EMFILE, errno.ENFILE, errno.EAGAIN) and self.active:
+                return False
+            raise FatalError("Could not start %s: %s" % (task.pretty_host, ex))
+        self.nodenum += 1
+        self.active.add(task)
+        for fd in fds:
+            self.poller.register(fd)
+            self.readers[fd] = task
+        if task.input_fd is not None:
+            self.poller.register(task.input_fd, write=True)
+            self.writers[task.input_fd] = task
+        if task.deadline is not None:
+            heapq.heappush(self.deadlines, (task.deadline, self.nodenum, task))
+        return True
+
+    def _speculate(self):
+        """
+        Start second attempts for stragglers, in the slots no pending host
+        needs.
+
+        @return: the time the next running task becomes a straggler, if any
+        """
+        cutoff = self.scheduler.straggler_cutoff()
+        if cutoff is None:
+            return None
+        now = time.time()
+        wakeup = None
+        for task in list(self.active):
+            if task.attempt or len(task.attempts) > 1:
+                continue
+            due = task.started + cutoff
+            if due > now:
+                wakeup = min(wakeup or due, due)
+                continue
+            if len(self.active) >= self.scheduler.limit:
+                break
+            clone = task.clone()
+            try:
+                if not self._start(clone):
+                    break
+            except FatalError:
+                break  # the first attempt is still running, leave it at that
+            task.attempts.append(clone)
+        return wakeup
+
+    def _kill(self, task, reason="Timed out"):
+        for fd in task.kill(reason):
+            self.poller.unregister(fd)
+            self.readers.pop(fd, None)
+            self.writers.pop(fd, None)
+        if task not in self.reaping:
+            self.reaping.append(task)
+
+    def _finish(self, task, status):
+        """
+        Account the exit of an attempt, and report its host if it was the
+        last one running or the first one to succeed.
+        """
+        if task.input_fd is not None:
+            # exited without reading all of its stdin
+            self.poller.unregister(task.input_fd)
+            del self.writers[task.input_fd]
+            task.close_input()
+        task.finish(status)
+        self.active.discard(task)
+        primary = task.primary
+        if task.superseded or primary.result is not None:
+            return
+        if self.scheduler:
+            self.scheduler.record(task, time.time() - task.started)
+
+        others = [attempt for attempt in primary.attempts
+                  if attempt is not task and attempt.exitstatus is None]
+        if status != 0 and others:
+            return  # wait for the other attempts
+        for attempt in others:
+            attempt.superseded = True
+            if attempt in self.active and attempt.streams:
+                self._kill(attempt, "Superseded")
+        primary.result = task
+        self.finished += 1
+        task.report(self.finished)
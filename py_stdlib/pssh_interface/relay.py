@@ -0,0 +1,251 @@
+"""
+Tree fan-out for pssh_interface.
+
+With relay_fanout set and more hosts than that, do_pssh does not start an
+ssh for every host from the control node. The hosts are split into at most
+relay_fanout partitions and the first host of each partition acts as its
+relay: the control node connects to it, ships this package and the
+partition on stdin, and the relay runs the partition with the same
+executor, relaying again if the partition is still larger than
+relay_fanout. Each relay streams the output and exit status of its hosts
+back as a multiplexed capture (see capture), which the control node
+captures and reports as if it had run the hosts itself.
+
+Relays need relay_python, a python 2 interpreter, and must be able to ssh
+to their partition, for which the relay connections forward the ssh agent.
+Relays have no timeout of their own, their hosts have. The transport
+option replaces ssh, e.g. by a program running the commands locally for
+testing (see benchmarks/pssh_relay.py). Speculative attempts are not made
+on relays, and timed out hosts are reported as killed.
+"""
+import copy
+import itertools
+import json
+import os
+import pipes
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+from cStringIO import StringIO
+
+from capture import MUX_HEADER, MUX_EXIT, MUX_NAMES
+from manager import Manager, Task
+
+BOOTSTRAP = """import os, struct, sys, tempfile
+size = struct.unpack("!I", sys.stdin.read(4))[0]
+fd, path = tempfile.mkstemp(suffix=".zip")
+os.write(fd, sys.stdin.read(size))
+os.close(fd)
+sys.path.insert(0, path)
+try:
+    from pssh_interface import relay
+    relay.main()
+finally:
+    os.unlink(path)
+"""
+
+# options which only matter on the control node
+RELAY_CONFIG = {"output_directory": None, "error_directory": None, "capture": "multiplex",
+                "capture_file": None, "inline": False, "inline_stdout": False,
+                "print_out": False, "tail_bytes": None, "latency_history": None,
+                "speculative": False, "host_files": []}
+
+_archive = None
+
+def _package():
+    # the pssh_interface package, under whichever name it was imported
+    return sys.modules[__name__.rpartition(".")[0]]
+
+def _str(value):
+    # json hands out unicode, which must not mix with the byte records
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_str(key), _str(item)) for key, item in value.items())
+    return value
+
+def package_archive():
+    """
+    @return: zip archive of this package, as shipped to the relays
+    """
+    global _archive
+    loader = globals().get("__loader__")
+    if _archive is None and hasattr(loader, "archive"):
+        # on a relay, running from the archive shipped to it
+        archive = open(loader.archive, "rb")
+        try:
+            _archive = archive.read()
+        finally:
+            archive.close()
+    elif _archive is None:
+        archive = StringIO()
+        package = zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED)
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".py"):
+                package.write(os.path.join(directory, name), "pssh_interface/" + name)
+        package.close()
+        _archive = archive.getvalue()
+    return _archive
+
+def partition(hosts, fanout):
+    """
+    Split hosts into at most fanout contiguous groups of nearly equal size,
+    each of at most fanout hosts if that takes no more than fanout groups.
+
+    @return: list of lists of hosts
+    """
+    fanout = max(2, fanout)
+    count = min(fanout, (len(hosts) + fanout - 1) // fanout)
+    size, extra = divmod(len(hosts), count)
+    groups = []
+    start = 0
+    for n in range(count):
+        end = start + size + (n < extra)
+        groups.append(hosts[start:end])
+        start = end
+    return groups
+
+class RelayTask(Task):
+    """
+    Task running the relay of a partition. The output and exit statuses it
+    streams back are handed to hosts, the tasks of the partition, which are
+    never started themselves; report is called with each of them once it
+    finished.
+    """
+    def __init__(self, relay, hosts, cmd, opts, stdin, report):
+        host, port, user = relay
+        Task.__init__(self, host, port, user, cmd, opts, stdin)
+        self.hosts = hosts
+        self.by_name = dict((task.pretty_host, task) for task in hosts)
+        self.report_host = report
+        self.capture = None
+        self.buffer = ""
+
+    @property
+    def output_name(self):
+        return self.pretty_host + ".relay"
+
+    def start(self, nodenum, capture):
+        self.capture = capture
+        self.stdin.seek(0)  # the job is read from the start again on a retry
+        return Task.start(self, nodenum, capture)
+
+    def handle_read(self, fd, data):
+        if self.streams[fd] != "stdout":
+            return Task.handle_read(self, fd, data)
+        self.buffer += data
+        offset = 0
+        while len(self.buffer) - offset >= MUX_HEADER.size:
+            host_size, stream, size = MUX_HEADER.unpack_from(self.buffer, offset)
+            start = offset + MUX_HEADER.size + host_size
+            if len(self.buffer) < start + size:
+                break
+            host = self.buffer[offset + MUX_HEADER.size:start]
+            self.dispatch(host, stream, self.buffer[start:start + size])
+            offset = start + size
+        self.buffer = self.buffer[offset:]
+
+    def dispatch(self, host, stream, data):
+        """
+        Hand a record streamed back by the relay to its host.
+        """
+        task = self.by_name.get(host)
+        if task is None or task.exitstatus is not None:
+            return
+        if task.output is None:
+            task.output = self.capture.open(task.output_name)
+        if stream == MUX_EXIT:
+            task.finish(int(data))
+            self.report_host(task)
+        else:
+            task.handle_output(MUX_NAMES[stream], data)
+
+    def finish(self, status):
+        """
+        Fail the hosts the relay did not report, then record its own exit.
+        """
+        for task in self.hosts:
+            if task.exitstatus is None:
+                if task.output is None:
+                    task.output = self.capture.open(task.output_name)
+                task.failures.append("Relay %s failed" % self.pretty_host)
+                task.finish(status or 255)
+                self.report_host(task)
+        Task.finish(self, status)
+
+    def report(self, n):
+        if self.failures:
+            sys.stdout.write("[relay] %s [FAILURE] %s %s\n" % (
+                time.asctime().split()[3], self.pretty_host, ", ".join(self.failures)))
+            sys.stdout.flush()
+
+def run_tree(hosts, cmdline, options):
+    """
+    Run cmdline on hosts through relays.
+
+    @type hosts: list
+    @param hosts: (host, port, user) tuples
+
+    @return: list of exit statuses, in the order of hosts
+
+    @raise FatalError: if no relay can be started
+    """
+    package = _package()
+    groups = partition(hosts, options.relay_fanout)
+    config = dict(options.config, **RELAY_CONFIG)
+    bootstrap = "%s -c %s" % (options.relay_python, pipes.quote(BOOTSTRAP))
+    archive = package_archive()
+
+    counter = itertools.count(1)
+    report = lambda task: task.report(counter.next())
+
+    relay_options = copy.copy(options)
+    relay_options.par = len(groups)
+    relay_options.timeout = 0
+    relay_options.adaptive = False
+    manager = Manager(relay_options)
+    results = []
+    stdins = []
+    try:
+        for group in groups:
+            tasks = [Task(host, port, user, package.ssh_command(host, port, user, cmdline, options),
+                          options) for host, port, user in group]
+            results.extend(tasks)
+
+            stdin = tempfile.TemporaryFile()
+            stdins.append(stdin)
+            stdin.write(struct.pack("!I", len(archive)) + archive)
+            json.dump({"config": config, "hosts": group, "cmdline": cmdline}, stdin)
+            stdin.seek(0)
+
+            host, port, user = group[0]
+            cmd = package.ssh_command(host, port, user, bootstrap, options, forward_agent=True)
+            manager.add_task(RelayTask(group[0], tasks, cmd, relay_options, stdin, report))
+        manager.run()
+    finally:
+        for stdin in stdins:
+            stdin.close()
+    return [task.exitstatus for task in results]
+
+def main():
+    """
+    Entry point of a relay, see BOOTSTRAP: runs the partition read from
+    stdin and streams the results to stdout.
+    """
+    job = _str(json.load(sys.stdin))
+    stream = sys.stdout
+    sys.stdout = sys.stderr  # keep the reports out of the results
+
+    package = _package()
+    options = package.PSSHOptions(dict(job["config"], capture_file=stream))
+    hosts = [tuple(host) for host in job["hosts"]]
+    try:
+        package.run_pssh(hosts, job["cmdline"], options)
+    except package.FatalError, ex:
+        sys.stderr.write("%s\n" % ex)
+        sys.exit(1)
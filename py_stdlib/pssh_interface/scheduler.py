@@ -0,0 +1,164 @@
+"""
+Adaptive scheduling for pssh_interface.
+
+With adaptive set, the Manager does not run a fixed parallel_workers hosts
+at a time. It starts with min_workers and lets AdaptiveScheduler adjust
+the number after every host:
+
+  - it grows by one for each host that succeeded in normal time;
+  - it shrinks by one for each host that succeeded but took more than
+    slow_factor times the median duration;
+  - it is halved when more than failure_rate of the recent hosts failed,
+    as refused or timed out connections mostly mean the control node or
+    the targets are overloaded.
+
+The duration of the whole ssh or scp child is the latency measure, since
+the connect time is not visible from outside ssh.
+
+Hosts are started slowest first, by their moving average duration in
+latency_history (a JSON file updated after every run), so the slow ones do
+not start last and set the wall time of the run.
+
+With speculative also set, once every host has been started, a host still
+running after speculative_factor times the median duration gets a second
+attempt. Whichever attempt succeeds first is reported and the other one is
+killed. Only use it with commands which are safe to run twice. The output
+of the second attempt is captured under "<host>.1".
+"""
+import json
+import os
+import warnings
+from collections import deque
+
+class LatencyHistory(object):
+    """
+    Moving average duration of each host over earlier runs, kept in a
+    JSON file.
+    """
+    def __init__(self, path=None, weight=0.3):
+        self.path = path
+        self.weight = weight
+        self.latencies = {}
+        if path and os.path.exists(path):
+            try:
+                history = open(path)
+                try:
+                    self.latencies = dict(json.load(history))
+                finally:
+                    history.close()
+            except (IOError, ValueError, TypeError):
+                self.latencies = {}  # start over rather than fail the run
+
+    def get(self, host, default=None):
+        return self.latencies.get(host, default)
+
+    def update(self, host, latency):
+        previous = self.latencies.get(host)
+        if previous is None:
+            self.latencies[host] = latency
+        else:
+            self.latencies[host] = (1 - self.weight) * previous + self.weight * latency
+
+    def save(self):
+        """
+        Write the history back. It is only a scheduling hint, so failing to
+        write it is warned about rather than raised over the run's results.
+        """
+        if not self.path:
+            return
+        temp = "%s.%d" % (self.path, os.getpid())
+        try:
+            history = open(temp, "w")
+            try:
+                json.dump(self.latencies, history)
+            finally:
+                history.close()
+            os.rename(temp, self.path)
+        except (IOError, OSError), ex:
+            warnings.warn("Could not save latency history %s: %s" % (self.path, ex))
+            if os.path.exists(temp):
+                os.unlink(temp)
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+class AdaptiveScheduler(object):
+    """
+    Decides the order in which hosts start, how many run at once (limit)
+    and which stragglers get a speculative second attempt, see the module
+    docstring.
+    """
+    def __init__(self, max_workers, min_workers=4, history=None, failure_rate=0.5,
+                 window=20, slow_factor=3.0, speculative=False, speculative_factor=2.0,
+                 min_samples=5):
+        self.max_workers = max(1, max_workers)
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.limit = self.min_workers
+        self.history = history or LatencyHistory()
+        self.failure_rate = failure_rate
+        self.slow_factor = slow_factor
+        self.speculative = speculative
+        self.speculative_factor = speculative_factor
+        self.min_samples = min_samples
+        self.outcomes = deque(maxlen=window)
+        self.durations = deque(maxlen=max(window, 100))
+
+    @classmethod
+    def from_options(cls, opts):
+        return cls(int(opts.par or 1),
+                   min_workers=getattr(opts, "min_workers", None) or 4,
+                   history=LatencyHistory(getattr(opts, "latency_history", None)),
+                   speculative=getattr(opts, "speculative", False),
+                   speculative_factor=getattr(opts, "speculative_factor", None) or 2.0)
+
+    def order(self, tasks):
+        """
+        @return: tasks sorted slowest first by their history, hosts without
+        history counting as the median host
+        """
+        known = [self.history.get(task.pretty_host) for task in tasks]
+        default = _median([latency for latency in known if latency is not None]) or 0
+        ranked = sorted(enumerate(tasks), key=lambda (n, task): (
+            -self.history.get(task.pretty_host, default), n))
+        return [task for n, task in ranked]
+
+    def record(self, task, latency):
+        """
+        Account a finished attempt of task which took latency seconds, and
+        adjust the limit.
+        """
+        ok = task.exitstatus == 0
+        self.outcomes.append(ok)
+        self.history.update(task.pretty_host, latency)
+        median = _median(self.durations)
+        if ok:
+            self.durations.append(latency)
+
+        failures = self.outcomes.count(False)
+        if not ok and len(self.outcomes) >= self.min_samples and \
+                failures > self.failure_rate * len(self.outcomes):
+            self.limit = max(self.min_workers, self.limit // 2)
+            self.outcomes.clear()  # judge the new limit on new outcomes only
+        elif ok and median is not None and latency > self.slow_factor * median:
+            self.limit = max(self.min_workers, self.limit - 1)
+        elif ok:
+            self.limit = min(self.max_workers, self.limit + 1)
+
+    def straggler_cutoff(self):
+        """
+        @return: the seconds after which a running host counts as a
+        straggler, None if speculation is off or there are too few samples
+        yet
+        """
+        if not self.speculative or len(self.durations) < self.min_samples:
+            return None
+        return self.speculative_factor * _median(self.durations)
+
+    def close(self):
+        self.history.save()
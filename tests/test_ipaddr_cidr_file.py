@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from py_stdlib.os_utils import ipaddr
+
+
+class LoadCidrFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "feed")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, feed):
+        output = open(self.path, "w")
+        try:
+            output.write(feed)
+        finally:
+            output.close()
+        return ipaddr.load_cidr_file(self.path)
+
+    def test_networks_ending_at_the_last_address_are_cached(self):
+        feed = "10.0.0.0/8\n2001:db8::/32\nffff::/16\n255.255.255.0/24\n"
+        parsed = self.load(feed)
+        self.assertTrue(os.path.exists(self.path + ".ipset"))
+        cached = ipaddr.load_cidr_file(self.path)
+        self.assertEqual([str(n) for n in cached], [str(n) for n in parsed])
+        self.assertEqual([str(n) for n in parsed],
+                         ["10.0.0.0/8", "255.255.255.0/24", "2001:db8::/32", "ffff::/16"])
+
+    def test_whole_address_space_is_cached(self):
+        parsed = self.load("::/0\n")
+        cached = ipaddr.load_cidr_file(self.path)
+        self.assertEqual([str(n) for n in cached], ["::/0"])
+        self.assertEqual([str(n) for n in parsed], ["::/0"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import errno
+import threading
+import unittest
+
+from py_stdlib.os_utils.openssh_wrapper import SSHCluster, SSHError, SSHResult
+
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+
+
+class FakeCluster(SSHCluster):
+    def connect(self, server):
+        return FakeConnection(server)
+
+
+def run_with_timeout(function, timeout=10):
+    """ Run function in a thread, None if it did not return in time. """
+    outcome = []
+    thread = threading.Thread(target=lambda: outcome.append(function()))
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return outcome and outcome[0] or None
+
+
+class SSHClusterTest(unittest.TestCase):
+
+    def test_action_exceptions_become_errors(self):
+        def action(connection):
+            if connection.server == 'h1':
+                raise OSError(errno.EMFILE, 'Too many open files')
+            if connection.server == 'h2':
+                raise ValueError('bad action')
+            return SSHResult('true', '', '', 0)
+
+        cluster = FakeCluster(['h0', 'h1', 'h2', 'h3'], concurrency=2, retries=2, backoff=0.01)
+        results = run_with_timeout(lambda: list(cluster.iter_map(action)))
+        self.assertTrue(results is not None, 'iter_map did not finish')
+        results = dict([(r.server, r) for r in results])
+        self.assertEqual(sorted(results), ['h0', 'h1', 'h2', 'h3'])
+        self.assertTrue(results['h0'].ok and results['h3'].ok)
+        self.assertTrue(isinstance(results['h1'].error, OSError))
+        self.assertTrue(isinstance(results['h2'].error, ValueError))
+        # only ssh errors are retried
+        self.assertEqual(results['h1'].attempts, 1)
+
+    def test_ssh_errors_are_retried(self):
+        def action(connection):
+            raise SSHError('unreachable')
+
+        cluster = FakeCluster(['h0'], retries=2, backoff=0.01)
+        results = run_with_timeout(lambda: list(cluster.iter_map(action)))
+        self.assertEqual(results[0].attempts, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import io
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from py_stdlib.os_utils.openssh_wrapper import SSHConnection
+
+
+class LocalConnection(SSHConnection):
+    """ Connection running the remote command locally, in place of ssh. """
+    def ssh_command(self, interpreter, forward_ssh_agent):
+        return ['/bin/sh', '-c', interpreter]
+
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.target = os.path.join(self.directory, "target")
+        os.mkdir(self.target)
+        self.umask = os.umask(0)
+        self.conn = LocalConnection("localhost")
+
+    def tearDown(self):
+        os.umask(self.umask)
+        shutil.rmtree(self.directory)
+
+    def mode(self, name):
+        return stat.S_IMODE(os.stat(os.path.join(self.target, name)).st_mode)
+
+    def test_unnamed_objects_are_private(self):
+        names = self.conn.upload([io.BytesIO(b"secret")], self.target)
+        self.assertEqual(self.mode(names[0]), 0o600)
+
+    def test_files_keep_their_mode(self):
+        source = os.path.join(self.directory, "script")
+        open(source, "w").close()
+        os.chmod(source, 0o750)
+        source_file = open(source, "rb")
+        try:
+            self.conn.upload([source_file], self.target)
+        finally:
+            source_file.close()
+        self.assertEqual(self.mode("script"), 0o750)
+
+    def test_symbolic_mode_does_not_widen_the_default(self):
+        names = self.conn.upload([io.BytesIO(b"secret")], self.target, mode="u+x")
+        self.assertEqual(self.mode(names[0]), 0o600)
+
+    def test_octal_mode(self):
+        names = self.conn.upload([io.BytesIO(b"data")], self.target, mode="0640")
+        self.assertEqual(self.mode(names[0]), 0o640)
+
+
+if __name__ == "__main__":
+    unittest.main()
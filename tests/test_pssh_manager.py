@@ -0,0 +1,129 @@
+import errno
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import unittest
+from cStringIO import StringIO
+
+from py_stdlib.pssh_interface import manager
+from py_stdlib.pssh_interface.capture import Capture
+from py_stdlib.pssh_interface.manager import Manager, Task
+
+
+class Options(object):
+    par = 2
+    timeout = 0
+    outdir = None
+    errdir = None
+    inline = False
+    inline_stdout = False
+    print_out = False
+
+    def __init__(self, **options):
+        self.__dict__.update(options)
+
+
+class FailingCapture(Capture):
+    """ Capture which fails to open the output of some hosts, as often as
+    failures says. """
+    failures = {}
+
+    def open(self, host):
+        if self.failures.get(host):
+            self.failures[host] -= 1
+            raise OSError(errno.EMFILE, "Too many open files")
+        return Capture.open(self, host)
+
+
+class ManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()  # the status lines
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.workdir)
+        manager.Capture = Capture
+
+    def run_hosts(self, opts, hosts, command):
+        runner = Manager(opts)
+        for host in hosts:
+            cmd = ["/bin/sh", "-c", command, host]
+            runner.add_task(Task(host, None, None, cmd, opts))
+        return runner.run()
+
+    def runs(self, host):
+        path = os.path.join(self.workdir, host)
+        if not os.path.exists(path):
+            return 0
+        return len(open(path).read())
+
+    def test_output_open_failure_does_not_start_the_host(self):
+        FailingCapture.failures = {"h1": 1}  # while h0 runs
+        manager.Capture = FailingCapture
+        hosts = ["h%d" % n for n in range(5)]
+        statuses = self.run_hosts(Options(), hosts,
+                                  'printf x >> %s/$PSSH_HOST' % self.workdir)
+        self.assertEqual(statuses, [0] * 5)
+        self.assertEqual([self.runs(host) for host in hosts], [1] * 5)
+
+    def test_failed_speculative_start(self):
+        # the second attempt of the straggler can never be started
+        FailingCapture.failures = {"slow.1": 1000}
+        manager.Capture = FailingCapture
+        opts = Options(par=8, adaptive=True, speculative=True, min_workers=8)
+        hosts = ["h%d" % n for n in range(6)] + ["slow"]
+        command = 'if [ $PSSH_HOST = slow ]; then sleep 1; exit 3; fi; sleep 0.05'
+        statuses = self.run_hosts(opts, hosts, command)
+        self.assertEqual(statuses, [0] * 6 + [3])
+        self.assertTrue("[FAILURE] slow Exited with error code 3" in sys.stdout.getvalue())
+
+    def run_with_input(self, opts, hosts, cmd, stdin):
+        runner = Manager(opts)
+        tasks = [Task(host, None, None, cmd, opts, stdin) for host in hosts]
+        for task in tasks:
+            runner.add_task(task)
+        hung = []
+        def kill_children():
+            # a blocked write only returns once its child is gone
+            hung.append(True)
+            for task in tasks:
+                if task.proc is not None and task.proc.poll() is None:
+                    os.kill(task.proc.pid, signal.SIGKILL)
+        watchdog = threading.Timer(20, kill_children)
+        watchdog.start()
+        try:
+            statuses = runner.run()
+        finally:
+            watchdog.cancel()
+            self.assertFalse(hung, "run hung")
+        return statuses, tasks
+
+    def test_large_input_is_written_while_output_is_read(self):
+        data = "".join(["line %d\n" % n for n in range(200000)])
+        opts = Options(par=3, tail_bytes=None, inline_stdout=True)
+        statuses, tasks = self.run_with_input(opts, ["h0", "h1", "h2"], ["cat"], data)
+        self.assertEqual(statuses, [0, 0, 0])
+        for task in tasks:
+            self.assertEqual(task.tail("stdout"), data)
+
+    def test_input_not_read_by_the_child(self):
+        data = "x" * (4 * 1024 * 1024)
+        statuses, tasks = self.run_with_input(Options(), ["h0", "h1"],
+                                               ["/bin/sh", "-c", "exit 2"], data)
+        self.assertEqual(statuses, [2, 2])
+
+    def test_input_of_a_timed_out_child(self):
+        data = "x" * (4 * 1024 * 1024)
+        statuses, tasks = self.run_with_input(Options(timeout=0.5), ["h0"], ["sleep", "5"], data)
+        self.assertEqual(statuses, [-signal.SIGKILL])
+        self.assertTrue("Timed out" in tasks[0].failures)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from py_stdlib.os_utils import scp
+from py_stdlib.os_utils.scp import compute_delta
+
+
+class ComputeDeltaTest(unittest.TestCase):
+    block_size = 2048
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "source")
+        rand = random.Random(7)
+        self.old = "".join([chr(rand.randrange(256)) for _ in range(256 * self.block_size)])
+        self.rolled = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        if "ord" in vars(scp):
+            del scp.ord
+
+    def signature(self, data):
+        return [(zlib.adler32(data[i:i + self.block_size]) & 0xffffffff,
+                 hashlib.sha1(data[i:i + self.block_size]).hexdigest())
+                for i in range(0, len(data), self.block_size)]
+
+    def delta(self, new):
+        output = open(self.path, "wb")
+        try:
+            output.write(new)
+        finally:
+            output.close()
+        return compute_delta(self.path, len(self.old), self.signature(self.old),
+                             self.block_size, max_literal=len(new) // 2)
+
+    def count_rolls(self):
+        # every byte rolled through looks up the byte leaving the window
+        def counting_ord(char):
+            self.rolled += 1
+            return ord(char)
+        scp.ord = counting_ord
+
+    def test_small_insert_is_found(self):
+        middle = len(self.old) // 2
+        stream, literal = self.delta(self.old[:middle] + "x" * 3000 + self.old[middle:])
+        self.assertEqual(literal, 3000)
+
+    def test_rewritten_file_gives_up_without_rolling_through_it(self):
+        self.count_rolls()
+        new = "".join(reversed(self.old))
+        self.assertEqual(self.delta(new), None)
+        self.assertTrue(self.rolled <= 2 * scp.DELTA_MAX_ROLL_BLOCKS * self.block_size,
+                        self.rolled)
+
+    def test_appended_data_is_not_rolled_through(self):
+        self.count_rolls()
+        extra = "y" * (64 * self.block_size)
+        stream, literal = self.delta(self.old + extra)
+        self.assertEqual(literal, len(extra))
+        self.assertTrue(self.rolled <= 2 * scp.DELTA_ROLL_BLOCKS * self.block_size,
+                        self.rolled)
+
+
+if __name__ == "__main__":
+    unittest.main()